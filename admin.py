@@ -0,0 +1,332 @@
+# admin.py
+import os
+import hmac
+import time
+import hashlib
+from datetime import datetime
+from urllib.parse import urlencode
+from aiohttp import web
+from loguru import logger
+from dotenv import load_dotenv
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+import db
+from vpn_manager import x3
+from sync import mirror
+from broadcast import broadcaster
+from traffic import format_bytes
+from tasks import generate_nickname
+
+load_dotenv()
+
+# Без ADMIN_PASSWORD админка не подключается
+ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "admin")
+ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
+# Ключ подписи cookie сессии; если не задан, выводится из пароля, и сессии переживают перезапуск
+ADMIN_SECRET = os.getenv("ADMIN_SECRET") or hashlib.sha256(f"admin:{ADMIN_PASSWORD}".encode()).hexdigest()
+ADMIN_SESSION_TTL = int(os.getenv("ADMIN_SESSION_TTL", 12 * 3600))
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", 50))
+ADMIN_MAX_PAGE_SIZE = 500
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+SESSION_COOKIE = "admin_session"
+DAY_MS = 24 * 3600 * 1000
+
+# Шаблоны компилируются один раз при подключении админки; auto_reload=False - без проверки файлов
+# на каждом рендере
+env = Environment(loader=FileSystemLoader(TEMPLATES_DIR), autoescape=select_autoescape(), auto_reload=False)
+templates = {}
+
+
+def sign(expires):
+    return hmac.new(ADMIN_SECRET.encode(), f"{ADMIN_USERNAME}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+
+def session_valid(value):
+    expires, _, signature = (value or "").partition(":")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, sign(expires))
+
+
+def render(name, **context):
+    return web.Response(text=templates[name].render(**context), content_type="text/html")
+
+
+# Срок для показа: миллисекунды эпохи из страниц или datetime из старых выборок
+def format_ms(value):
+    if not value:
+        return ""
+    if not isinstance(value, datetime):
+        value = db.from_epoch_ms(value)
+    return value.strftime("%Y-%m-%d %H:%M")
+
+
+# Срок из формы: дата/время ISO (по UTC) или миллисекунды эпохи
+def parse_expiry(value):
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    return db.to_epoch_ms(datetime.fromisoformat(value))
+
+
+def parse_tg_ids(value):
+    return [int(part) for part in value.replace(",", " ").split()]
+
+
+def page_size(request):
+    try:
+        limit = int(request.query.get("limit", ADMIN_PAGE_SIZE))
+    except ValueError:
+        raise web.HTTPBadRequest(text="limit должен быть числом")
+    return max(1, min(limit, ADMIN_MAX_PAGE_SIZE))
+
+
+# Курсор страницы: "id" без фильтра по сроку, "expires_at:id" с фильтром
+def parse_cursor(value, status):
+    if not value:
+        return None
+    try:
+        if status in ("active", "expired"):
+            expires_at, _, sub_id = value.partition(":")
+            return int(expires_at), int(sub_id)
+        return int(value)
+    except ValueError:
+        raise web.HTTPBadRequest(text="Некорректный курсор страницы")
+
+
+def make_cursor(row, status):
+    if status in ("active", "expired"):
+        return f"{row['expires_at']}:{row['id']}"
+    return str(row["id"])
+
+
+# Страница подписок по параметрам запроса: limit, after, user_id, status (active|expired).
+# Выбирается на одну строку больше, чтобы узнать, есть ли следующая страница
+async def subscriptions_page(request):
+    limit = page_size(request)
+    status = request.query.get("status") or None
+    if status not in (None, "active", "expired"):
+        raise web.HTTPBadRequest(text="status: active или expired")
+    user_id = request.query.get("user_id") or None
+    if user_id is not None and not user_id.lstrip("-").isdigit():
+        raise web.HTTPBadRequest(text="user_id должен быть числом")
+    rows = await db.get_subscriptions_page(limit + 1, after=parse_cursor(request.query.get("after"), status),
+                                           user_id=int(user_id) if user_id else None, status=status,
+                                           now_ms=int(time.time() * 1000))
+    next_cursor = make_cursor(rows[limit - 1], status) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+@web.middleware
+async def auth_middleware(request, handler):
+    if request.match_info.route.name == "admin.login" or session_valid(request.cookies.get(SESSION_COOKIE)):
+        return await handler(request)
+    if request.path.startswith("/admin/api/"):
+        raise web.HTTPUnauthorized(text='{"error": "unauthorized"}', content_type="application/json")
+    raise web.HTTPFound(request.app.router["admin.login"].url_for())
+
+
+async def login(request):
+    if request.method == "GET":
+        return render("login.html")
+    data = await request.post()
+    if not (hmac.compare_digest(data.get("username", ""), ADMIN_USERNAME)
+            and hmac.compare_digest(data.get("password", ""), ADMIN_PASSWORD)):
+        logger.warning(f"Неудачный вход в админку с {request.remote}")
+        return web.Response(status=403, text="Неверный логин или пароль")
+    expires = str(int(time.time()) + ADMIN_SESSION_TTL)
+    response = web.HTTPFound(request.app.router["admin.index"].url_for())
+    response.set_cookie(SESSION_COOKIE, f"{expires}:{sign(expires)}", max_age=ADMIN_SESSION_TTL,
+                        path="/admin", httponly=True, samesite="Strict")
+    raise response
+
+
+async def index(request):
+    subscriptions, next_cursor = await subscriptions_page(request)
+    next_url = None
+    if next_cursor is not None:
+        query = {key: value for key, value in request.query.items() if key != "after"}
+        next_url = f"{request.path}?{urlencode({**query, 'after': next_cursor})}"
+    return render("index.html", subscriptions=subscriptions, next_url=next_url, format_ms=format_ms,
+                  filters=request.query)
+
+
+async def subscriptions_json(request):
+    subscriptions, next_cursor = await subscriptions_page(request)
+    return web.json_response({"items": subscriptions, "next": next_cursor})
+
+
+async def users_json(request):
+    try:
+        after = int(request.query.get("after", 0))
+    except ValueError:
+        raise web.HTTPBadRequest(text="Некорректный курсор страницы")
+    limit = page_size(request)
+    user_ids = await db.get_users_after(after, limit + 1)
+    return web.json_response({"items": user_ids[:limit],
+                              "next": user_ids[limit - 1] if len(user_ids) > limit else None})
+
+
+# Пользователи с наибольшим трафиком за days суток: (days, [(user_id, up, down)])
+async def traffic_top(request):
+    try:
+        days = max(1, int(request.query.get("days", 30)))
+    except ValueError:
+        raise web.HTTPBadRequest(text="days должен быть числом")
+    now = int(time.time() * 1000)
+    return days, await db.get_traffic_top(now - now % DAY_MS - (days - 1) * DAY_MS, page_size(request))
+
+
+async def traffic_top_json(request):
+    _, rows = await traffic_top(request)
+    return web.json_response({"items": [{"user_id": user_id, "up": up, "down": down} for user_id, up, down in rows]})
+
+
+async def traffic_page(request):
+    days, rows = await traffic_top(request)
+    return render("traffic.html", days=days, limit=page_size(request), rows=rows, format_bytes=format_bytes)
+
+
+# Пакетные операции с клиентами панели: {"tg_ids": [...], "days": N} для продления,
+# {"tg_ids": [...]} для удаления, {"tg_ids": [...], "days": N} для создания ключей
+async def read_batch(request, need_days):
+    try:
+        data = await request.json()
+        tg_ids = [int(tg_id) for tg_id in data["tg_ids"]]
+        days = int(data["days"]) if need_days else None
+    except (ValueError, KeyError, TypeError):
+        raise web.HTTPBadRequest(text='Ожидается {"tg_ids": [...]' + (', "days": N}' if need_days else '}'))
+    return tg_ids, days
+
+
+async def create_clients_json(request):
+    tg_ids, days = await read_batch(request, need_days=True)
+    links, existing = await x3.add_clients_if_absent([(days, tg_id, f"{tg_id}-{generate_nickname()}")
+                                                      for tg_id in tg_ids])
+    await mirror.flush()
+    return web.json_response({"created": {str(tg_id): link for tg_id, link in links.items()},
+                              "existing": sorted(existing)})
+
+
+async def renew_clients_json(request):
+    tg_ids, days = await read_batch(request, need_days=True)
+    renewed = await x3.renew_many(days, tg_ids)
+    await mirror.flush()
+    return web.json_response({"renewed": sorted(renewed)})
+
+
+async def delete_clients_json(request):
+    tg_ids, _ = await read_batch(request, need_days=False)
+    deleted = await x3.delete_many(tg_ids)
+    await mirror.flush()
+    return web.json_response({"deleted": sorted(deleted)})
+
+
+# Создание ключей: в поле user_id можно перечислить несколько tg_id через запятую или пробел,
+# все ключи создаются одним пакетом
+async def create_key(request):
+    if request.method == "GET":
+        return render("new_key.html")
+    data = await request.post()
+    try:
+        tg_ids = parse_tg_ids(data.get("user_id", ""))
+        days = int(data.get("duration", ""))
+    except ValueError:
+        raise web.HTTPBadRequest(text="User ID и срок должны быть числами")
+    # Проверка существующих ключей и добавление - под блокировками пользователей, как у бота
+    links, existing = await x3.add_clients_if_absent([(days, tg_id, f"{tg_id}-{generate_nickname()}")
+                                                      for tg_id in tg_ids])
+    await mirror.flush()
+    logger.info(f"Админка: создано ключей {len(links)}, уже были у {len(existing)}")
+    return render("new_key.html", links=links, existing=sorted(existing))
+
+
+async def edit_subscription(request):
+    sub_id = int(request.match_info["sub_id"])
+    subscription = await db.get_subscription(sub_id)
+    if subscription is None:
+        raise web.HTTPNotFound(text="Подписка не найдена")
+    if request.method == "GET":
+        return render("edit.html", sub_id=sub_id, expires_at=format_ms(subscription["expires_at"]))
+    data = await request.post()
+    try:
+        expires_at = parse_expiry(data.get("expires_at", ""))
+    except ValueError:
+        raise web.HTTPBadRequest(text="Срок: YYYY-MM-DD HH:MM (UTC) или миллисекунды")
+    # Для клиентов панели срок меняется в 3x-ui запросом на одного клиента, зеркало запишет его в базу
+    if subscription["inbound_id"] is not None:
+        if not await x3.set_expiry(subscription["user_id"], expires_at):
+            return web.Response(status=502, text="Панель не приняла изменение срока")
+        await mirror.flush()
+    else:
+        await db.update_subscription_async(sub_id, db.from_epoch_ms(expires_at))
+    logger.info(f"Админка: срок подписки {sub_id} изменен на {format_ms(expires_at)}")
+    raise web.HTTPFound(request.app.router["admin.index"].url_for())
+
+
+async def delete_subscription_route(request):
+    sub_id = int(request.match_info["sub_id"])
+    subscription = await db.get_subscription(sub_id)
+    if subscription is None:
+        raise web.HTTPNotFound(text="Подписка не найдена")
+    if subscription["inbound_id"] is not None:
+        if not await x3.delete_client(subscription["user_id"]):
+            return web.Response(status=502, text="Панель не удалила клиента")
+        await mirror.flush()
+    else:
+        await db.delete_subscription_async(sub_id)
+    logger.info(f"Админка: подписка {sub_id} пользователя {subscription['user_id']} удалена")
+    raise web.HTTPFound(request.app.router["admin.index"].url_for())
+
+
+async def send_message(request):
+    if request.method == "GET":
+        return render("send_message.html")
+    data = await request.post()
+    try:
+        chat_id = int(data.get("chat_id", ""))
+    except ValueError:
+        raise web.HTTPBadRequest(text="Chat ID должен быть числом")
+    delivered = await broadcaster.deliver(chat_id, data.get("message", ""))
+    return render("send_message.html", delivered=delivered)
+
+
+async def broadcast_message(request):
+    if request.method == "GET":
+        return render("broadcast.html")
+    data = await request.post()
+    broadcast_id = await broadcaster.start_broadcast(data.get("message", ""))
+    logger.info(f"Админка: запущена рассылка {broadcast_id}")
+    return render("broadcast.html", broadcast_id=broadcast_id)
+
+
+def url_for(name, **params):
+    return str(admin_app.router[name].url_for(**{key: str(value) for key, value in params.items()}))
+
+
+admin_app = web.Application(middlewares=[auth_middleware])
+admin_app.router.add_route("*", "/login", login, name="admin.login")
+admin_app.router.add_get("/", index, name="admin.index")
+admin_app.router.add_route("*", "/keys/new", create_key, name="admin.create_key")
+admin_app.router.add_route("*", "/subscriptions/{sub_id:\\d+}/edit", edit_subscription,
+                           name="admin.edit_subscription")
+admin_app.router.add_post("/subscriptions/{sub_id:\\d+}/delete", delete_subscription_route,
+                          name="admin.delete_subscription_route")
+admin_app.router.add_route("*", "/send_message", send_message, name="admin.send_message")
+admin_app.router.add_route("*", "/broadcast", broadcast_message, name="admin.broadcast_message")
+admin_app.router.add_get("/traffic", traffic_page, name="admin.traffic")
+admin_app.router.add_get("/api/subscriptions", subscriptions_json, name="admin.api_subscriptions")
+admin_app.router.add_get("/api/users", users_json, name="admin.api_users")
+admin_app.router.add_get("/api/traffic/top", traffic_top_json, name="admin.api_traffic_top")
+admin_app.router.add_post("/api/clients", create_clients_json, name="admin.api_create_clients")
+admin_app.router.add_post("/api/clients/renew", renew_clients_json, name="admin.api_renew_clients")
+admin_app.router.add_post("/api/clients/delete", delete_clients_json, name="admin.api_delete_clients")
+
+
+# Подключает админку к приложению под /admin и компилирует все шаблоны
+def setup_admin(app):
+    env.globals["url_for"] = url_for
+    for name in env.list_templates(extensions=["html"]):
+        templates[name] = env.get_template(name)
+    app.add_subapp("/admin", admin_app)
+    logger.info(f"Админка подключена, шаблонов: {len(templates)}")
\ No newline at end of file
@@ -0,0 +1,70 @@
+# benchmarks/bench_admin.py
+# Время главной страницы админки в зависимости от числа подписок: вся таблица (get_all_subscriptions)
+# против страницы по курсору (get_subscriptions_page). Шаблон один и тот же, скомпилированный один раз.
+# Запуск из корня репозитория: python -m benchmarks.bench_admin --sizes 1000,10000,100000
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from aiohttp import web
+from admin import setup_admin, templates, format_ms, ADMIN_PAGE_SIZE
+
+
+async def fill(count, start):
+    now_ms = int(time.time() * 1000)
+    await db.get_db().executemany('''
+        INSERT INTO subscriptions (user_id, key_id, access_url, expires_at) VALUES (?, ?, ?, ?)
+    ''', [(100000 + i, f"key-{i}", f"vless://key-{i}@bench.example.com:443", now_ms + (i % 100 - 50) * 3600000)
+          for i in range(start, count)])
+    await db.get_db().commit()
+
+
+async def timed_page(fetch, repeat):
+    total = 0.0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = await fetch()
+        templates["index.html"].render(subscriptions=rows, next_url=None, format_ms=format_ms, filters={})
+        total += time.perf_counter() - started
+    return total / repeat, len(rows)
+
+
+async def main(args):
+    setup_admin(web.Application())
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_FILE = os.path.join(tmp, "bench.db")
+        await db.init_db()
+        try:
+            await run(args)
+        finally:
+            await db.close_db()
+
+
+async def run(args):
+    filled = 0
+    for size in sorted(int(size) for size in args.sizes.split(",")):
+        await fill(size, filled)
+        filled = size
+        now_ms = int(time.time() * 1000)
+        full, rows = await timed_page(db.get_all_subscriptions, args.repeat)
+        print(f"{size:>8} subscriptions  full table: {full * 1000:9.2f} ms ({rows} rows)")
+        page, rows = await timed_page(lambda: db.get_subscriptions_page(ADMIN_PAGE_SIZE + 1), args.repeat)
+        print(f"{'':>8}                page:       {page * 1000:9.2f} ms ({rows} rows)")
+        middle = (now_ms, size // 2)
+        page, rows = await timed_page(lambda: db.get_subscriptions_page(ADMIN_PAGE_SIZE + 1, after=middle,
+                                                                        status="active", now_ms=now_ms),
+                                      args.repeat)
+        print(f"{'':>8}                active, mid: {page * 1000:8.2f} ms ({rows} rows)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--repeat", type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
\ No newline at end of file
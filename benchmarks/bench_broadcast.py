@@ -0,0 +1,88 @@
+# benchmarks/bench_broadcast.py
+# Пропускная способность рассылки против имитации Telegram Bot API с лимитом 30 сообщений в секунду.
+# Запуск из корня репозитория: python -m benchmarks.bench_broadcast --users 600
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from aiogram.methods import SendMessage
+from aiogram.exceptions import TelegramRetryAfter
+from broadcast import Broadcaster
+
+
+# Бот, который отвечает с задержкой latency и, как Telegram, возвращает RetryAfter
+# при превышении limit сообщений за последнюю секунду
+class FakeBot:
+    def __init__(self, latency, limit=30):
+        self.latency = latency
+        self.limit = limit
+        self.window = deque()
+        self.sent = 0
+        self.flood = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        while self.window and now - self.window[0] > 1:
+            self.window.popleft()
+        if len(self.window) >= self.limit:
+            self.flood += 1
+            raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=text), "Flood control exceeded", 1)
+        self.window.append(now)
+        self.sent += 1
+
+
+# Без очереди: по одному сообщению, как раньше отправлялись уведомления в цикле проверки
+async def serial(bot, users):
+    for user_id in users:
+        try:
+            await bot.send_message(user_id, "bench")
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+
+
+async def main(args):
+    users = list(range(1, args.users + 1))
+
+    bot = FakeBot(args.latency)
+    started = time.perf_counter()
+    await serial(bot, users)
+    elapsed = time.perf_counter() - started
+    print(f"serial:    {bot.sent}/{len(users)} delivered in {elapsed:.1f}s "
+          f"({bot.sent / elapsed:.1f} msg/s), flood errors {bot.flood}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_FILE = os.path.join(tmp, "bench.db")
+        await db.init_db()
+        for user_id in users:
+            await db.get_db().execute('INSERT INTO users (user_id) VALUES (?)', (user_id,))
+        await db.get_db().commit()
+
+        bot = FakeBot(args.latency)
+        broadcaster = Broadcaster(rate=args.rate, workers=args.workers)
+        broadcaster.start(bot)
+        started = time.perf_counter()
+        broadcast_id = await broadcaster.start_broadcast("bench")
+        await broadcaster.broadcasts[broadcast_id]
+        elapsed = time.perf_counter() - started
+        print(f"broadcast: {bot.sent}/{len(users)} delivered in {elapsed:.1f}s "
+              f"({bot.sent / elapsed:.1f} msg/s), flood errors {bot.flood}, "
+              f"rate {args.rate}/s, {args.workers} workers")
+        await broadcaster.stop()
+        await db.close_db()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=600)
+    parser.add_argument("--latency", type=float, default=0.1, help="задержка ответа Bot API, с")
+    parser.add_argument("--rate", type=float, default=25)
+    parser.add_argument("--workers", type=int, default=8)
+    asyncio.run(main(parser.parse_args()))
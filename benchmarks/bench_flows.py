@@ -0,0 +1,301 @@
+# benchmarks/bench_flows.py
+# Сквозные замеры против локальной заглушки панели (benchmarks/fake_panel.py): обработчики бота,
+# проход проверки подписок, сбор трафика, уведомления ЮMoney и обновления Telegram через webhook. Печатает p50/p99 и пропускную способность.
+# Запуск из корня репозитория: python -m benchmarks.bench_flows --clients 10000 --latency 0.02
+import os
+import sys
+import time
+import asyncio
+import hashlib
+import argparse
+import tempfile
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_panel import FakePanel
+
+SECRET = "bench-secret"
+
+
+def configure(args):
+    # Настройки читаются модулями бота при импорте, поэтому задаются до него.
+    # Уже заданные переменные .env не перекрывает
+    os.environ.update({
+        "HOST": f"http://127.0.0.1:{args.port}",
+        "BASE_PATH": "",
+        "LOGIN": "bench",
+        "PASSWORD": "bench",
+        "PANELS": "",
+        "TELEGRAM_BOT_TOKEN": "123456:bench",
+        "YOOMONEY_SECRET": SECRET,
+        "TELEGRAM_WEBHOOK_URL": f"http://127.0.0.1:{args.port + 1}",
+    })
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(name, latencies, elapsed):
+    print(f"{name:<22} n={len(latencies):<6} p50={percentile(latencies, 50) * 1000:8.2f} ms  "
+          f"p99={percentile(latencies, 99) * 1000:8.2f} ms  {len(latencies) / elapsed:9.1f} op/s")
+
+
+# Выполняет coros с ограничением параллельности и возвращает задержки каждого вызова
+async def run_concurrent(factories, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def timed(factory):
+        async with semaphore:
+            started = time.perf_counter()
+            await factory()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed(factory) for factory in factories))
+    return latencies, time.perf_counter() - started
+
+
+def make_session(latency):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import SendMessage
+    from aiogram.types import Chat, Message
+
+    # Сессия Bot API без сети: отвечает с задержкой latency, сообщения только считаются
+    class FakeSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.sent = 0
+
+        async def make_request(self, bot, method, timeout=None):
+            await asyncio.sleep(latency)
+            if isinstance(method, SendMessage):
+                self.sent += 1
+                return Message(message_id=self.sent, date=datetime.now(),
+                               chat=Chat(id=method.chat_id, type="private"), text=method.text)
+            return True
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            raise NotImplementedError
+
+        async def close(self):
+            pass
+
+    return FakeSession()
+
+
+def make_update(update_id, tg_id, text=None, data=None):
+    from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+    user = User(id=tg_id, is_bot=False, first_name="bench")
+    message = Message(message_id=update_id, date=datetime.now(), chat=Chat(id=tg_id, type="private"),
+                      from_user=user, text=text or "menu")
+    if data is None:
+        return Update(update_id=update_id, message=message)
+    return Update(update_id=update_id,
+                  callback_query=CallbackQuery(id=str(update_id), from_user=user, chat_instance="bench",
+                                               message=message, data=data))
+
+
+async def bench_bot(args, telegram_bot):
+    from context import current
+    bot, dp = current().bot, telegram_bot.dp
+    flows = [
+        ("bot /start", lambda i: make_update(i, 100000 + i % args.clients, text="/start")),
+        ("bot my_keys", lambda i: make_update(i, 100000 + i % args.clients, data="my_keys")),
+        ("bot new_key", lambda i: make_update(i, 100000 + i % args.clients, data="new_key")),
+        ("bot traffic", lambda i: make_update(i, 100000 + i % args.clients, data="traffic")),
+        ("bot test_period", lambda i: make_update(i, 900000 + i, data="test_period")),
+        ("bot instruction", lambda i: make_update(i, 100000 + i % args.clients, data="instruction")),
+    ]
+    for name, make in flows:
+        updates = [make(i) for i in range(args.requests)]
+        latencies, elapsed = await run_concurrent(
+            [lambda update=update: dp.feed_update(bot, update) for update in updates], args.concurrency)
+        report(name, latencies, elapsed)
+
+
+async def bench_traffic(args, traffic):
+    latencies = []
+    for _ in range(args.sweeps):
+        started = time.perf_counter()
+        await traffic.traffic_collector.collect()
+        latencies.append(time.perf_counter() - started)
+    report(f"traffic collect ({len(traffic.traffic_collector.counters)})", latencies, sum(latencies))
+
+
+async def bench_sweep(args, tasks):
+    latencies = []
+    for _ in range(args.sweeps):
+        # Каждый проход читает список заново, как после истечения CLIENT_INDEX_TTL
+        tasks.x3.index.invalidate()
+        started = time.perf_counter()
+        await tasks.sweep_subscribes_expirity()
+        latencies.append(time.perf_counter() - started)
+    report(f"expiry sweep ({len(tasks.x3.index.clients)})", latencies, sum(latencies))
+
+
+def sign(fields):
+    params = [fields[key] for key in ("notification_type", "operation_id", "amount", "currency",
+                                      "datetime", "sender", "codepro")]
+    fields["sha1_hash"] = hashlib.sha1("&".join([*params, SECRET, fields["label"]]).encode()).hexdigest()
+    return fields
+
+
+def make_notification(i, args):
+    stamp = int(time.time())
+    # Половина уведомлений продлевает существующих клиентов, половина покупает новые ключи
+    if i % 2:
+        label = f"renew_key_{100000 + i % args.clients}_{stamp}"
+    else:
+        label = f"{800000 + i}_{stamp}"
+    return sign({
+        "notification_type": "card-incoming",
+        "operation_id": f"bench-{stamp}-{i}",
+        "amount": "196.00",
+        "withdraw_amount": "200.00",
+        "currency": "643",
+        "datetime": datetime.now().isoformat(),
+        "sender": "",
+        "codepro": "false",
+        "label": label,
+    })
+
+
+async def bench_webhook(args, main_module, payments):
+    import aiohttp
+    from aiohttp import web
+
+    runner = web.AppRunner(main_module.app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port + 1).start()
+    url = f"http://127.0.0.1:{args.port + 1}/yoomoney_notification"
+    notifications = [make_notification(i, args) for i in range(args.requests)]
+    try:
+        async with aiohttp.ClientSession() as session:
+            async def post(fields):
+                async with session.post(url, data=fields) as response:
+                    assert await response.text() == "OK"
+
+            started = time.perf_counter()
+            latencies, elapsed = await run_concurrent(
+                [lambda fields=fields: post(fields) for fields in notifications], args.concurrency)
+            report("webhook response", latencies, elapsed)
+            # Выдача ключей идет в фоне: замер до обработки всех записанных платежей
+            await payments.payment_processor.queue.join()
+            total = time.perf_counter() - started
+            print(f"{'webhook processed':<22} n={len(notifications):<6} "
+                  f"{len(notifications) / total:9.1f} payments/s end to end")
+    finally:
+        await runner.cleanup()
+
+
+# Обновления Telegram через webhook: время ответа сервера и обработка через очередь обновлений
+async def bench_updates(args, main_module, telegram_bot):
+    import aiohttp
+    from aiohttp import web
+    from telegram_webhook import update_queue, TELEGRAM_WEBHOOK_PATH
+    from context import current
+
+    runner = web.AppRunner(main_module.app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port + 1).start()
+    update_queue.start(current().bot, telegram_bot.dp)
+    url = f"http://127.0.0.1:{args.port + 1}{TELEGRAM_WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": update_queue.secret}
+    bodies = [make_update(i, 100000 + i % args.clients, data="my_keys").model_dump_json(exclude_none=True)
+              for i in range(args.requests)]
+    try:
+        async with aiohttp.ClientSession(headers={**headers, "Content-Type": "application/json"}) as session:
+            async def post(body):
+                async with session.post(url, data=body) as response:
+                    assert response.status == 200, response.status
+
+            started = time.perf_counter()
+            latencies, elapsed = await run_concurrent(
+                [lambda body=body: post(body) for body in bodies], args.concurrency)
+            report("updates response", latencies, elapsed)
+            await update_queue.queue.join()
+            total = time.perf_counter() - started
+            print(f"{'updates processed':<22} n={len(bodies):<6} {len(bodies) / total:9.1f} updates/s end to end")
+    finally:
+        await update_queue.stop()
+        await runner.cleanup()
+
+
+async def main(args):
+    panel = FakePanel(args.clients, args.per_inbound, args.latency, args.jitter)
+    panel_runner = await panel.start(port=args.port)
+
+    import db
+    import main as main_module
+    import tasks
+    import payments
+    import traffic
+    import telegram_bot
+    from sync import mirror
+    from broadcast import broadcaster
+    from context import create_context
+
+    context = create_context(stderr_level=None)
+    context.start_logging()
+    await db.init_db()
+    context.bot.session = make_session(args.api_latency)
+    # Лимит Telegram не проверяется: замеряется работа бота, а не ожидание токенов
+    broadcaster.bucket.rate = 10 ** 9
+    broadcaster.start(context.bot)
+    payments.payment_processor.start()
+    try:
+        started = time.perf_counter()
+        await mirror.reconcile()
+        report(f"mirror reconcile ({len(mirror.rows)})", [time.perf_counter() - started],
+               time.perf_counter() - started)
+        if "bot" in args.scenarios:
+            await bench_bot(args, telegram_bot)
+        if "sweep" in args.scenarios:
+            await bench_sweep(args, tasks)
+        if "traffic" in args.scenarios:
+            await bench_traffic(args, traffic)
+        if "webhook" in args.scenarios:
+            await bench_webhook(args, main_module, payments)
+        if "updates" in args.scenarios:
+            await bench_updates(args, main_module, telegram_bot)
+        await broadcaster.queue.join()
+        await mirror.flush()
+        print(f"panel calls: {panel.calls}")
+    finally:
+        await payments.payment_processor.stop()
+        await broadcaster.stop()
+        await context.close()
+        await db.close_db()
+        await panel_runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=5000)
+    parser.add_argument("--per-inbound", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа панели, с")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument("--requests", type=int, default=500, help="запросов на каждый сценарий")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--sweeps", type=int, default=5)
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--scenarios", default="bot,sweep,traffic,webhook,updates")
+    args = parser.parse_args()
+    configure(args)
+
+    from loguru import logger
+    # Журналы бота пишутся в файлы во временном каталоге, в консоль выводятся только результаты
+    logger.remove()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        asyncio.run(main(args))
+        os.chdir(ROOT)
\ No newline at end of file
@@ -0,0 +1,71 @@
+# benchmarks/bench_logging.py
+# Стоимость записи журнала для вызывающего потока: прежние синхронные текстовые файлы против
+# start_logging (очередь, JSON, ограничение по месту вызова). Имитирует поиск клиента, который
+# пишет строку на каждый вызов, и проход по клиентам с записью на каждого.
+# Запуск из корня репозитория: python -m benchmarks.bench_logging --records 100000
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger
+from logs import LOG_SINKS, sampler, start_logging, stop_logging
+
+
+def lookups(count):
+    for tg_id in range(count):
+        logger.debug(f"Найдена ссылка для клиента: {tg_id}")
+
+
+def count_lines(tmp):
+    total = 0
+    for path, _ in LOG_SINKS:
+        with open(os.path.join(tmp, path), encoding="utf-8") as file:
+            total += sum(1 for _ in file)
+    return total
+
+
+def run(name, setup, teardown, count):
+    with tempfile.TemporaryDirectory() as tmp:
+        sinks = [(os.path.join(tmp, path), level) for path, level in LOG_SINKS]
+        sink_ids = setup(sinks)
+        started = time.perf_counter()
+        lookups(count)
+        caller = time.perf_counter() - started
+        teardown(sink_ids)
+        total = time.perf_counter() - started
+        lines = count_lines(tmp)
+    print(f"{name:<28} caller: {caller * 1000:8.1f} ms ({caller / count * 1e6:6.2f} us/record)  "
+          f"until flushed: {total * 1000:8.1f} ms  lines written: {lines}")
+
+
+def old_setup(sinks):
+    return [logger.add(path, mode='w', level=level) for path, level in sinks]
+
+
+def old_teardown(sink_ids):
+    for sink_id in sink_ids:
+        logger.remove(sink_id)
+
+
+# Без stderr: сравниваются только файлы
+def new_setup(sinks):
+    return start_logging(sinks, stderr_level=None)
+
+
+def main(args):
+    logger.remove()
+    run("sync text sinks (before)", old_setup, old_teardown, args.records)
+    run("start_logging (after)", new_setup, stop_logging, args.records)
+    # Только очередь и JSON, без ограничения: каждая запись доходит до файлов
+    sampler.burst = 0
+    run("start_logging, no sampling", new_setup, stop_logging, args.records)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=100000)
+    main(parser.parse_args())
\ No newline at end of file
@@ -0,0 +1,78 @@
+# benchmarks/bench_loop_monitor.py
+# Сторож цикла событий: накладные расходы на пропускную способность цикла (много коротких задач
+# с монитором и без) и обнаружение блокировки - обработчик, который синхронно спит внутри корутины.
+# Запуск из корня репозитория: python -m benchmarks.bench_loop_monitor --switches 200000
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger
+from prometheus_client import REGISTRY
+from loop_monitor import LoopMonitor
+
+
+async def switches(count, tasks=100):
+    async def worker():
+        for _ in range(count // tasks):
+            await asyncio.sleep(0)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(tasks)))
+    return time.perf_counter() - started
+
+
+def blocking_lookup(seconds):
+    # Как синхронный HTTP-запрос к панели внутри обработчика
+    time.sleep(seconds)
+
+
+async def handle_slow_command(seconds):
+    await asyncio.sleep(0)
+    blocking_lookup(seconds)
+
+
+async def run(args, monitor):
+    if monitor:
+        monitor.start()
+    try:
+        elapsed = await switches(args.switches)
+        if args.block:
+            await handle_slow_command(args.block)
+            await asyncio.sleep(monitor.interval * 2 if monitor else 0)
+    finally:
+        if monitor:
+            await monitor.stop()
+    return elapsed
+
+
+def samples(name):
+    for metric in REGISTRY.collect():
+        for sample in metric.samples:
+            if sample.name == name and sample.value:
+                yield sample.labels, sample.value
+
+
+def main(args):
+    logger.remove()
+    logger.add(sys.stdout, format="{level} {message}", level="WARNING")
+    base = asyncio.run(run(argparse.Namespace(switches=args.switches, block=0), None))
+    print(f"{args.switches} task switches without monitor: {base * 1000:8.1f} ms")
+    with_monitor = asyncio.run(run(argparse.Namespace(switches=args.switches, block=0), LoopMonitor()))
+    print(f"{args.switches} task switches with monitor:    {with_monitor * 1000:8.1f} ms "
+          f"({(with_monitor / base - 1) * 100:+.1f}%)")
+    print(f"handler blocking the loop for {args.block * 1000:.0f} ms, debug mode:")
+    asyncio.run(run(args, LoopMonitor(debug=True)))
+    for labels, value in samples("loop_blocked_seconds_total"):
+        print(f"  loop_blocked_seconds_total{labels} = {value:.3f}")
+    for labels, value in samples("loop_sync_calls_total"):
+        print(f"  loop_sync_calls_total{labels} = {value:.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--switches", type=int, default=200000)
+    parser.add_argument("--block", type=float, default=0.3, help="длительность блокировки, с")
+    main(parser.parse_args())
\ No newline at end of file
@@ -0,0 +1,82 @@
+# benchmarks/bench_parse.py
+# Память и CPU разбора ответа inbounds/list: прежний разбор всего тела и settings каждого инбаунда
+# против потокового разбора с кэшем по хэшу settings.
+# Запуск из корня репозитория: python -m benchmarks.bench_parse --clients 50000
+import os
+import sys
+import gc
+import json
+import time
+import asyncio
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger
+from benchmarks.fake_panel import FakePanel
+from jsonstream import load_stream, CHUNK_SIZE
+from vpn_manager import ClientIndex
+
+
+def make_body(clients, per_inbound):
+    panel = FakePanel(clients, per_inbound)
+    obj = [{**inbound["item"], "settings": json.dumps({"clients": list(inbound["clients"].values())})}
+           for inbound in panel.inbounds.values()]
+    return json.dumps({"success": True, "msg": "", "obj": obj}).encode()
+
+
+async def chunks(body):
+    for start in range(0, len(body), CHUNK_SIZE):
+        yield body[start:start + CHUNK_SIZE]
+
+
+# Прежний путь: response.text() и json.loads всего тела, затем json.loads settings каждого инбаунда.
+# Инбаунды с исходными строками settings остаются в индексе вместе с разобранными клиентами
+async def legacy(body, state):
+    inbounds = json.loads(body.decode())["obj"]
+    clients = {}
+    for item in inbounds:
+        for client in json.loads(item["settings"])["clients"]:
+            clients.setdefault(client["tgId"], (item, client))
+    state["kept"] = (inbounds, clients)
+
+
+async def streaming(body, state):
+    index = state.setdefault("index", ClientIndex(60))
+    data = await load_stream(chunks(body), "obj", lambda item: index.decode(item, "bench"))
+    index.rebuild(data["obj"], "bench")
+
+
+async def measure(name, func, body, state, trace):
+    gc.collect()
+    if trace:
+        tracemalloc.start()
+        await func(body, state)
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:<18} peak {peak / 2 ** 20:7.1f} MiB, retained {retained / 2 ** 20:7.1f} MiB")
+    else:
+        started = time.process_time()
+        await func(body, state)
+        print(f"{name:<18} cpu {(time.process_time() - started) * 1000:8.1f} ms")
+
+
+async def main(args):
+    body = make_body(args.clients, args.per_inbound)
+    print(f"inbounds/list: {args.clients} clients, {len(body) / 2 ** 20:.1f} MiB")
+    for trace in (False, True):
+        await measure("legacy", legacy, body, {}, trace)
+        state = {}
+        await measure("streaming (cold)", streaming, body, state, trace)
+        # Повторная загрузка без изменений: settings только хэшируются
+        await measure("streaming (warm)", streaming, body, state, trace)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=50000)
+    parser.add_argument("--per-inbound", type=int, default=5000)
+    logger.remove()
+    asyncio.run(main(parser.parse_args()))
\ No newline at end of file
@@ -0,0 +1,68 @@
+# benchmarks/bench_startup.py
+# Холодный старт: время от запуска процесса до первого обработанного обновления (/start) без сети.
+# Панель указана на закрытый порт, Bot API заменен сессией без сети: старт не должен от них зависеть.
+# Запуск из корня репозитория: python -m benchmarks.bench_startup --runs 5
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def child():
+    started = time.perf_counter()
+    import asyncio
+    import main
+    imported = time.perf_counter()
+    from benchmarks.bench_flows import make_session, make_update
+    import db
+    from context import create_context
+
+    async def run():
+        context = create_context()
+        context.start_logging()
+        await db.init_db()
+        context.bot.session = make_session(0)
+        await main.dp.feed_update(context.bot, make_update(1, 42, text="/start"))
+        handled = time.perf_counter()
+        # Пул панелей не нужен для /start и не должен был создаваться
+        result = {"import": imported - started, "first_update": handled - started,
+                  "pool_created": "x3" in context.__dict__}
+        await context.close()
+        await db.close_db()
+        return result
+
+    print(json.dumps(asyncio.run(run())))
+
+
+def main(args):
+    env = {**os.environ, "PYTHONPATH": ROOT, "TELEGRAM_BOT_TOKEN": "123456:bench",
+           "HOST": "http://127.0.0.1:9", "PANELS": "", "TELEGRAM_WEBHOOK_URL": ""}
+    results = []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as tmp:
+            started = time.perf_counter()
+            output = subprocess.run([sys.executable, "-m", "benchmarks.bench_startup", "--child"], cwd=tmp,
+                                    env=env, capture_output=True, text=True, check=True).stdout
+            total = time.perf_counter() - started
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(f"process start -> first update {total * 1000:7.0f} ms  (imports {result['import'] * 1000:6.0f} ms, "
+              f"in process {result['first_update'] * 1000:6.0f} ms, pool created: {result['pool_created']})")
+    best = min(result["first_update"] for result in results)
+    print(f"best in-process time to first update: {best * 1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--child", action="store_true")
+    args = parser.parse_args()
+    if args.child:
+        child()
+    else:
+        main(args)
\ No newline at end of file
@@ -0,0 +1,134 @@
+# benchmarks/bench_sweep.py
+# Замер одного прохода проверки сроков подписок на синтетических клиентах.
+# Оба алгоритма прогоняются на одном и том же числе клиентов. Старый алгоритм квадратичен
+# (~15 с на 2000 клиентов), поэтому для больших списков можно ограничить --before-sample:
+# тогда время для всех клиентов экстраполируется, и это указывается в выводе.
+# Запуск из корня репозитория: python -m benchmarks.bench_sweep --clients 2000
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tasks
+from broadcast import Broadcaster
+from vpn_manager import X3
+
+
+def make_inbounds(clients, per_inbound=5000):
+    now_ms = int(time.time() * 1000)
+    inbounds = []
+    for start in range(0, clients, per_inbound):
+        items = []
+        for i in range(start, min(start + per_inbound, clients)):
+            items.append({
+                "id": f"00000000-0000-0000-0000-{i:012d}",
+                "email": f"{i}-bench",
+                "tgId": 100000 + i,
+                # Часть клиентов уже истекла, часть попадает в окно напоминания, остальные активны
+                "expiryTime": now_ms + ((i % 100) - 2) * 3600 * 1000,
+                "flow": "xtls-rprx-vision",
+                "enable": True
+            })
+        inbounds.append({
+            "id": len(inbounds) + 1,
+            "port": 443,
+            "settings": json.dumps({"clients": items}),
+            "streamSettings": "{}"
+        })
+    return inbounds
+
+
+# X3, отвечающий из памяти: замеряется только работа бота, без сети
+class FakeX3(X3):
+    def __init__(self, inbounds):
+        super().__init__("bench", "bench", "https://bench")
+        self.payload = {"success": True, "obj": inbounds}
+        self.requests = 0
+
+    async def request(self, method, path, **kwargs):
+        self.requests += 1
+        if path.endswith("/inbounds/list"):
+            # Как и при реальном ответе, каждый раз отдается свежая копия
+            return 200, json.loads(json.dumps(self.payload))
+        return 200, {"success": True}
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+
+# Прежний get_inbounds: весь список без индекса
+async def legacy_inbounds(x3):
+    status, data = await x3.request("GET", "/panel/api/inbounds/list")
+    return data["obj"]
+
+
+# Прежний алгоритм: для каждого клиента полная загрузка и разбор списка инбаундов
+async def legacy_sweep(x3, bot, limit):
+    inbounds = await legacy_inbounds(x3)
+    checked = 0
+    for item in inbounds:
+        for client in json.loads(item["settings"])["clients"]:
+            if checked >= limit:
+                return checked
+            tg_id = client.get("tgId")
+            time_left = None
+            for other in await legacy_inbounds(x3):
+                for candidate in json.loads(other["settings"])["clients"]:
+                    if candidate.get("tgId") == tg_id:
+                        time_left = candidate["expiryTime"]
+                        break
+                if time_left is not None:
+                    break
+            total_seconds_left = (time_left - int(time.time() * 1000)) // 1000
+            if total_seconds_left <= 0:
+                await bot.send_message(str(tg_id), "expired")
+            checked += 1
+    return checked
+
+
+async def main(args):
+    inbounds = make_inbounds(args.clients)
+
+    x3 = FakeX3(inbounds)
+    bot = FakeBot()
+    sample = args.before_sample or args.clients
+    started = time.perf_counter()
+    checked = await legacy_sweep(x3, bot, sample)
+    legacy = time.perf_counter() - started
+    if checked >= args.clients:
+        print(f"before: {checked} clients in {legacy:.2f}s, {x3.requests} panel requests")
+    else:
+        # Каждый клиент старым алгоритмом разбирает весь список, поэтому время на клиента постоянно
+        # для данного размера списка; итог не измерен, а пересчитан
+        print(f"before: {checked} of {args.clients} clients in {legacy:.2f}s, {x3.requests} panel requests; "
+              f"EXTRAPOLATED ~{legacy / checked * args.clients:.1f}s for {args.clients} clients (not measured)")
+
+    x3 = FakeX3(inbounds)
+    bot = FakeBot()
+    tasks.x3 = x3
+    x3.index.listeners.append(tasks.scheduler.update)
+    tasks.broadcaster = Broadcaster(rate=10 ** 9)
+    tasks.broadcaster.start(bot)
+    started = time.perf_counter()
+    await tasks.sweep_subscribes_expirity()
+    await tasks.broadcaster.queue.join()
+    elapsed = time.perf_counter() - started
+    print(f"after:  {args.clients} clients in {elapsed:.2f}s, "
+          f"{x3.requests} panel requests, {bot.sent} messages")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--before-sample", type=int, default=0,
+                        help="сколько клиентов прогнать старым алгоритмом; 0 - всех, иначе время экстраполируется")
+    asyncio.run(main(parser.parse_args()))
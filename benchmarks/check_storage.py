@@ -0,0 +1,188 @@
+# benchmarks/check_storage.py
+# Проверка общего хранилища на локальной замене Redis (fakeredis, без сервера): взаимное исключение
+# блокировок двух экземпляров RedisStorage, снятие блокировки только владельцем токена, срок жизни
+# set_if_absent, общие сессия и индекс двух X3 на одной заглушке панели и один ключ на tg_id
+# у двух пулов, одновременно выдающих ключ одному пользователю.
+# Нужен пакет fakeredis (в зависимости бота не входит). Код возврата 1, если проверка не прошла.
+# Запуск из корня репозитория: python -m benchmarks.check_storage
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PORT = 18191
+os.environ.update({"HOST": f"http://127.0.0.1:{PORT}", "BASE_PATH": "", "LOGIN": "bench", "PASSWORD": "bench",
+                   "PANELS": ""})
+
+try:
+    import fakeredis
+except ImportError:
+    raise SystemExit("Для проверки установите пакет fakeredis") from None
+
+from loguru import logger
+import storage
+
+server = fakeredis.FakeServer()
+
+
+def make_redis_storage():
+    return storage.RedisStorage(client=fakeredis.aioredis.FakeRedis(server=server, decode_responses=True))
+
+
+# vpn_manager берет хранилище при импорте, поэтому оно подменяется до импорта
+storage.storage = make_redis_storage()
+
+import vpn_manager
+from benchmarks.fake_panel import FakePanel
+
+failures = []
+
+
+def check(name, ok, detail=""):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}" + (f": {detail}" if detail and not ok else ""))
+    if not ok:
+        failures.append(name)
+
+
+# Два экземпляра хранилища (как два процесса бота) по очереди держат одну блокировку
+async def check_mutual_exclusion():
+    first, second = make_redis_storage(), make_redis_storage()
+    holders = []
+    overlaps = []
+
+    async def hold(store, tag):
+        for _ in range(5):
+            async with store.lock("mutex"):
+                holders.append(tag)
+                if len(holders) > 1:
+                    overlaps.append(list(holders))
+                await asyncio.sleep(0.005)
+                holders.remove(tag)
+
+    await asyncio.gather(hold(first, "a"), hold(second, "b"), hold(first, "c"), hold(second, "d"))
+    check("lock: mutual exclusion across two storages", not overlaps, f"overlaps {overlaps[:3]}")
+    await first.close()
+    await second.close()
+
+
+# Блокировка, истекшая у первого владельца и взятая вторым, не снимается первым при выходе
+async def check_token_release():
+    first, second = make_redis_storage(), make_redis_storage()
+    name = f"{first.prefix}lock:token"
+    taken = asyncio.Event()
+    released = asyncio.Event()
+
+    async def slow_owner():
+        async with first.lock("token", ttl=0.05):
+            await asyncio.sleep(0.1)
+            await taken.wait()
+        released.set()
+
+    async def next_owner():
+        await asyncio.sleep(0.06)
+        async with second.lock("token", ttl=5):
+            taken.set()
+            await released.wait()
+            value = await second.redis.get(name)
+            check("lock: expired holder does not release the new holder's lock", value is not None,
+                  "lock key deleted by the previous holder")
+            await first.release(name, "wrong-token")
+            check("lock: release with a wrong token is ignored",
+                  value is not None and await second.redis.get(name) == value)
+        check("lock: owner releases its own lock", await second.redis.get(name) is None)
+
+    await asyncio.gather(slow_owner(), next_owner())
+    await first.close()
+    await second.close()
+
+
+async def check_set_if_absent():
+    store = make_redis_storage()
+    first = await store.set_if_absent("once", "1", ttl=0.1)
+    second = await store.set_if_absent("once", "2", ttl=0.1)
+    check("set_if_absent: second write refused while the key lives", first and not second)
+    await asyncio.sleep(0.15)
+    check("set_if_absent: key can be written again after ttl", await store.set_if_absent("once", "3", ttl=0.1))
+    await store.close()
+
+
+# Два X3 одной панели: второй берет индекс и сессию из хранилища, а не из панели
+async def check_shared_panel_state():
+    panel = FakePanel(200, 100)
+    runner = await panel.start(port=PORT)
+    first = vpn_manager.X3("bench", "bench", f"http://127.0.0.1:{PORT}", base_path="")
+    second = vpn_manager.X3("bench", "bench", f"http://127.0.0.1:{PORT}", base_path="")
+    try:
+        await first.refresh_index()
+        await second.refresh_index()
+        check("x3: second instance adopts session and index snapshot",
+              panel.calls == {"login": 1, "list": 1} and len(second.index.clients) == 200, str(panel.calls))
+
+        # Изменение на первом сбрасывает снимок: второй загружает список заново и видит клиента
+        await first.add_client(30, 555, "bench")
+        second.index.invalidate()
+        await second.refresh_index()
+        check("x3: mutation invalidates the shared snapshot",
+              second.index.get(555) is not None and panel.calls["list"] == 2, str(panel.calls))
+
+        # Панель сбросила сессии: первый входит заново, второй берет его новую сессию
+        panel.sessions = {"expired"}
+        await first.get_inbounds()
+        await second.get_inbounds()
+        check("x3: relogin on one instance is adopted by the other", panel.calls["login"] == 2, str(panel.calls))
+    finally:
+        await first.close()
+        await second.close()
+        await runner.cleanup()
+
+
+def panel_clients(panel, tg_id):
+    return [c for inbound in panel.inbounds.values() for c in inbound["clients"].values() if c["tgId"] == tg_id]
+
+
+# Отдельное имя панели: снимок и сессия предыдущей проверки в хранилище не используются
+def make_pool():
+    return vpn_manager.X3Pool([vpn_manager.X3("bench", "bench", f"http://127.0.0.1:{PORT}", base_path="",
+                                              name="pool")])
+
+
+# Два пула (как два процесса бота) с уже загруженными индексами одновременно выдают ключ одному
+# tg_id: второй под блокировкой пользователя должен увидеть клиента, созданного первым
+async def check_single_key_across_pools():
+    panel = FakePanel(50, 100)
+    runner = await panel.start(port=PORT)
+    first, second = make_pool(), make_pool()
+    try:
+        await first.refresh_index()
+        await second.refresh_index()
+        results = await asyncio.gather(first.add_client_if_absent(30, 777, "bench-777"),
+                                       second.add_client_if_absent(30, 777, "bench-777"))
+        check("pool: one key for a tg_id added from two pools",
+              len(panel_clients(panel, 777)) == 1 and sorted(created for _, created in results) == [False, True],
+              f"{len(panel_clients(panel, 777))} clients, {panel.calls}")
+
+        results = await asyncio.gather(first.add_clients_if_absent([(30, 778, "bench-778")]),
+                                       second.add_clients_if_absent([(30, 778, "bench-778")]))
+        check("pool: one key for a tg_id added in batches from two pools",
+              len(panel_clients(panel, 778)) == 1 and sorted(len(links) for links, _ in results) == [0, 1],
+              f"{len(panel_clients(panel, 778))} clients, {panel.calls}")
+    finally:
+        await first.close()
+        await second.close()
+        await runner.cleanup()
+
+
+async def main():
+    await check_mutual_exclusion()
+    await check_token_release()
+    await check_set_if_absent()
+    await check_shared_panel_state()
+    await check_single_key_across_pools()
+    await storage.storage.close()
+
+
+if __name__ == '__main__':
+    logger.remove()
+    asyncio.run(main())
+    sys.exit(1 if failures else 0)
\ No newline at end of file
@@ -0,0 +1,184 @@
+# benchmarks/fake_panel.py
+# Локальная заглушка панели 3x-ui для замеров без продакшена: /login, inbounds/list, addClient,
+# updateClient, delClient и update инбаунда. Клиенты генерируются синтетически, задержка ответа настраивается,
+# счетчики трафика в clientStats растут с каждым запросом списка.
+# Отдельный запуск: python -m benchmarks.fake_panel --clients 10000 --latency 0.05 --port 2053
+import json
+import time
+import random
+import asyncio
+import argparse
+from aiohttp import web
+
+STREAM_SETTINGS = json.dumps({
+    "network": "tcp",
+    "security": "reality",
+    "realitySettings": {
+        "serverNames": ["bench.example.com"],
+        "shortIds": ["0123abcd"],
+        "settings": {"publicKey": "bench-public-key", "fingerprint": "chrome"}
+    }
+})
+
+
+def make_client(i, now_ms):
+    return {
+        "id": f"00000000-0000-0000-0000-{i:012d}",
+        "email": f"{i}-bench",
+        "tgId": 100000 + i,
+        # Часть клиентов уже истекла, часть попадает в окно напоминания, остальные активны
+        "expiryTime": now_ms + ((i % 100) - 2) * 3600 * 1000,
+        "flow": "xtls-rprx-vision",
+        "limitIp": 3,
+        "totalGB": 0,
+        "enable": True,
+        "subId": ""
+    }
+
+
+class FakePanel:
+    def __init__(self, clients=1000, per_inbound=5000, latency=0.0, jitter=0.0,
+                 login="bench", password="bench"):
+        self.latency = latency
+        self.jitter = jitter
+        self.login = login
+        self.password = password
+        self.sessions = set()
+        # Счетчики запросов по маршрутам
+        self.calls = {}
+        # email -> [up, down]
+        self.traffic = {}
+        now_ms = int(time.time() * 1000)
+        # inbound_id -> {"item": инбаунд без settings, "clients": {client_id: client}}
+        self.inbounds = {}
+        for start in range(0, max(clients, 1), per_inbound):
+            inbound_id = len(self.inbounds) + 1
+            self.inbounds[inbound_id] = {
+                "item": {"id": inbound_id, "port": 443 + inbound_id - 1, "protocol": "vless",
+                         "streamSettings": STREAM_SETTINGS, "enable": True},
+                "clients": {c["id"]: c for c in (make_client(i, now_ms)
+                                                 for i in range(start, min(start + per_inbound, clients)))}
+            }
+
+    async def delay(self, route):
+        self.calls[route] = self.calls.get(route, 0) + 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def authorized(self, request):
+        return request.cookies.get("session") in self.sessions
+
+    # Как 3x-ui новых версий: на API-запрос с просроченной сессией панель отвечает 401
+    @staticmethod
+    def denied():
+        return web.json_response({"success": False, "msg": "The login time limit has expired, please log in again"},
+                                 status=401)
+
+    async def handle_login(self, request):
+        await self.delay("login")
+        data = await request.post()
+        if data.get("username") != self.login or data.get("password") != self.password:
+            return web.json_response({"success": False, "msg": "wrong credentials"})
+        session = f"s{len(self.sessions) + 1}"
+        self.sessions.add(session)
+        response = web.json_response({"success": True})
+        response.set_cookie("session", session)
+        return response
+
+    def client_stats(self, inbound_id, client):
+        counters = self.traffic.setdefault(client["email"], [0, 0])
+        counters[0] += random.randrange(0, 1 << 20)
+        counters[1] += random.randrange(0, 1 << 24)
+        return {"inboundId": inbound_id, "enable": client.get("enable", True), "email": client["email"],
+                "up": counters[0], "down": counters[1], "expiryTime": client.get("expiryTime", 0), "total": 0}
+
+    async def handle_list(self, request):
+        await self.delay("list")
+        if not self.authorized(request):
+            return self.denied()
+        obj = [{**inbound["item"],
+                "settings": json.dumps({"clients": list(inbound["clients"].values()),
+                                        "decryption": "none", "fallbacks": []}),
+                "clientStats": [self.client_stats(inbound_id, client) for client in inbound["clients"].values()]}
+               for inbound_id, inbound in self.inbounds.items()]
+        return web.json_response({"success": True, "obj": obj})
+
+    async def handle_add(self, request):
+        await self.delay("addClient")
+        if not self.authorized(request):
+            return self.denied()
+        data = await request.json()
+        inbound = self.inbounds.get(int(data["id"]))
+        if inbound is None:
+            return web.json_response({"success": False, "msg": "inbound not found"})
+        for client in json.loads(data["settings"])["clients"]:
+            inbound["clients"][client["id"]] = client
+        return web.json_response({"success": True})
+
+    async def handle_update(self, request):
+        await self.delay("updateClient")
+        if not self.authorized(request):
+            return self.denied()
+        data = await request.json()
+        inbound = self.inbounds.get(int(data["id"]))
+        client_id = request.match_info["client_id"]
+        if inbound is None or client_id not in inbound["clients"]:
+            return web.json_response({"success": False, "msg": "client not found"})
+        inbound["clients"][client_id] = json.loads(data["settings"])["clients"][0]
+        return web.json_response({"success": True})
+
+    async def handle_delete(self, request):
+        await self.delay("delClient")
+        if not self.authorized(request):
+            return self.denied()
+        inbound = self.inbounds.get(int(request.match_info["inbound_id"]))
+        if inbound is None or inbound["clients"].pop(request.match_info["client_id"], None) is None:
+            return web.json_response({"success": False, "msg": "client not found"})
+        return web.json_response({"success": True})
+
+    # Обновление инбаунда целиком: список клиентов заменяется переданным в settings
+    async def handle_update_inbound(self, request):
+        await self.delay("update")
+        if not self.authorized(request):
+            return self.denied()
+        data = await request.json()
+        inbound = self.inbounds.get(int(request.match_info["inbound_id"]))
+        if inbound is None:
+            return web.json_response({"success": False, "msg": "inbound not found"})
+        settings = json.loads(data["settings"])
+        # Как и настоящая панель, инбаунд без обязательных полей не сохраняется
+        if settings.get("decryption") != "none" or data.get("port") != inbound["item"]["port"]:
+            return web.json_response({"success": False, "msg": "invalid inbound"})
+        inbound["clients"] = {c["id"]: c for c in settings["clients"]}
+        return web.json_response({"success": True})
+
+    def make_app(self, base_path=""):
+        app = web.Application()
+        app.router.add_post(f"{base_path}/login", self.handle_login)
+        app.router.add_get(f"{base_path}/panel/api/inbounds/list", self.handle_list)
+        app.router.add_post(f"{base_path}/panel/api/inbounds/addClient", self.handle_add)
+        app.router.add_post(f"{base_path}/panel/api/inbounds/updateClient/{{client_id}}", self.handle_update)
+        app.router.add_post(f"{base_path}/panel/api/inbounds/{{inbound_id}}/delClient/{{client_id}}",
+                            self.handle_delete)
+        app.router.add_post(f"{base_path}/panel/api/inbounds/update/{{inbound_id}}", self.handle_update_inbound)
+        return app
+
+    # Запускает панель в текущем event loop; возвращает runner для остановки
+    async def start(self, host="127.0.0.1", port=2053, base_path=""):
+        runner = web.AppRunner(self.make_app(base_path))
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--per-inbound", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка каждого ответа, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, с")
+    parser.add_argument("--port", type=int, default=2053)
+    parser.add_argument("--base-path", default="")
+    args = parser.parse_args()
+    panel = FakePanel(args.clients, args.per_inbound, args.latency, args.jitter)
+    web.run_app(panel.make_app(args.base_path), host="127.0.0.1", port=args.port)
\ No newline at end of file
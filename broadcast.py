@@ -0,0 +1,161 @@
+# broadcast.py
+import os
+import time
+import random
+import asyncio
+from loguru import logger
+from dotenv import load_dotenv
+from aiogram.exceptions import (TelegramRetryAfter,
+                                TelegramForbiddenError,
+                                TelegramBadRequest,
+                                TelegramNetworkError,
+                                TelegramServerError)
+import db
+from metrics import observe_send
+
+load_dotenv()
+
+# Общий лимит Telegram около 30 сообщений в секунду на бота
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 8))
+BROADCAST_QUEUE_SIZE = int(os.getenv("BROADCAST_QUEUE_SIZE", 10000))
+# Сколько пользователей рассылки обрабатывается между сохранениями курсора
+BROADCAST_PAGE = int(os.getenv("BROADCAST_PAGE", 200))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))
+
+
+# Ведро токенов: не больше rate отправок в секунду, всплеск до capacity (по умолчанию без всплесков).
+# pause() останавливает все отправки, когда Telegram ответил RetryAfter
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or 1
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Очередь уведомлений и рассылок с ограничением скорости и фиксированным числом отправителей
+class Broadcaster:
+    def __init__(self, rate=BROADCAST_RATE, workers=BROADCAST_WORKERS, queue_size=BROADCAST_QUEUE_SIZE):
+        self.bot = None
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.queue = asyncio.Queue(queue_size)
+        self.tasks = []
+        self.broadcasts = {}
+
+    def start(self, bot):
+        self.bot = bot
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        # Прерванные рассылки остаются в статусе running и продолжатся при следующем запуске
+        tasks = [*self.tasks, *self.broadcasts.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks = []
+
+    # Отправка одного сообщения с учетом лимита; возвращает True, если сообщение доставлено
+    @observe_send
+    async def send(self, chat_id, text, **kwargs):
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                return True
+            except TelegramRetryAfter as e:
+                logger.warning(f"Telegram просит подождать {e.retry_after} с перед отправкой в {chat_id}")
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                logger.info(f"Пользователь {chat_id} заблокировал бота, сообщение не отправлено")
+                return False
+            except TelegramBadRequest as e:
+                logger.error(f"Сообщение для {chat_id} отклонено: {e}")
+                return False
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logger.warning(f"Ошибка отправки сообщения {chat_id}: {e}")
+                await asyncio.sleep(random.uniform(0, 2 ** attempt))
+        logger.error(f"Не удалось отправить сообщение {chat_id} после {BROADCAST_MAX_RETRIES + 1} попыток")
+        return False
+
+    async def worker(self):
+        while True:
+            chat_id, text, kwargs, future = await self.queue.get()
+            try:
+                result = await self.send(chat_id, text, **kwargs)
+                if future is not None and not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                logger.error(f"Ошибка отправки сообщения {chat_id}: {e}")
+                if future is not None and not future.done():
+                    future.set_result(False)
+            finally:
+                self.queue.task_done()
+
+    # Ставит уведомление в очередь и сразу возвращает управление
+    async def notify(self, chat_id, text, **kwargs):
+        await self.queue.put((chat_id, text, kwargs, None))
+
+    # Ставит сообщение в очередь и ждет результата отправки
+    async def deliver(self, chat_id, text, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((chat_id, text, kwargs, future))
+        return await future
+
+    # Рассылка всем пользователям постранично; курсор сохраняется после каждой страницы
+    async def run_broadcast(self, broadcast_id):
+        broadcast = await db.get_broadcast(broadcast_id)
+        if broadcast is None or broadcast["status"] != "running":
+            return
+        cursor, sent, failed = broadcast["cursor"], broadcast["sent"], broadcast["failed"]
+        logger.info(f"Рассылка {broadcast_id} запущена с пользователя {cursor}")
+        while True:
+            user_ids = await db.get_users_after(cursor, BROADCAST_PAGE)
+            if not user_ids:
+                break
+            results = await asyncio.gather(*(self.deliver(user_id, broadcast["text"]) for user_id in user_ids))
+            sent += sum(results)
+            failed += len(results) - sum(results)
+            cursor = user_ids[-1]
+            await db.update_broadcast(broadcast_id, cursor, sent, failed)
+        await db.update_broadcast(broadcast_id, cursor, sent, failed, status='done')
+        logger.info(f"Рассылка {broadcast_id} завершена: доставлено {sent}, ошибок {failed}")
+
+    def spawn_broadcast(self, broadcast_id):
+        task = asyncio.create_task(self.run_broadcast(broadcast_id))
+        self.broadcasts[broadcast_id] = task
+        task.add_done_callback(lambda _: self.broadcasts.pop(broadcast_id, None))
+        return task
+
+    async def start_broadcast(self, text):
+        broadcast_id = await db.create_broadcast(text)
+        self.spawn_broadcast(broadcast_id)
+        return broadcast_id
+
+    # Продолжает рассылки, прерванные остановкой бота
+    async def resume_broadcasts(self):
+        for broadcast_id in await db.get_unfinished_broadcasts():
+            self.spawn_broadcast(broadcast_id)
+
+
+broadcaster = Broadcaster()
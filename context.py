@@ -0,0 +1,70 @@
+# context.py
+import os
+import functools
+from dotenv import load_dotenv
+from logs import LOG_SINKS, LOG_STDERR_LEVEL, start_logging, stop_logging
+
+load_dotenv()
+
+
+# Контекст приложения: пул панелей 3x-ui, бот Telegram и журналы. Объекты создаются при первом
+# обращении, поэтому импорт модулей бота не открывает файлы журналов и не требует токена и панели
+class AppContext:
+    def __init__(self, log_sinks=LOG_SINKS, stderr_level=LOG_STDERR_LEVEL):
+        self.log_sinks = log_sinks
+        self.stderr_level = stderr_level
+        self.sink_ids = []
+
+    def start_logging(self):
+        if not self.sink_ids:
+            self.sink_ids = start_logging(self.log_sinks, self.stderr_level)
+
+    @functools.cached_property
+    def x3(self):
+        from vpn_manager import make_pool
+        return make_pool()
+
+    @functools.cached_property
+    def bot(self):
+        from aiogram import Bot
+        return Bot(token=os.getenv('TELEGRAM_BOT_TOKEN'))
+
+    # Закрывает только то, что было создано
+    async def close(self):
+        if "x3" in self.__dict__:
+            await self.x3.close()
+        if "bot" in self.__dict__:
+            await self.bot.session.close()
+        if self.sink_ids:
+            stop_logging(self.sink_ids)
+        self.sink_ids = []
+
+
+# Объект, который передает обращения к атрибутам объекту из текущего контекста: модули
+# по-прежнему импортируют x3 и bot, а создаются они при первом использовании
+class Lazy:
+    def __init__(self, resolve):
+        object.__setattr__(self, "_resolve", resolve)
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+
+_context = None
+
+
+# Контекст создается в main(); скрипты и бенчмарки, которые не вызывают main(), получают
+# контекст по умолчанию при первом обращении
+def create_context(**kwargs):
+    global _context
+    _context = AppContext(**kwargs)
+    return _context
+
+
+def current():
+    if _context is None:
+        return create_context()
+    return _context
\ No newline at end of file
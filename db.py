@@ -1,165 +1,595 @@
 # db.py
+import os
+import asyncio
 import aiosqlite
 import logging
 from datetime import datetime, timedelta, timezone
+from metrics import instrument_queries
 
 DB_FILE = 'subscriptions.db'
 
+# Сколько секунд ждать перед коммитом, чтобы объединить параллельные записи в одну транзакцию
+DB_COMMIT_DELAY = float(os.getenv('DB_COMMIT_DELAY', 0.005))
+
+# Общее соединение, открывается один раз в init_db()
+_db = None
+# Соединение с synchronous=FULL для записей, которые должны быть на диске до ответа внешней системе
+_durable_db = None
+_pending_commit = None
+
+
+def get_db():
+    if _db is None:
+        raise RuntimeError("База данных не инициализирована: сначала вызовите init_db()")
+    return _db
+
+
+async def _group_commit():
+    global _pending_commit
+    await asyncio.sleep(DB_COMMIT_DELAY)
+    _pending_commit = None
+    await get_db().commit()
+
+
+# Групповой коммит: все записи, сделанные за DB_COMMIT_DELAY, фиксируются одним fsync.
+# Каждый вызывающий дожидается коммита, в который попала его запись
+async def commit():
+    global _pending_commit
+    if _pending_commit is None:
+        _pending_commit = asyncio.ensure_future(_group_commit())
+    await asyncio.shield(_pending_commit)
+
+
+async def execute_write(query, params=()):
+    await get_db().execute(query, params)
+    await commit()
+
+
+async def execute_many_write(query, params_seq):
+    await get_db().executemany(query, params_seq)
+    await commit()
+
+
+async def fetchone(query, params=()):
+    async with get_db().execute(query, params) as cursor:
+        return await cursor.fetchone()
+
+
+async def fetchall(query, params=()):
+    async with get_db().execute(query, params) as cursor:
+        return await cursor.fetchall()
+
+
 async def init_db():
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                key_id TEXT,
-                access_url TEXT,
-                expires_at TEXT,
-                notified_5_days BOOLEAN DEFAULT 0,
-                notified_1_day BOOLEAN DEFAULT 0,
-                notified_expired BOOLEAN DEFAULT 0
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS test_usage (
-                user_id INTEGER PRIMARY KEY,
-                used_at TEXT
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                first_interaction TEXT
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS purchase_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                amount INTEGER,
-                period INTEGER,
-                action TEXT,
-                purchase_date TEXT,
-                label TEXT,
-                operation_id TEXT
-            )
+    global _db
+    if _db is not None:
+        return
+    # sqlite3 кэширует подготовленные запросы на соединение, поэтому держим одно соединение
+    _db = await aiosqlite.connect(DB_FILE, cached_statements=256)
+    await _db.execute('PRAGMA journal_mode=WAL')
+    await _db.execute('PRAGMA synchronous=NORMAL')
+    await _db.execute('PRAGMA cache_size=-16000')
+    await _db.execute('PRAGMA temp_store=MEMORY')
+    await _db.execute('PRAGMA busy_timeout=5000')
+
+    await _db.execute('''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            key_id TEXT,
+            access_url TEXT,
+            expires_at TEXT,
+            notified_5_days BOOLEAN DEFAULT 0,
+            notified_1_day BOOLEAN DEFAULT 0,
+            notified_expired BOOLEAN DEFAULT 0
+        )
+    ''')
+    await _db.execute('''
+        CREATE TABLE IF NOT EXISTS test_usage (
+            user_id INTEGER PRIMARY KEY,
+            used_at TEXT
+        )
+    ''')
+    await _db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            first_interaction TEXT
+        )
+    ''')
+    await _db.execute('''
+        CREATE TABLE IF NOT EXISTS purchase_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount INTEGER,
+            period INTEGER,
+            action TEXT,
+            purchase_date TEXT,
+            label TEXT,
+            operation_id TEXT
+        )
+    ''')
+
+    await _db.commit()
+    await migrate_db(_db)
+
+    # Общее соединение пишет с synchronous=NORMAL и групповым коммитом: при отключении питания
+    # последние транзакции в WAL могут пропасть. Платежи, после записи которых ЮMoney получает ответ
+    # и уведомление не повторит, пишутся через отдельное соединение, где каждый коммит синхронизирует WAL.
+    # Уровень synchronous нельзя менять внутри транзакции, поэтому это отдельное соединение, а не PRAGMA
+    # вокруг общего коммита
+    global _durable_db
+    _durable_db = await aiosqlite.connect(DB_FILE)
+    await _durable_db.execute('PRAGMA synchronous=FULL')
+    await _durable_db.execute('PRAGMA busy_timeout=5000')
+
+
+# Приводит время к миллисекундам эпохи, как expiryTime в 3x-ui
+def to_epoch_ms(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp() * 1000)
+    if isinstance(value, str):
+        return to_epoch_ms(datetime.fromisoformat(value))
+    return int(value)
+
+
+def from_epoch_ms(value):
+    return datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+
+
+# Миграция 1: subscriptions.expires_at из ISO-строки в целые миллисекунды эпохи
+async def _migration_expires_at_ms(db):
+    async with db.execute('SELECT id, expires_at FROM subscriptions') as cursor:
+        rows = await cursor.fetchall()
+    converted = []
+    for sub_id, expires_at in rows:
+        try:
+            converted.append((sub_id, to_epoch_ms(expires_at)))
+        except (TypeError, ValueError):
+            logging.error(f"Subscription {sub_id}: invalid expires_at {expires_at!r}, reset to 0")
+            converted.append((sub_id, 0))
+
+    await db.execute('ALTER TABLE subscriptions RENAME TO subscriptions_old')
+    await db.execute('''
+        CREATE TABLE subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            key_id TEXT,
+            access_url TEXT,
+            expires_at INTEGER NOT NULL DEFAULT 0,
+            notified_5_days BOOLEAN DEFAULT 0,
+            notified_1_day BOOLEAN DEFAULT 0,
+            notified_expired BOOLEAN DEFAULT 0
+        )
+    ''')
+    await db.execute('''
+        INSERT INTO subscriptions (id, user_id, key_id, access_url, expires_at,
+                                   notified_5_days, notified_1_day, notified_expired)
+        SELECT id, user_id, key_id, access_url, 0, notified_5_days, notified_1_day, notified_expired
+        FROM subscriptions_old
+    ''')
+    await db.executemany('UPDATE subscriptions SET expires_at = ? WHERE id = ?',
+                         [(expires_at, sub_id) for sub_id, expires_at in converted])
+    await db.execute('DROP TABLE subscriptions_old')
+
+
+# Миграция 2: индексы для выборок по пользователю, сроку и дедупликации платежей
+async def _migration_indexes(db):
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_user_id ON subscriptions(user_id)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_expires_at ON subscriptions(expires_at)')
+    # Повторные уведомления могли оставить дубликаты operation_id, оставляем первую запись
+    await db.execute('''
+        DELETE FROM purchase_history
+        WHERE operation_id IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM purchase_history WHERE operation_id IS NOT NULL GROUP BY operation_id
+        )
+    ''')
+    await db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_purchase_history_operation_id
+        ON purchase_history(operation_id)
+    ''')
+
+
+# Миграция 3: subscriptions хранит зеркало клиентов панели (key_id = uuid клиента в 3x-ui).
+# Строки зеркала отличаются заполненным inbound_id, старые записи не затрагиваются
+async def _migration_panel_mirror(db):
+    await db.execute('ALTER TABLE subscriptions ADD COLUMN email TEXT')
+    await db.execute('ALTER TABLE subscriptions ADD COLUMN inbound_id INTEGER')
+    await db.execute('ALTER TABLE subscriptions ADD COLUMN enable BOOLEAN DEFAULT 1')
+    await db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_subscriptions_key_id
+        ON subscriptions(key_id) WHERE inbound_id IS NOT NULL
+    ''')
+
+
+# Миграция 4: рассылки с сохраняемым курсором, чтобы прерванная рассылка продолжилась с места остановки
+async def _migration_broadcasts(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            cursor INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'running',
+            created_at TEXT
+        )
+    ''')
+
+
+# Миграция 5: статус обработки платежа. Уведомление ЮMoney сначала записывается как pending,
+# ключ выдается фоновым обработчиком
+async def _migration_payment_status(db):
+    await db.execute("ALTER TABLE purchase_history ADD COLUMN status TEXT NOT NULL DEFAULT 'done'")
+    await db.execute('ALTER TABLE purchase_history ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+    await db.execute('ALTER TABLE purchase_history ADD COLUMN email TEXT')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_purchase_history_pending
+        ON purchase_history(status) WHERE status = 'pending'
+    ''')
+
+
+# Миграция 6: трафик клиентов. Приросты счетчиков панели суммируются сразу в часовые и суточные
+# корзины (bucket - начало часа или суток в миллисекундах эпохи), последние значения счетчиков
+# хранятся по email, чтобы после перезапуска считать прирост, а не весь накопленный трафик
+async def _migration_traffic(db):
+    for table in ('traffic_hourly', 'traffic_daily'):
+        await db.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                user_id INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                up INTEGER NOT NULL DEFAULT 0,
+                down INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, bucket)
+            ) WITHOUT ROWID
         ''')
+        await db.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_bucket ON {table}(bucket)')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS traffic_counters (
+            email TEXT PRIMARY KEY,
+            up INTEGER NOT NULL,
+            down INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
 
-        await db.commit()
 
-async def save_purchase_history(user_id, amount, period, action, label, operation_id):
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('''
-            INSERT INTO purchase_history (user_id, amount, period, action, label, purchase_date, operation_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, amount, period, action, label, datetime.now(timezone.utc).isoformat(), operation_id))
-        await db.commit()
-    logging.info(f"Purchase history for user {user_id} saved.")
+# Миграция 7: срок окончания, до которого продлевает платеж. Вычисляется один раз при первой
+# попытке, повторы и возобновление после перезапуска применяют тот же срок
+async def _migration_payment_target(db):
+    await db.execute('ALTER TABLE purchase_history ADD COLUMN target_expiry INTEGER')
+
+
+# Миграции применяются по порядку, номер последней хранится в PRAGMA user_version
+MIGRATIONS = [
+    _migration_expires_at_ms,
+    _migration_indexes,
+    _migration_panel_mirror,
+    _migration_broadcasts,
+    _migration_payment_status,
+    _migration_traffic,
+    _migration_payment_target,
+]
+
+
+async def migrate_db(db):
+    async with db.execute('PRAGMA user_version') as cursor:
+        version = (await cursor.fetchone())[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            # sqlite3 не открывает транзакцию перед DDL сам, а миграция должна примениться целиком
+            await db.execute('BEGIN')
+            await migration(db)
+            await db.execute(f'PRAGMA user_version = {number}')
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        logging.info(f"Database migrated to version {number}")
+
+
+async def close_db():
+    global _db
+    if _db is None:
+        return
+    if _pending_commit is not None:
+        await asyncio.shield(_pending_commit)
+    await _db.commit()
+    await _db.close()
+    _db = None
+    global _durable_db
+    if _durable_db is not None:
+        await _durable_db.close()
+        _durable_db = None
+
+
+# Записывает платеж в статусе pending; возвращает False, если operation_id уже был записан.
+# Запись фиксируется на диске до ответа ЮMoney: повторного уведомления не будет
+async def record_payment(user_id, amount, period, action, label, operation_id, email=None):
+    cursor = await _durable_db.execute('''
+        INSERT OR IGNORE INTO purchase_history
+            (user_id, amount, period, action, label, purchase_date, operation_id, email, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'pending')
+    ''', (user_id, amount, period, action, label, datetime.now(timezone.utc).isoformat(), operation_id, email))
+    await _durable_db.commit()
+    return cursor.rowcount == 1
+
+async def get_payment(operation_id):
+    row = await fetchone('''
+        SELECT user_id, amount, period, action, label, operation_id, email, status, attempts, target_expiry
+        FROM purchase_history WHERE operation_id = ?
+    ''', (operation_id,))
+    if row is None:
+        return None
+    return dict(zip(('user_id', 'amount', 'period', 'action', 'label', 'operation_id', 'email',
+                     'status', 'attempts', 'target_expiry'), row))
+
+async def get_pending_payments():
+    rows = await fetchall("SELECT operation_id FROM purchase_history WHERE status = 'pending' ORDER BY id")
+    return [row[0] for row in rows]
+
+# Срок продления фиксируется на диске до запроса к панели, как и сам платеж
+async def set_payment_target(operation_id, target_expiry):
+    await _durable_db.execute('UPDATE purchase_history SET target_expiry = ? WHERE operation_id = ?',
+                              (target_expiry, operation_id))
+    await _durable_db.commit()
+
+async def update_payment_status(operation_id, status, attempts):
+    await execute_write('''
+        UPDATE purchase_history SET status = ?, attempts = ? WHERE operation_id = ?
+    ''', (status, attempts, operation_id))
 
 async def add_user(user_id):
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('''
-            INSERT OR IGNORE INTO users (user_id, first_interaction)
-            VALUES (?, ?)
-        ''', (user_id, datetime.now(timezone.utc).isoformat()))
-        await db.commit()
+    await execute_write('''
+        INSERT OR IGNORE INTO users (user_id, first_interaction)
+        VALUES (?, ?)
+    ''', (user_id, datetime.now(timezone.utc).isoformat()))
+
+async def has_used_test(user_id):
+    row = await fetchone('SELECT COUNT(*) FROM test_usage WHERE user_id = ?', (user_id,))
+    return row[0] > 0
 
 async def save_subscription(user_id, key_data, duration_days):
     expires_at = datetime.now(timezone.utc) + timedelta(days=duration_days)
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('''
-            INSERT INTO subscriptions (user_id, key_id, access_url, expires_at)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, key_data['id'], key_data['accessUrl'], expires_at.isoformat()))
-        await db.commit()
+    await execute_write('''
+        INSERT INTO subscriptions (user_id, key_id, access_url, expires_at)
+        VALUES (?, ?, ?, ?)
+    ''', (user_id, key_data['id'], key_data['accessUrl'], to_epoch_ms(expires_at)))
     logging.info(f"Subscription for user {user_id} saved until {expires_at}")
 
 async def get_subscriptions(user_id):
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('''
-            SELECT id, key_id, access_url, expires_at FROM subscriptions WHERE user_id = ?
-        ''', (user_id,))
-        rows = await cursor.fetchall()
-        subscriptions = []
-        for row in rows:
-            sub_id, key_id, access_url, expires_at_str = row
-            try:
-                expires_at = datetime.fromisoformat(expires_at_str).replace(tzinfo=timezone.utc)
-            except ValueError:
-                expires_at = datetime.now(timezone.utc)
-            subscriptions.append({
-                'id': sub_id,
-                'key_id': key_id,
-                'access_url': access_url,
-                'expires_at': expires_at
-            })
-        return subscriptions
+    rows = await fetchall('''
+        SELECT id, key_id, access_url, expires_at FROM subscriptions WHERE user_id = ?
+    ''', (user_id,))
+    subscriptions = []
+    for row in rows:
+        sub_id, key_id, access_url, expires_at_ms = row
+        subscriptions.append({
+            'id': sub_id,
+            'key_id': key_id,
+            'access_url': access_url,
+            'expires_at': from_epoch_ms(expires_at_ms)
+        })
+    return subscriptions
 
 async def delete_subscription(sub_id, user_id):
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('''
-            DELETE FROM subscriptions WHERE id = ?
-        ''', (sub_id,))
-        await db.commit()
+    await execute_write('''
+        DELETE FROM subscriptions WHERE id = ?
+    ''', (sub_id,))
     logging.info(f"Subscription {sub_id} for user {user_id} deleted")
 
 async def extend_subscription(user_id, sub_id, additional_days):
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('''
-            SELECT expires_at FROM subscriptions
-            WHERE id = ? AND user_id = ? LIMIT 1
-        ''', (sub_id, user_id))
-        row = await cursor.fetchone()
-        if row:
-            current_expires_at_str = row[0]
-            current_expires_at = datetime.fromisoformat(current_expires_at_str).replace(tzinfo=timezone.utc)
-            if current_expires_at > datetime.now(timezone.utc):
-                new_expires_at = current_expires_at + timedelta(days=additional_days)
-            else:
-                new_expires_at = datetime.now(timezone.utc) + timedelta(days=additional_days)
-            await db.execute('''
-                UPDATE subscriptions SET expires_at = ?
-                WHERE id = ? AND user_id = ?
-            ''', (new_expires_at.isoformat(), sub_id, user_id))
-            await db.commit()
-            logging.info(f"Subscription {sub_id} for user {user_id} extended until {new_expires_at}")
+    row = await fetchone('''
+        SELECT expires_at FROM subscriptions
+        WHERE id = ? AND user_id = ? LIMIT 1
+    ''', (sub_id, user_id))
+    if row:
+        current_expires_at = from_epoch_ms(row[0])
+        if current_expires_at > datetime.now(timezone.utc):
+            new_expires_at = current_expires_at + timedelta(days=additional_days)
         else:
-            logging.error(f"Subscription {sub_id} for user {user_id} not found")
+            new_expires_at = datetime.now(timezone.utc) + timedelta(days=additional_days)
+        await execute_write('''
+            UPDATE subscriptions SET expires_at = ?
+            WHERE id = ? AND user_id = ?
+        ''', (to_epoch_ms(new_expires_at), sub_id, user_id))
+        logging.info(f"Subscription {sub_id} for user {user_id} extended until {new_expires_at}")
+    else:
+        logging.error(f"Subscription {sub_id} for user {user_id} not found")
 
 async def get_all_subscriptions():
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('SELECT id, user_id, key_id, access_url, expires_at FROM subscriptions')
-        rows = await cursor.fetchall()
-        subscriptions = []
-        for row in rows:
-            sub_id, user_id, key_id, access_url, expires_at_str = row
-            expires_at = datetime.fromisoformat(expires_at_str).replace(tzinfo=timezone.utc)
-            subscriptions.append({
-                'id': sub_id,
-                'user_id': user_id,
-                'key_id': key_id,
-                'access_url': access_url,
-                'expires_at': expires_at
-            })
-        return subscriptions
+    rows = await fetchall('SELECT id, user_id, key_id, access_url, expires_at FROM subscriptions')
+    subscriptions = []
+    for row in rows:
+        sub_id, user_id, key_id, access_url, expires_at_ms = row
+        subscriptions.append({
+            'id': sub_id,
+            'user_id': user_id,
+            'key_id': key_id,
+            'access_url': access_url,
+            'expires_at': from_epoch_ms(expires_at_ms)
+        })
+    return subscriptions
+
+# Подписки, истекающие в диапазоне [start, end), выборка идет по индексу expires_at
+async def get_expiring_subscriptions(start, end):
+    rows = await fetchall('''
+        SELECT id, user_id, key_id, access_url, expires_at FROM subscriptions
+        WHERE expires_at >= ? AND expires_at < ?
+        ORDER BY expires_at
+    ''', (to_epoch_ms(start), to_epoch_ms(end)))
+    return [{
+        'id': sub_id,
+        'user_id': user_id,
+        'key_id': key_id,
+        'access_url': access_url,
+        'expires_at': from_epoch_ms(expires_at_ms)
+    } for sub_id, user_id, key_id, access_url, expires_at_ms in rows]
 
 async def get_all_users():
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('SELECT user_id FROM users')
-        users = await cursor.fetchall()
-        return [{'user_id': row[0]} for row in users]
+    users = await fetchall('SELECT user_id FROM users')
+    return [{'user_id': row[0]} for row in users]
+
+# Страница пользователей после user_id, выборка по первичному ключу
+async def get_users_after(user_id, limit):
+    rows = await fetchall('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', (user_id, limit))
+    return [row[0] for row in rows]
+
+SUBSCRIPTION_COLUMNS = ('id', 'user_id', 'key_id', 'access_url', 'expires_at', 'email', 'inbound_id', 'enable')
+
+# Страница подписок для админки; after - ключ сортировки последней строки прошлой страницы.
+# Без фильтра по сроку сортировка по id (новые первыми), с фильтром - по (expires_at, id):
+# выборка идет по индексу и не зависит от числа подписок
+async def get_subscriptions_page(limit, after=None, user_id=None, status=None, now_ms=0):
+    conditions, params = [], []
+    if user_id is not None:
+        conditions.append('user_id = ?')
+        params.append(user_id)
+    if status == 'active':
+        conditions.append('expires_at >= ?')
+        params.append(now_ms)
+        order, op = 'expires_at, id', '>'
+    elif status == 'expired':
+        conditions.append('expires_at < ?')
+        params.append(now_ms)
+        order, op = 'expires_at DESC, id DESC', '<'
+    else:
+        order, op = 'id DESC', '<'
+    if after is not None:
+        if status in ('active', 'expired'):
+            conditions.append(f'(expires_at, id) {op} (?, ?)')
+            params.extend(after)
+        else:
+            conditions.append('id < ?')
+            params.append(after)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    rows = await fetchall(f'''
+        SELECT {', '.join(SUBSCRIPTION_COLUMNS)} FROM subscriptions {where} ORDER BY {order} LIMIT ?
+    ''', (*params, limit))
+    return [dict(zip(SUBSCRIPTION_COLUMNS, row)) for row in rows]
+
+async def get_subscription(sub_id):
+    row = await fetchone(f'''
+        SELECT {', '.join(SUBSCRIPTION_COLUMNS)} FROM subscriptions WHERE id = ?
+    ''', (sub_id,))
+    return dict(zip(SUBSCRIPTION_COLUMNS, row)) if row else None
 
 async def update_subscription_async(sub_id, new_expires_at):
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('UPDATE subscriptions SET expires_at = ? WHERE id = ?', (new_expires_at, sub_id))
-        await db.commit()
+    await execute_write('UPDATE subscriptions SET expires_at = ? WHERE id = ?', (to_epoch_ms(new_expires_at), sub_id))
 
 async def get_subscription_expiry_async(sub_id):
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('SELECT expires_at FROM subscriptions WHERE id = ?', (sub_id,))
-        row = await cursor.fetchone()
-        return row[0] if row else None
+    row = await fetchone('SELECT expires_at FROM subscriptions WHERE id = ?', (sub_id,))
+    return from_epoch_ms(row[0]) if row else None
 
 async def delete_subscription_async(sub_id):
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('DELETE FROM subscriptions WHERE id = ?', (sub_id,))
-        await db.commit()
+    await execute_write('DELETE FROM subscriptions WHERE id = ?', (sub_id,))
+
+# Зеркало клиентов панели: key_id -> (user_id, email, inbound_id, expires_at, enable, access_url)
+async def get_mirrored_clients():
+    rows = await fetchall('''
+        SELECT key_id, user_id, email, inbound_id, expires_at, enable, access_url
+        FROM subscriptions WHERE inbound_id IS NOT NULL
+    ''')
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+async def upsert_mirrored_clients(rows):
+    await execute_many_write('''
+        INSERT INTO subscriptions (key_id, user_id, email, inbound_id, expires_at, enable, access_url)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(key_id) WHERE inbound_id IS NOT NULL DO UPDATE SET
+            user_id = excluded.user_id,
+            email = excluded.email,
+            inbound_id = excluded.inbound_id,
+            expires_at = excluded.expires_at,
+            enable = excluded.enable,
+            access_url = excluded.access_url
+    ''', [(key_id, *row) for key_id, row in rows])
+
+async def delete_mirrored_clients(key_ids):
+    await execute_many_write('''
+        DELETE FROM subscriptions WHERE key_id = ? AND inbound_id IS NOT NULL
+    ''', [(key_id,) for key_id in key_ids])
+
+async def get_mirrored_client(user_id):
+    return await fetchone('''
+        SELECT key_id, user_id, email, inbound_id, expires_at, enable, access_url
+        FROM subscriptions WHERE user_id = ? AND inbound_id IS NOT NULL LIMIT 1
+    ''', (user_id,))
+
+async def get_mirrored_expiring(start_ms, end_ms):
+    return await fetchall('''
+        SELECT user_id, expires_at FROM subscriptions
+        WHERE inbound_id IS NOT NULL AND expires_at > 0 AND expires_at >= ? AND expires_at < ?
+    ''', (start_ms, end_ms))
+
+async def create_broadcast(text):
+    db = get_db()
+    cursor = await db.execute('''
+        INSERT INTO broadcasts (text, created_at) VALUES (?, ?)
+    ''', (text, datetime.now(timezone.utc).isoformat()))
+    await commit()
+    return cursor.lastrowid
+
+async def get_broadcast(broadcast_id):
+    row = await fetchone('''
+        SELECT id, text, cursor, sent, failed, status FROM broadcasts WHERE id = ?
+    ''', (broadcast_id,))
+    if row is None:
+        return None
+    return dict(zip(('id', 'text', 'cursor', 'sent', 'failed', 'status'), row))
+
+async def get_unfinished_broadcasts():
+    rows = await fetchall("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+    return [row[0] for row in rows]
+
+async def update_broadcast(broadcast_id, cursor, sent, failed, status='running'):
+    await execute_write('''
+        UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, status = ? WHERE id = ?
+    ''', (cursor, sent, failed, status, broadcast_id))
+
+
+
+async def get_traffic_counters():
+    rows = await fetchall('SELECT email, up, down FROM traffic_counters')
+    return {email: (up, down) for email, up, down in rows}
+
+# Один проход сборщика трафика одной транзакцией: приросты в часовые и суточные корзины,
+# новые значения счетчиков и удаление счетчиков пропавших клиентов.
+# samples: [(user_id, hour_bucket, day_bucket, up, down)]
+async def save_traffic(samples, counters, removed):
+    db = get_db()
+    for table, position in (('traffic_hourly', 1), ('traffic_daily', 2)):
+        await db.executemany(f'''
+            INSERT INTO {table} (user_id, bucket, up, down) VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, bucket) DO UPDATE SET up = up + excluded.up, down = down + excluded.down
+        ''', [(sample[0], sample[position], sample[3], sample[4]) for sample in samples])
+    await db.executemany('''
+        INSERT INTO traffic_counters (email, up, down) VALUES (?, ?, ?)
+        ON CONFLICT(email) DO UPDATE SET up = excluded.up, down = excluded.down
+    ''', counters)
+    await db.executemany('DELETE FROM traffic_counters WHERE email = ?', [(email,) for email in removed])
+    await commit()
+
+async def prune_traffic(hourly_before_ms, daily_before_ms):
+    db = get_db()
+    await db.execute('DELETE FROM traffic_hourly WHERE bucket < ?', (hourly_before_ms,))
+    await db.execute('DELETE FROM traffic_daily WHERE bucket < ?', (daily_before_ms,))
+    await commit()
+
+# Суммарный трафик пользователя (up, down) с since_ms; table - traffic_hourly или traffic_daily
+async def get_user_traffic(user_id, since_ms, table='traffic_daily'):
+    row = await fetchone(f'''
+        SELECT COALESCE(SUM(up), 0), COALESCE(SUM(down), 0) FROM {table} WHERE user_id = ? AND bucket >= ?
+    ''', (user_id, since_ms))
+    return row[0], row[1]
+
+# Пользователи с наибольшим трафиком с since_ms: [(user_id, up, down)]
+async def get_traffic_top(since_ms, limit):
+    return await fetchall('''
+        SELECT user_id, SUM(up), SUM(down) FROM traffic_daily WHERE bucket >= ?
+        GROUP BY user_id ORDER BY SUM(up) + SUM(down) DESC LIMIT ?
+    ''', (since_ms, limit))
+
+# Время каждой функции запроса попадает в метрику db_query_seconds{query="имя функции"}
+instrument_queries(globals(), exclude=('commit', 'execute_write', 'execute_many_write', 'fetchone', 'fetchall',
+                                       'init_db', 'migrate_db', 'close_db'))
\ No newline at end of file
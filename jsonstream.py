@@ -0,0 +1,105 @@
+# jsonstream.py
+import json
+import codecs
+
+WHITESPACE = " \t\n\r"
+# Сколько байт читать за раз из тела ответа
+CHUNK_SIZE = 65536
+
+decoder = json.JSONDecoder()
+
+
+# Потоковый разбор JSON-объекта верхнего уровня: массив под ключом stream_key разбирается по одному
+# элементу, и каждый элемент сразу передается в item_hook. В памяти одновременно находятся только
+# текущий элемент и непрочитанный остаток тела, а не весь ответ целиком
+class StreamReader:
+    def __init__(self, chunks):
+        self.chunks = chunks.__aiter__()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+
+    # Дочитывает тело, пока в буфере не окажется хотя бы size непрочитанных символов
+    async def fill(self, size=1):
+        parts = [self.buffer[self.pos:]]
+        available = len(parts[0])
+        while available < size and not self.eof:
+            try:
+                chunk = await self.chunks.__anext__()
+            except StopAsyncIteration:
+                self.eof = True
+                # final=True: обрезанный многобайтовый символ в конце ответа дает ошибку
+                text = self.utf8.decode(b"", final=True)
+            else:
+                # Многобайтовый символ может оказаться на границе чанков, декодер дождется его конца
+                text = self.utf8.decode(chunk)
+            parts.append(text)
+            available += len(text)
+        self.buffer = "".join(parts)
+        self.pos = 0
+
+    async def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                raise json.JSONDecodeError("Неожиданный конец ответа", self.buffer, self.pos)
+            await self.fill()
+
+    async def expect(self, char):
+        if await self.peek() != char:
+            raise json.JSONDecodeError(f"Ожидался символ {char!r}", self.buffer, self.pos)
+        self.pos += 1
+
+    async def value(self):
+        await self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                # Число в конце буфера могло оборваться на середине
+                if (end < len(self.buffer) or self.eof or isinstance(value, bool)
+                        or not isinstance(value, (int, float))):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Буфер растет геометрически, поэтому повторные попытки разбора длинного элемента
+            # в сумме стоят не больше трети от одного полного разбора
+            await self.fill(4 * (len(self.buffer) - self.pos) + CHUNK_SIZE)
+
+    async def load(self, stream_key, item_hook):
+        result = {}
+        await self.expect("{")
+        if await self.peek() == "}":
+            self.pos += 1
+            return result
+        while True:
+            key = await self.value()
+            await self.expect(":")
+            if key == stream_key and await self.peek() == "[":
+                self.pos += 1
+                items = []
+                if await self.peek() == "]":
+                    self.pos += 1
+                else:
+                    while True:
+                        items.append(item_hook(await self.value()))
+                        if await self.peek() == "]":
+                            self.pos += 1
+                            break
+                        await self.expect(",")
+                result[key] = items
+            else:
+                result[key] = await self.value()
+            if await self.peek() == "}":
+                self.pos += 1
+                return result
+            await self.expect(",")
+
+
+async def load_stream(chunks, stream_key, item_hook):
+    return await StreamReader(chunks).load(stream_key, item_hook)
\ No newline at end of file
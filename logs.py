@@ -0,0 +1,161 @@
+# logs.py
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import traceback
+from loguru import logger
+from dotenv import load_dotenv
+from metrics import LOG_SUPPRESSED
+
+load_dotenv()
+
+# Файлы журналов (путь, уровень); открываются при запуске приложения, а не при импорте модулей
+LOG_SINKS = [
+    ("logs_bot.log", "DEBUG"),
+    ("logs_manager.log", "DEBUG"),
+    ("logs_payments.log", "DEBUG"),
+    ("logs_tasks.log", "INFO"),
+]
+# json - по объекту JSON на строку, text - прежний текстовый формат
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_STDERR_LEVEL = os.getenv("LOG_STDERR_LEVEL", "DEBUG")
+# С одного места вызова проходит не больше LOG_SAMPLE_BURST записей ниже WARNING за LOG_SAMPLE_WINDOW секунд;
+# 0 отключает ограничение. Предупреждения и ошибки не ограничиваются
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", "20"))
+LOG_SAMPLE_WINDOW = float(os.getenv("LOG_SAMPLE_WINDOW", "1"))
+
+
+# Ограничение частоты по месту вызова (файл и строка). Работает как patcher loguru: решение принимается
+# один раз на запись, до всех sink'ов. Отброшенные записи помечаются в extra и не доходят до sink'ов,
+# а первая прошедшая запись следующего окна несет extra["suppressed"] - сколько было отброшено
+class CallSiteSampler:
+    def __init__(self, burst=LOG_SAMPLE_BURST, window=LOG_SAMPLE_WINDOW, below="WARNING"):
+        self.burst = burst
+        self.window = window
+        self.below = logger.level(below).no
+        self.sites = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        if self.burst <= 0 or record["level"].no >= self.below:
+            return
+        site = (record["file"].path, record["line"])
+        now = time.monotonic()
+        with self.lock:
+            state = self.sites.get(site)
+            if state is None:
+                state = self.sites[site] = [now, 0, 0]
+            elif now - state[0] >= self.window:
+                if state[2]:
+                    record["extra"]["suppressed"] = state[2]
+                state[:] = [now, 0, 0]
+            if state[1] < self.burst:
+                state[1] += 1
+                return
+            state[2] += 1
+        record["extra"]["sampled_out"] = True
+        LOG_SUPPRESSED.labels(record["name"]).inc()
+
+
+# Sink для loguru: вызывающий поток только кладет готовую строку в очередь, запись и flush делает
+# отдельный поток пачками. enqueue=True в loguru для этого не подходит: он передает записи через
+# multiprocessing-очередь с pickle, и под нагрузкой это медленнее синхронной записи в файл
+class QueuedWriter:
+    def __init__(self, stream, owned=False):
+        self.stream = stream
+        self.owned = owned
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, message):
+        self.queue.put(message)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopped = None in batch
+            self.stream.write("".join(message for message in batch if message is not None))
+            self.stream.flush()
+            if stopped:
+                break
+
+    # Вызывается loguru при удалении sink'а: дописывает очередь и закрывает файл
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.owned:
+            self.stream.close()
+
+
+def keep(record):
+    return "sampled_out" not in record["extra"]
+
+
+# Компактная JSON-строка записи. Собирается один раз на запись в patcher и подставляется во все файлы
+# через json_format; serialize=True в loguru сериализует запись целиком отдельно для каждого sink'а
+def to_json(record):
+    data = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "module": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+        "message": record["message"],
+    }
+    extra = {key: value for key, value in record["extra"].items() if key != "json"}
+    if extra:
+        data["extra"] = extra
+    if record["exception"]:
+        data["exception"] = "".join(traceback.format_exception(*record["exception"]))
+    return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def json_format(record):
+    return "{extra[json]}\n"
+
+
+sampler = CallSiteSampler()
+
+
+def patch(record):
+    sampler(record)
+    if LOG_FORMAT == "json" and keep(record):
+        record["extra"]["json"] = to_json(record)
+
+
+# Запись в файлы и stderr идет в потоках QueuedWriter, цикл событий только кладет строку в очередь.
+# stderr_level=None - без вывода в консоль. Возвращает идентификаторы sink'ов для stop_logging
+def start_logging(sinks=LOG_SINKS, stderr_level=LOG_STDERR_LEVEL):
+    logger.configure(patcher=patch)
+    # stderr по умолчанию пишет синхронно; заменяется таким же, но через очередь
+    try:
+        logger.remove(0)
+    except ValueError:
+        pass
+    # Для text остается формат loguru по умолчанию
+    file_options = {"format": json_format} if LOG_FORMAT == "json" else {}
+    sink_ids = []
+    if stderr_level:
+        sink_ids.append(logger.add(QueuedWriter(sys.stderr), level=stderr_level, filter=keep))
+    for path, level in sinks:
+        # Файлы журналов перезаписываются при каждом запуске, как и раньше
+        stream = open(path, 'w', encoding='utf-8')
+        sink_ids.append(logger.add(QueuedWriter(stream, owned=True), level=level, filter=keep,
+                                   **file_options))
+    return sink_ids
+
+
+# Удаление sink'а дожидается записи всего, что уже стоит в его очереди (QueuedWriter.stop)
+def stop_logging(sink_ids):
+    for sink_id in sink_ids:
+        logger.remove(sink_id)
+    logger.configure(patcher=None)
\ No newline at end of file
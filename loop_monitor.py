@@ -0,0 +1,177 @@
+# loop_monitor.py
+import os
+import sys
+import time
+import asyncio
+import functools
+import importlib
+import threading
+import traceback
+from loguru import logger
+from dotenv import load_dotenv
+from metrics import LOOP_LAG_SECONDS, LOOP_BLOCKS, LOOP_BLOCKED_SECONDS, SYNC_CALLS
+
+load_dotenv()
+
+LOOP_MONITOR = os.getenv("LOOP_MONITOR", "1") == "1"
+# Период проверки цикла событий и задержка, начиная с которой он считается заблокированным, с
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.05"))
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.1"))
+# Режим отладки: известные синхронные вызовы в потоке цикла событий записываются в журнал с местом вызова
+LOOP_MONITOR_DEBUG = os.getenv("LOOP_MONITOR_DEBUG", "0") == "1"
+# Модуль и путь к атрибуту; отсутствующие модули (requests не в зависимостях) пропускаются
+SYNC_CALLS_TO_FLAG = [
+    ("requests", "Session.request"),
+    ("time", "sleep"),
+    ("socket", "create_connection"),
+    ("subprocess", "run"),
+]
+STACK_LIMIT = 15
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Декораторы метрик и сам монитор прозрачны: не считаются ни виновником, ни обработчиком
+WRAPPER_MODULES = {"metrics", "loop_monitor", "logs"}
+
+
+def frame_kind(frame):
+    path = frame.f_code.co_filename
+    if not path.startswith(ROOT) or "site-packages" in path:
+        return "library"
+    if frame.f_globals.get("__name__") in WRAPPER_MODULES:
+        return "wrapper"
+    return "own"
+
+
+def describe(frame):
+    return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}"
+
+
+# Разбор стека потока цикла событий. call - самый внутренний кадр (например, socket внутри requests),
+# function - самый внутренний кадр кода бота, handler - внешний кадр той же непрерывной цепочки кода
+# бота: обработчик aiogram, маршрут aiohttp или фоновая задача
+def analyze(frame):
+    # Обертка режима отладки сама не является вызовом
+    while frame.f_back is not None and frame_kind(frame) == "wrapper":
+        frame = frame.f_back
+    report = {"call": f"{describe(frame)}:{frame.f_lineno}", "function": "-", "location": "-", "handler": "-",
+              "stack": "".join(traceback.format_stack(frame, limit=STACK_LIMIT))}
+    found = False
+    while frame is not None:
+        kind = frame_kind(frame)
+        if kind == "own":
+            if not found:
+                found = True
+                report["function"] = describe(frame)
+                report["location"] = f"{os.path.relpath(frame.f_code.co_filename, ROOT)}:{frame.f_lineno}"
+            report["handler"] = describe(frame)
+        elif kind == "library" and found:
+            break
+        frame = frame.f_back
+    return report
+
+
+# Сторож цикла событий. Задача в цикле раз в interval отмечает heartbeat и меряет, насколько позже
+# срока она проснулась (loop_lag_seconds). Поток-наблюдатель, увидев, что heartbeat не обновлялся
+# дольше threshold, снимает стек потока цикла; когда цикл освобождается, задача пишет блокировку
+# в журнал и в метрики по этому снимку
+class LoopMonitor:
+    def __init__(self, interval=LOOP_MONITOR_INTERVAL, threshold=LOOP_BLOCK_THRESHOLD, debug=LOOP_MONITOR_DEBUG):
+        self.interval = interval
+        self.threshold = threshold
+        self.debug = debug
+        self.heartbeat = 0.0
+        self.sample = None
+        self.loop_thread_id = None
+        self.task = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.patched = []
+
+    def start(self):
+        if self.task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopped.clear()
+        self.task = asyncio.create_task(self.tick())
+        self.thread = threading.Thread(target=self.watch, name="loop-monitor", daemon=True)
+        self.thread.start()
+        if self.debug:
+            self.patch_sync_calls()
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.unpatch_sync_calls()
+        self.stopped.set()
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.thread.join()
+        self.task = self.thread = None
+
+    async def tick(self):
+        while True:
+            started = self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - started - self.interval, 0.0)
+            LOOP_LAG_SECONDS.observe(lag)
+            if lag >= self.threshold:
+                self.report(started, lag)
+
+    # Поток-наблюдатель: один снимок стека на каждую блокировку
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            heartbeat = self.heartbeat
+            if time.monotonic() - heartbeat < self.interval + self.threshold:
+                continue
+            if self.sample is not None and self.sample[0] == heartbeat:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                self.sample = (heartbeat, analyze(frame))
+
+    def report(self, heartbeat, lag):
+        if self.sample is not None and self.sample[0] == heartbeat:
+            report = self.sample[1]
+        else:
+            # Блокировка закончилась раньше, чем наблюдатель успел снять стек
+            report = {"call": "-", "function": "-", "location": "-", "handler": "-", "stack": ""}
+        LOOP_BLOCKS.labels(report["function"], report["handler"]).inc()
+        LOOP_BLOCKED_SECONDS.labels(report["function"], report["handler"]).inc(lag)
+        logger.warning(f"Цикл событий заблокирован на {lag * 1000:.0f} мс: {report['function']} "
+                       f"({report['location']}), обработчик {report['handler']}, вызов {report['call']}\n"
+                       f"{report['stack']}")
+
+    # Отладка: обертки над известными синхронными вызовами, срабатывающие только в потоке цикла
+    # событий; вызовы из asyncio.to_thread и других потоков не отмечаются
+    def patch_sync_calls(self):
+        for module_name, path in SYNC_CALLS_TO_FLAG:
+            try:
+                owner = importlib.import_module(module_name)
+            except ImportError:
+                continue
+            *owner_path, attribute = path.split(".")
+            for name in owner_path:
+                owner = getattr(owner, name)
+            original = getattr(owner, attribute)
+            setattr(owner, attribute, self.flagged(f"{module_name}.{path}", original))
+            self.patched.append((owner, attribute, original))
+
+    def unpatch_sync_calls(self):
+        for owner, attribute, original in reversed(self.patched):
+            setattr(owner, attribute, original)
+        self.patched = []
+
+    def flagged(self, name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if threading.get_ident() == self.loop_thread_id:
+                report = analyze(sys._getframe(1))
+                SYNC_CALLS.labels(name, report["function"]).inc()
+                logger.warning(f"Синхронный вызов {name} в цикле событий: {report['function']} "
+                               f"({report['location']}), обработчик {report['handler']}\n{report['stack']}")
+            return func(*args, **kwargs)
+        return wrapper
+
+
+loop_monitor = LoopMonitor()
\ No newline at end of file
@@ -1,26 +1,77 @@
 # main.py
+import os
 import asyncio
 from aiohttp import web
-from db import init_db
-from telegram_bot import bot, dp
-from payments import yoomoney_notification
+from db import init_db, close_db
+from telegram_bot import dp
+from payments import yoomoney_notification, payment_processor
 from tasks import check_subscribes_expirity
+from sync import mirror
+from broadcast import broadcaster
+from metrics import metrics_handler
+from traffic import traffic_collector
+from storage import storage
+from telegram_webhook import update_queue, TELEGRAM_WEBHOOK_URL, TELEGRAM_WEBHOOK_PATH
+from admin import setup_admin, ADMIN_PASSWORD
+from context import create_context
+from loop_monitor import loop_monitor, LOOP_MONITOR
+
+# Фоновые задачи (зеркало, проверка подписок, сбор трафика, рассылки и платежи) запускаются
+# на одном экземпляре; остальные экземпляры с BACKGROUND_JOBS=0 только обрабатывают обновления
+BACKGROUND_JOBS = os.getenv("BACKGROUND_JOBS", "1") == "1"
 
 
 app = web.Application()
 app.router.add_post('/yoomoney_notification', yoomoney_notification)
+app.router.add_get('/metrics', metrics_handler)
+# В режиме webhook обновления Telegram приходят на тот же сервер, что и уведомления ЮMoney
+if TELEGRAM_WEBHOOK_URL:
+    app.router.add_post(TELEGRAM_WEBHOOK_PATH, update_queue.handle)
+# Админка под /admin, только если задан пароль
+if ADMIN_PASSWORD:
+    setup_admin(app)
 
 
 async def main():
+    # Контекст приложения: журналы открываются здесь, панели и бот создаются при первом обращении
+    context = create_context()
+    context.start_logging()
+    if LOOP_MONITOR:
+        loop_monitor.start()
+    bot = context.bot
     await init_db()
-    asyncio.create_task(check_subscribes_expirity())
+    broadcaster.start(bot)
+    payment_processor.start()
+    if BACKGROUND_JOBS:
+        await broadcaster.resume_broadcasts()
+        await payment_processor.resume()
+        asyncio.create_task(mirror.run())
+        asyncio.create_task(check_subscribes_expirity())
+        asyncio.create_task(traffic_collector.run())
     runner = web.AppRunner(app)
     await runner.setup()
 
     site = web.TCPSite(runner, '127.0.0.1', 8080)
     await site.start()
 
-    await dp.start_polling(bot)
+    try:
+        if TELEGRAM_WEBHOOK_URL:
+            update_queue.start(bot, dp)
+            await update_queue.set_webhook()
+            await asyncio.Event().wait()
+        else:
+            # Пока установлен webhook, getUpdates недоступен
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await runner.cleanup()
+        await loop_monitor.stop()
+        await update_queue.stop()
+        await payment_processor.stop()
+        await broadcaster.stop()
+        await context.close()
+        await close_db()
+        await storage.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,120 @@
+# metrics.py
+import time
+import inspect
+import functools
+from aiohttp import web
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+PANEL_SECONDS = Histogram("x3_panel_seconds", "Время обращения к панели 3x-ui по методам X3",
+                          ["method", "node"])
+PANEL_ERRORS = Counter("x3_panel_errors_total", "Исключения в методах X3", ["method", "node"])
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработчиков aiogram", ["handler", "outcome"])
+EXPIRY_SWEEP_SECONDS = Histogram("expiry_sweep_seconds", "Длительность прохода проверки подписок",
+                                 buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+EXPIRY_CLIENTS = Gauge("expiry_clients", "Клиентов в индексе панелей при проверке подписок")
+EXPIRY_SCHEDULED = Gauge("expiry_scheduled_events", "Событий в планировщике окончания подписок")
+EXPIRY_EVENTS = Counter("expiry_events_total", "Обработанные события окончания подписок", ["event"])
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Время функций запросов к базе", ["query"],
+                             buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1))
+WEBHOOK_SECONDS = Histogram("webhook_seconds", "Время обработки уведомлений ЮMoney")
+WEBHOOK_OUTCOMES = Counter("webhook_outcomes_total", "Результаты уведомлений ЮMoney", ["outcome"])
+TRAFFIC_COLLECT_SECONDS = Histogram("traffic_collect_seconds", "Длительность прохода сборщика трафика",
+                                    buckets=(0.05, 0.1, 0.5, 1, 5, 10, 30, 60))
+TELEGRAM_SENDS = Counter("telegram_sends_total", "Отправки сообщений через очередь", ["outcome"])
+TELEGRAM_UPDATES = Counter("telegram_updates_total", "Обновления Telegram, полученные через webhook", ["outcome"])
+TELEGRAM_UPDATE_QUEUE = Gauge("telegram_update_queue", "Обновлений Telegram в очереди обработки")
+LOG_SUPPRESSED = Counter("log_suppressed_total", "Записи журнала, отброшенные ограничением по месту вызова",
+                         ["module"])
+LOOP_LAG_SECONDS = Histogram("loop_lag_seconds", "Опоздание тика сторожа цикла событий",
+                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+LOOP_BLOCKS = Counter("loop_blocks_total", "Блокировки цикла событий дольше порога", ["function", "handler"])
+LOOP_BLOCKED_SECONDS = Counter("loop_blocked_seconds_total", "Суммарное время блокировок цикла событий",
+                               ["function", "handler"])
+SYNC_CALLS = Counter("loop_sync_calls_total", "Синхронные вызовы в потоке цикла событий (режим отладки)",
+                     ["call", "function"])
+
+
+# Декоратор для корутин: время каждого вызова в histogram с фиксированными метками
+def timed(histogram, **labels):
+    def decorator(func):
+        metric = histogram.labels(**labels) if labels else histogram
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with metric.time():
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Декоратор методов X3 и X3Pool: время запроса к панели с меткой имени метода и панели
+def observe_panel(func):
+    method = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        node = getattr(self, "name", None) or "pool"
+        started = time.perf_counter()
+        try:
+            return await func(self, *args, **kwargs)
+        except Exception:
+            PANEL_ERRORS.labels(method, node).inc()
+            raise
+        finally:
+            PANEL_SECONDS.labels(method, node).observe(time.perf_counter() - started)
+    return wrapper
+
+
+# Оборачивает все публичные корутины модуля (кроме exclude) в db_query_seconds{query=имя}
+def instrument_queries(namespace, exclude=()):
+    module = namespace["__name__"]
+    for name, func in list(namespace.items()):
+        if (name.startswith("_") or name in exclude or not inspect.iscoroutinefunction(func)
+                or func.__module__ != module):
+            continue
+        namespace[name] = timed(DB_QUERY_SECONDS, query=name)(func)
+
+
+# Декоратор обработчика уведомлений: время и результат по тексту ответа
+def observe_webhook(func):
+    @functools.wraps(func)
+    async def wrapper(request):
+        with WEBHOOK_SECONDS.time():
+            try:
+                response = await func(request)
+            except Exception:
+                WEBHOOK_OUTCOMES.labels("error").inc()
+                raise
+        WEBHOOK_OUTCOMES.labels(response.text or str(response.status)).inc()
+        return response
+    return wrapper
+
+
+# Декоратор отправки: считает доставленные и недоставленные сообщения
+def observe_send(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        delivered = await func(*args, **kwargs)
+        TELEGRAM_SENDS.labels("delivered" if delivered else "failed").inc()
+        return delivered
+    return wrapper
+
+
+# Middleware aiogram: время каждого обработчика с меткой имени функции. aiogram принимает любой
+# вызываемый объект, а без BaseMiddleware модули с метриками не тянут за собой импорт aiogram
+class HandlerMetricsMiddleware:
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            HANDLER_SECONDS.labels(name, outcome).observe(time.perf_counter() - started)
+
+
+async def metrics_handler(request):
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
\ No newline at end of file
@@ -1,7 +1,6 @@
 # payment.py
-import aiosqlite
 import os
-import decimal
+import asyncio
 import hashlib
 import hmac
 from aiohttp import web
@@ -9,17 +8,25 @@ from dotenv import load_dotenv
 from loguru import logger
 from urllib.parse import urlencode
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-from db import DB_FILE
-from telegram_bot import bot, generate_nickname
+from db import record_payment, get_payment, get_pending_payments, update_payment_status, set_payment_target
+from tasks import generate_nickname
 from vpn_manager import x3
+from broadcast import broadcaster
+from metrics import observe_webhook
+from storage import storage, Locks
+from tariffs import tariffs, to_kopecks
 
 load_dotenv()
 
-logger.add("logs_payments.log", mode='w', level="DEBUG")
-
 YOOMONEY_SECRET = os.getenv('YOOMONEY_SECRET')
 YOOMONEY_WALLET = os.getenv('YOOMONEY_WALLET')
 NOTIFICATION_URL = os.getenv('NOTIFICATION_URL')
+PAYMENT_WORKERS = int(os.getenv('PAYMENT_WORKERS', 4))
+PAYMENT_MAX_ATTEMPTS = int(os.getenv('PAYMENT_MAX_ATTEMPTS', 5))
+# Задержка перед первым повтором обработки платежа, дальше удваивается
+PAYMENT_RETRY_DELAY = float(os.getenv('PAYMENT_RETRY_DELAY', 10))
+# Сколько секунд operation_id остается занятым в общем хранилище после первого уведомления
+PAYMENT_CLAIM_TTL = float(os.getenv('PAYMENT_CLAIM_TTL', 7 * 86400))
 
 
 def generate_payment_link(amount, label, description):
@@ -44,6 +51,7 @@ def generate_payment_link(amount, label, description):
     return payment_link
 
 
+@observe_webhook
 async def yoomoney_notification(request):
     data = await request.post()
     logger.info(f"Получено уведомление от ЮMoney: {data}")
@@ -80,63 +88,31 @@ async def yoomoney_notification(request):
         logger.error("Неверная подпись в уведомлении от ЮMoney")
         return web.Response(text='Invalid signature')
 
-    # Проверяем, не была ли уже обработана эта транзакция
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('''
-            SELECT COUNT(*) FROM purchase_history WHERE operation_id = ?
-        ''', (operation_id,))
-        row = await cursor.fetchone()
-        if row[0] > 0:
-            logger.info(f"Уведомление с operation_id {operation_id} уже обработано.")
-            return web.Response(text='OK')  # Возвращаем OK, чтобы ЮMoney не отправлял повторные уведомления
-
     # Подпись верна, обрабатываем платеж
     if not label:
         logger.error("Отсутствует label в уведомлении")
         return web.Response(text='Invalid label')
 
-    # Преобразуем withdraw_amount_str в Decimal
+    # Сумма в копейках и тариф по ней: одно обращение к словарю тарифов
     try:
-        paid_amount = decimal.Decimal(withdraw_amount_str)
-        paid_amount = paid_amount.quantize(decimal.Decimal('1.00'))  # Округляем до 2 знаков
-    except decimal.InvalidOperation:
+        paid_kopecks = to_kopecks(withdraw_amount_str)
+    except ValueError:
         logger.error(f"Некорректная сумма withdraw_amount: {withdraw_amount_str}")
         return web.Response(text='Invalid withdraw_amount')
 
-    logger.info(f"paid_amount: {paid_amount}")
-
-    # Обновляем amount_mapping с использованием Decimal
-    amount_mapping = {
-        decimal.Decimal('5.00'): 5,
-        decimal.Decimal('200.00'): 30,
-        decimal.Decimal('500.00'): 90,
-        decimal.Decimal('1000.00'): 180
-    }
-
-    matching_amount = None
-    for amt in amount_mapping:
-        difference = abs(paid_amount - amt)
-        logger.info(f"Сравнение paid_amount: {paid_amount} и amt: {amt}, разница: {difference}")
-        if difference <= decimal.Decimal('0.01'):
-            matching_amount = amt
-            break
-
-    logger.info(f"matching_amount: {matching_amount}")
-
-
-    if not matching_amount:
-        logger.error(f"Не удалось найти соответствие для paid_amount: {paid_amount}")
+    tariff = tariffs.for_kopecks(paid_kopecks)
+    if tariff is None:
+        logger.error(f"Нет тарифа для суммы {withdraw_amount_str}")
         if label.startswith('renew_') or label.startswith('new_subscribe_'):
             parts = label.split('_')
             if len(parts) >= 2:
                 user_id_str = parts[1]
                 if user_id_str.isdigit():
                     user_id = int(user_id_str)
-                    await bot.send_message(user_id, "Получена неверная сумма оплаты.")
+                    await broadcaster.notify(user_id, "Получена неверная сумма оплаты.")
         return web.Response(text='Invalid amount')
 
-    # Округляем сумму до ближайшего значения в amount_mapping
-    expected_period = amount_mapping[matching_amount]
+    expected_period = tariff.days
 
     if label.startswith('renew_key_'):
         parts = label.split('_')
@@ -150,13 +126,8 @@ async def yoomoney_notification(request):
             return web.Response(text='Invalid user ID in label')
 
         user_id = int(user_id_str)
-        booster_key = x3.renew_subscribe(day=expected_period, tg_id=user_id)
-        if booster_key:
-            await bot.send_message(user_id, f"Оплата получена! Ваша подписка продлена на {expected_period} дней.")
-            return web.Response(text='OK')
-        else:
-            await bot.send_message(user_id, "Ошибка при обновлении ключа.")
-            return web.Response(text='Error creating VPN key')
+        action = 'renew'
+        user_name = None
     else:
         parts = label.split('_')
         if len(parts) != 2:
@@ -169,23 +140,135 @@ async def yoomoney_notification(request):
             return web.Response(text='Invalid user ID in label')
 
         user_id = int(user_id_str)
-        random_nickname = generate_nickname()
-        user_name = f"{user_id}-{random_nickname}"
-
-        # Создаем клиента и получаем ссылку
-        booster_key = x3.add_client(day=expected_period, tg_id=user_id, user_id=user_name)
-        if booster_key:
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text="Инструкция", callback_data="instruction")]
-                ]
-            )
-            await bot.send_message(user_id, f"Оплата получена!")
-            await bot.send_message(user_id,
-                                   f"Ваш ключ для HRVPN:<pre>{booster_key}</pre>"
-                                   f"Просто коснитесь 👆 и ключ сам скопируеться в буффер обмена",
-                                  parse_mode="HTML", reply_markup=keyboard)
-            return web.Response(text='OK')
+        action = 'new'
+        # Имя клиента выбирается один раз и сохраняется, чтобы повторная обработка не создала второй ключ
+        user_name = f"{user_id}-{generate_nickname()}"
+
+    # Повторное уведомление может прийти на другой экземпляр бота со своей базой: operation_id
+    # сначала занимается в общем хранилище
+    if not await storage.set_if_absent(f"payment:{operation_id}", "1", ttl=PAYMENT_CLAIM_TTL):
+        logger.info(f"Уведомление с operation_id {operation_id} уже принято.")
+        return web.Response(text='OK')
+
+    # Платеж фиксируется уникальной записью по operation_id: повторное уведомление ее не создаст
+    try:
+        recorded = await record_payment(user_id, paid_kopecks, expected_period, action, label, operation_id,
+                                        user_name)
+    except Exception:
+        # Платеж не записан: повторное уведомление ЮMoney должно быть принято
+        await storage.delete(f"payment:{operation_id}")
+        raise
+    if not recorded:
+        logger.info(f"Уведомление с operation_id {operation_id} уже обработано.")
+        return web.Response(text='OK')  # Возвращаем OK, чтобы ЮMoney не отправлял повторные уведомления
+
+    # Ключ выдается в фоне, ЮMoney получает ответ сразу
+    payment_processor.submit(operation_id)
+    return web.Response(text='OK')
+
+
+# Фоновая обработка записанных платежей: выдача или продление ключа и уведомление пользователя
+class PaymentProcessor:
+    def __init__(self, workers=PAYMENT_WORKERS, max_attempts=PAYMENT_MAX_ATTEMPTS):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.queue = asyncio.Queue()
+        self.tasks = []
+        self.retries = set()
+        # Один платеж в одно время обрабатывает только один экземпляр бота
+        self.locks = Locks(storage, "payment")
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        tasks = [*self.tasks, *self.retries]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, operation_id):
+        self.queue.put_nowait(operation_id)
+
+    # Платежи, не обработанные до остановки бота, ставятся в очередь заново
+    async def resume(self):
+        for operation_id in await get_pending_payments():
+            self.submit(operation_id)
+
+    async def retry_later(self, operation_id, delay):
+        await asyncio.sleep(delay)
+        self.submit(operation_id)
+
+    async def worker(self):
+        while True:
+            operation_id = await self.queue.get()
+            try:
+                await self.process(operation_id)
+            except Exception as e:
+                logger.error(f"Ошибка обработки платежа {operation_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def process(self, operation_id):
+        async with self.locks.hold(operation_id):
+            await self.process_payment(operation_id)
+
+    # Статус перечитывается под блокировкой: платеж, уже обработанный другим экземпляром, пропускается
+    async def process_payment(self, operation_id):
+        payment = await get_payment(operation_id)
+        if payment is None or payment['status'] != 'pending':
+            return
+        user_id = payment['user_id']
+        period = payment['period']
+        attempts = payment['attempts'] + 1
+
+        if payment['action'] == 'renew':
+            # Повтор после сбоя не продлевает второй раз: срок из прошлой попытки применяется как есть
+            ok = await x3.renew_to(period, user_id, payment['target_expiry'],
+                                   lambda target: set_payment_target(operation_id, target))
+            booster_key = None
         else:
-            await bot.send_message(user_id, "Ошибка при создании ключа.")
-            return web.Response(text='Error creating VPN key')
+            # Ключ мог быть создан при прошлой попытке, если она прервалась до смены статуса
+            entry = await x3.get_client(user_id)
+            if entry is not None and entry[1].get("email") == payment['email']:
+                booster_key = await x3.find_client_by_tg_id(user_id)
+            else:
+                booster_key = await x3.add_client(day=period, tg_id=user_id, user_id=payment['email'])
+            ok = booster_key is not None
+
+        if ok:
+            await update_payment_status(operation_id, 'done', attempts)
+            if payment['action'] == 'renew':
+                await broadcaster.deliver(user_id, f"Оплата получена! Ваша подписка продлена на {period} дней.")
+            else:
+                keyboard = InlineKeyboardMarkup(
+                    inline_keyboard=[
+                        [InlineKeyboardButton(text="Инструкция", callback_data="instruction")]
+                    ]
+                )
+                await broadcaster.deliver(user_id, f"Оплата получена!")
+                await broadcaster.deliver(user_id,
+                                          f"Ваш ключ для HRVPN:<pre>{booster_key}</pre>"
+                                          f"Просто коснитесь 👆 и ключ сам скопируеться в буффер обмена",
+                                          parse_mode="HTML", reply_markup=keyboard)
+            return
+
+        if attempts < self.max_attempts:
+            await update_payment_status(operation_id, 'pending', attempts)
+            delay = PAYMENT_RETRY_DELAY * 2 ** (attempts - 1)
+            logger.warning(f"Платеж {operation_id}: попытка {attempts} не удалась, повтор через {delay} с")
+            task = asyncio.create_task(self.retry_later(operation_id, delay))
+            self.retries.add(task)
+            task.add_done_callback(self.retries.discard)
+            return
+
+        await update_payment_status(operation_id, 'failed', attempts)
+        logger.error(f"Платеж {operation_id} не обработан после {attempts} попыток")
+        if payment['action'] == 'renew':
+            await broadcaster.notify(user_id, "Ошибка при обновлении ключа.")
+        else:
+            await broadcaster.notify(user_id, "Ошибка при создании ключа.")
+
+
+payment_processor = PaymentProcessor()
@@ -0,0 +1,98 @@
+# scheduler.py
+import heapq
+import asyncio
+import itertools
+from datetime import datetime, timezone
+
+# События по каждому клиенту: за сколько миллисекунд до expiryTime они наступают
+EXPIRY_EVENTS = (
+    ("5_days", 5 * 86400000),
+    ("1_day", 86400000),
+    ("expired", 0),
+)
+
+
+def now_ms():
+    return int(datetime.now(timezone.utc).timestamp() * 1000)
+
+
+# Очередь ближайших событий окончания подписки, упорядоченная по времени наступления
+class ExpiryScheduler:
+    def __init__(self, grace_ms=600000):
+        # До первой загрузки панели из зеркала берутся клиенты, истекшие не раньше чем grace_ms назад
+        self.grace_ms = grace_ms
+        self.heap = []
+        # tg_id -> expiryTime, под который построены записи в куче; остальные записи устарели
+        self.expiry = {}
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+
+    def schedule(self, tg_id, expiry_time):
+        if self.expiry.get(tg_id) == expiry_time:
+            return
+        self.expiry[tg_id] = expiry_time
+        # expiryTime <= 0 в 3x-ui означает бессрочного клиента
+        if expiry_time <= 0:
+            return
+
+        current = now_ms()
+        for event, offset in EXPIRY_EVENTS:
+            due = expiry_time - offset
+            # Напоминания, наступившие к моменту планирования, не отправляются: новый ключ на 1 день
+            # не должен сразу получать "осталось 1 день". Опоздавшими доставляются только напоминания,
+            # наступившие уже после планирования. Истечение обрабатывается всегда
+            if event != "expired" and due <= current:
+                continue
+            self.push(due, tg_id, event, expiry_time)
+
+    def push(self, due, tg_id, event, expiry_time):
+        heapq.heappush(self.heap, (due, next(self.counter), tg_id, event, expiry_time))
+        # Будим ожидающий цикл, если новое событие раньше того, до которого он спит
+        if self.heap[0][0] == due:
+            self.wakeup.set()
+
+    # Повторяет событие через delay_ms, если его не удалось обработать (например, ключ не удален,
+    # потому что панель недоступна). Событие действует, пока expiryTime клиента не изменился
+    def retry(self, tg_id, event, delay_ms):
+        expiry_time = self.expiry.get(tg_id)
+        if expiry_time is None or expiry_time <= 0:
+            return
+        self.push(now_ms() + delay_ms, tg_id, event, expiry_time)
+
+    def unschedule(self, tg_id):
+        self.expiry.pop(tg_id, None)
+
+    # Слушатель индекса клиентов X3: changes это {tg_id: клиент или None при удалении}
+    def update(self, changes):
+        for tg_id, client in changes.items():
+            if client is None:
+                self.unschedule(tg_id)
+            else:
+                self.schedule(tg_id, client.get("expiryTime", 0))
+
+    # Снимает с кучи все наступившие события, пропуская устаревшие записи
+    def pop_due(self, current=None):
+        current = now_ms() if current is None else current
+        due_events = []
+        while self.heap and self.heap[0][0] <= current:
+            _, _, tg_id, event, expiry_time = heapq.heappop(self.heap)
+            if self.expiry.get(tg_id) == expiry_time:
+                due_events.append((tg_id, event))
+        return due_events
+
+    def next_due(self):
+        while self.heap and self.expiry.get(self.heap[0][2]) != self.heap[0][4]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    # Спит до ближайшего события, но не дольше max_sleep секунд
+    async def wait(self, max_sleep):
+        timeout = max_sleep
+        due = self.next_due()
+        if due is not None:
+            timeout = max(0.0, min(max_sleep, (due - now_ms()) / 1000))
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
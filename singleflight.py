@@ -0,0 +1,48 @@
+# singleflight.py
+import asyncio
+import contextlib
+
+
+# Объединяет одновременные одинаковые вызовы: пока вызов с ключом key выполняется,
+# остальные вызывающие ждут его результат вместо повторного запроса
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, func, *args, **kwargs):
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self.calls[key] = future
+            future.add_done_callback(lambda done: self.calls.pop(key) if self.calls.get(key) is done else None)
+        # shield: отмена одного ожидающего не отменяет общий вызов для остальных
+        return await asyncio.shield(future)
+
+
+# Блокировки по ключу (например, по tg_id); неиспользуемые блокировки удаляются
+class KeyedLock:
+    def __init__(self):
+        self.locks = {}
+        self.holders = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        self.holders[key] = self.holders.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.holders[key] -= 1
+            if not self.holders[key]:
+                del self.holders[key]
+                del self.locks[key]
+
+    # Блокировки нескольких ключей сразу; берутся в отсортированном порядке, чтобы два пакетных
+    # вызова с пересекающимися ключами не ждали друг друга бесконечно
+    @contextlib.asynccontextmanager
+    async def hold_many(self, keys):
+        async with contextlib.AsyncExitStack() as stack:
+            for key in sorted(set(keys)):
+                await stack.enter_async_context(self.hold(key))
+            yield
\ No newline at end of file
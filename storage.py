@@ -0,0 +1,165 @@
+# storage.py
+import os
+import time
+import uuid
+import random
+import asyncio
+import contextlib
+from loguru import logger
+from dotenv import load_dotenv
+from singleflight import KeyedLock
+
+load_dotenv()
+
+# memory:// - все в памяти процесса (один экземпляр бота);
+# redis://host:6379/0 - общее состояние для нескольких экземпляров main.py
+STORAGE_URL = os.getenv("STORAGE_URL", "memory://")
+# Срок жизни блокировки: если экземпляр упал, не сняв ее, она освободится сама
+STORAGE_LOCK_TTL = float(os.getenv("STORAGE_LOCK_TTL", 60))
+STORAGE_PREFIX = os.getenv("STORAGE_PREFIX", "hrvpn:")
+
+
+# Состояние одного процесса: значения со сроком жизни и блокировки asyncio
+class MemoryStorage:
+    # Состояние видно только этому процессу, делиться индексом и сессией не с кем
+    shared = False
+
+    def __init__(self):
+        self.values = {}
+        self.keyed = KeyedLock()
+
+    def alive(self, key):
+        entry = self.values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.values[key]
+            return None
+        return entry
+
+    async def get(self, key):
+        entry = self.alive(key)
+        return entry[0] if entry is not None else None
+
+    async def set(self, key, value, ttl=None):
+        self.values[key] = (value, time.monotonic() + ttl if ttl else None)
+
+    # Записывает значение, только если ключа еще нет; возвращает True, если записано
+    async def set_if_absent(self, key, value, ttl=None):
+        if self.alive(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key):
+        self.values.pop(key, None)
+
+    def lock(self, key, ttl=STORAGE_LOCK_TTL):
+        return self.keyed.hold(key)
+
+    async def close(self):
+        pass
+
+
+# Состояние в Redis (или совместимом сервере): значения общие для всех экземпляров,
+# блокировки - SET NX PX с токеном владельца. Снятие через WATCH/MULTI, а не Lua-скрипт:
+# скрипты поддерживают не все серверы с протоколом Redis
+class RedisStorage:
+    shared = True
+
+    def __init__(self, url=None, client=None, prefix=STORAGE_PREFIX):
+        if client is None:
+            try:
+                from redis import asyncio as aioredis
+            except ImportError:
+                raise RuntimeError("Для STORAGE_URL=redis:// установите пакет redis") from None
+            client = aioredis.from_url(url, decode_responses=True)
+        self.redis = client
+        self.prefix = prefix
+        # Ожидающие в одном процессе стоят в очереди asyncio, а не опрашивают Redis
+        self.keyed = KeyedLock()
+
+    async def get(self, key):
+        return await self.redis.get(self.prefix + key)
+
+    async def set(self, key, value, ttl=None):
+        await self.redis.set(self.prefix + key, value, px=int(ttl * 1000) if ttl else None)
+
+    async def set_if_absent(self, key, value, ttl=None):
+        return bool(await self.redis.set(self.prefix + key, value, nx=True,
+                                         px=int(ttl * 1000) if ttl else None))
+
+    async def delete(self, key):
+        await self.redis.delete(self.prefix + key)
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key, ttl=STORAGE_LOCK_TTL):
+        async with self.keyed.hold(key):
+            name = f"{self.prefix}lock:{key}"
+            token = uuid.uuid4().hex
+            delay = 0.01
+            while not await self.redis.set(name, token, nx=True, px=int(ttl * 1000)):
+                await asyncio.sleep(random.uniform(0, delay))
+                delay = min(delay * 2, 0.5)
+            try:
+                yield
+            finally:
+                try:
+                    await self.release(name, token)
+                except Exception as e:
+                    # Блокировка освободится сама по истечении ttl
+                    logger.error(f"Не удалось снять блокировку {key}: {e}")
+
+    # Удаляет блокировку, только если она все еще принадлежит владельцу token: после истечения ttl
+    # ее мог взять другой экземпляр
+    async def release(self, name, token):
+        from redis.exceptions import WatchError
+        async with self.redis.pipeline() as pipe:
+            try:
+                await pipe.watch(name)
+                if await pipe.get(name) != token:
+                    return
+                pipe.multi()
+                pipe.delete(name)
+                await pipe.execute()
+            except WatchError:
+                pass
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+# Блокировки одного вида (пользователи, инбаунды, платежи) с интерфейсом KeyedLock
+class Locks:
+    def __init__(self, storage, prefix):
+        self.storage = storage
+        self.prefix = prefix
+
+    def hold(self, key):
+        return self.storage.lock(f"{self.prefix}:{key}")
+
+    # Ключи берутся в отсортированном порядке, чтобы пересекающиеся пакетные вызовы не ждали друг друга
+    @contextlib.asynccontextmanager
+    async def hold_many(self, keys):
+        async with contextlib.AsyncExitStack() as stack:
+            for key in sorted(set(keys)):
+                await stack.enter_async_context(self.hold(key))
+            yield
+
+
+def make_storage(url):
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStorage(url)
+    if url.startswith("memory://"):
+        return MemoryStorage()
+    raise ValueError(f"Неизвестный STORAGE_URL: {url}")
+
+
+# Хранилище состояний aiogram (FSM) на том же сервере, что и остальное состояние
+def make_fsm_storage(url):
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        from aiogram.fsm.storage.redis import RedisStorage as FSMRedisStorage
+        return FSMRedisStorage.from_url(url)
+    from aiogram.fsm.storage.memory import MemoryStorage as FSMMemoryStorage
+    return FSMMemoryStorage()
+
+
+storage = make_storage(STORAGE_URL)
\ No newline at end of file
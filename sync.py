@@ -0,0 +1,169 @@
+# sync.py
+import os
+import asyncio
+from loguru import logger
+from dotenv import load_dotenv
+import db
+from singleflight import SingleFlight
+from vpn_manager import x3, index_listeners
+
+load_dotenv()
+
+# Интервал полной сверки зеркала с панелью, в секундах
+MIRROR_SYNC_INTERVAL = int(os.getenv("MIRROR_SYNC_INTERVAL", 300))
+
+
+# Зеркало клиентов 3x-ui в таблице subscriptions. Изменения из индекса X3 записываются сразу,
+# а периодическая сверка с inbounds/list удаляет клиентов, пропавших из панели
+class ClientMirror:
+    def __init__(self, x3, interval):
+        self.x3 = x3
+        self.interval = interval
+        # key_id -> строка в том виде, в каком она записана в базу
+        self.rows = {}
+        self.by_tg = {}
+        # tg_id -> строка или None; изменения, еще не записанные в базу
+        self.pending = {}
+        # Изменения, которые сейчас записываются в базу
+        self.flushing = {}
+        self.wakeup = asyncio.Event()
+        self.synced = False
+        self.flights = SingleFlight()
+
+    def make_row(self, item, client):
+        try:
+            link = self.x3.build_client_link(item, client)
+        except Exception as e:
+            logger.error(f"Ошибка формирования ссылки для клиента {client.get('tgId')}: {e}")
+            link = None
+        return (client["tgId"], client.get("email"), item["id"], client.get("expiryTime", 0),
+                bool(client.get("enable", True)), link)
+
+    # Слушатель индекса X3: откладывает изменения до ближайшей записи в базу
+    def update(self, changes):
+        for tg_id, client in changes.items():
+            if client is None:
+                self.pending[tg_id] = None
+                continue
+            entry = self.x3.index.get(tg_id)
+            if entry is None:
+                continue
+            item, client = entry
+            key_id = self.by_tg.get(tg_id)
+            stored = self.rows.get(key_id) if key_id == client["id"] else None
+            # Ссылку пересобираем только если клиент действительно изменился
+            if stored is not None and stored[:5] == (tg_id, client.get("email"), item["id"],
+                                                     client.get("expiryTime", 0),
+                                                     bool(client.get("enable", True))):
+                self.pending.pop(tg_id, None)
+                continue
+            self.pending[tg_id] = (client["id"], self.make_row(item, client))
+        if self.pending:
+            self.wakeup.set()
+
+    async def load(self):
+        self.rows = await db.get_mirrored_clients()
+        self.by_tg = {row[0]: key_id for key_id, row in self.rows.items()}
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        self.flushing = pending
+        upserts = []
+        deletes = []
+        for tg_id, change in pending.items():
+            old_key = self.by_tg.get(tg_id)
+            if change is None:
+                if old_key is not None:
+                    deletes.append(old_key)
+                continue
+            key_id, row = change
+            if old_key is not None and old_key != key_id:
+                deletes.append(old_key)
+            upserts.append((key_id, row))
+
+        try:
+            if deletes:
+                await db.delete_mirrored_clients(deletes)
+            if upserts:
+                await db.upsert_mirrored_clients(upserts)
+        except Exception:
+            # Не потерять изменения: более новые значения из pending имеют приоритет
+            self.pending = {**pending, **self.pending}
+            raise
+        finally:
+            self.flushing = {}
+
+        for key_id in deletes:
+            row = self.rows.pop(key_id, None)
+            if row is not None and self.by_tg.get(row[0]) == key_id:
+                del self.by_tg[row[0]]
+        for key_id, row in upserts:
+            self.rows[key_id] = row
+            self.by_tg[row[0]] = key_id
+        logger.debug(f"Зеркало клиентов: записано {len(upserts)}, удалено {len(deletes)}")
+
+    # Полная сверка: свежий список из панели плюс удаление строк, которых в панели больше нет
+    async def reconcile(self):
+        updated_at = self.x3.index.updated_at
+        await self.x3.refresh_index(force=True)
+        if self.x3.index.updated_at == updated_at:
+            logger.error("Сверка зеркала клиентов пропущена: панель недоступна")
+            return
+        for tg_id in self.by_tg.keys() - self.x3.index.clients.keys():
+            self.pending.setdefault(tg_id, None)
+        await self.flush()
+        self.synced = True
+
+    async def run(self):
+        await self.load()
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Ошибка сверки зеркала клиентов: {e}")
+            deadline = loop.time() + self.interval
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.error(f"Ошибка записи зеркала клиентов: {e}")
+
+    # Строка зеркала по tg_id: (tg_id, email, inbound_id, expiry_time, enable, link) или None
+    async def get_client(self, tg_id):
+        for changes in (self.pending, self.flushing):
+            if tg_id in changes:
+                change = changes[tg_id]
+                return change[1] if change is not None else None
+        # Повторные нажатия пользователя делят один запрос к базе
+        row = await self.flights.do(tg_id, db.get_mirrored_client, tg_id)
+        return tuple(row[1:]) if row else None
+
+    # Ссылка клиента; пока зеркало не сверено с панелью, ответ берется из X3
+    async def get_client_link(self, tg_id):
+        if not self.synced:
+            return await self.x3.find_client_by_tg_id(tg_id)
+        row = await self.get_client(tg_id)
+        return row[5] if row else None
+
+    async def get_expirytime(self, tg_id):
+        if not self.synced:
+            return await self.x3.find_expirytime_by_tg_id(tg_id)
+        row = await self.get_client(tg_id)
+        return row[3] if row else None
+
+    # Клиенты со сроком в диапазоне [start_ms, end_ms) в формате слушателя индекса
+    async def get_expiring(self, start_ms, end_ms):
+        rows = await db.get_mirrored_expiring(start_ms, end_ms)
+        return {tg_id: {"expiryTime": expires_at} for tg_id, expires_at in rows}
+
+
+mirror = ClientMirror(x3, MIRROR_SYNC_INTERVAL)
+index_listeners.append(mirror.update)
@@ -0,0 +1,57 @@
+# tariffs.py
+import os
+import json
+import decimal
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Тарифы: JSON-список {"days": срок в днях, "price": цена в рублях}; порядок задает порядок кнопок.
+# TARIFFS='[{"days": 30, "price": "200"}, {"days": 90, "price": "500"}, {"days": 180, "price": "1000"}]'
+DEFAULT_TARIFFS = [{"days": 30, "price": "200"}, {"days": 90, "price": "500"}, {"days": 180, "price": "1000"}]
+
+
+# Сумма в рублях (строка или число) -> целые копейки; ValueError, если это не сумма
+def to_kopecks(value):
+    try:
+        amount = decimal.Decimal(str(value).replace(',', '.').strip()).quantize(decimal.Decimal('1.00'))
+    except decimal.InvalidOperation:
+        raise ValueError(f"Некорректная сумма: {value!r}") from None
+    if not amount.is_finite():
+        raise ValueError(f"Некорректная сумма: {value!r}")
+    return int(amount * 100)
+
+
+class Tariff:
+    def __init__(self, days, kopecks):
+        self.days = days
+        self.kopecks = kopecks
+        # Сумма для формы ЮMoney и текста кнопок: "200" или "199.50"
+        rubles, rest = divmod(kopecks, 100)
+        self.price = f"{rubles}.{rest:02d}" if rest else str(rubles)
+        self.title = f"{days} дней - {self.price} рублей"
+
+
+# Тарифы загружаются один раз; поиск по сроку (кнопки) и по оплаченной сумме в копейках (уведомления
+# ЮMoney) - обращения к словарю
+class Tariffs:
+    def __init__(self, plans):
+        self.plans = [Tariff(int(plan["days"]), to_kopecks(plan["price"])) for plan in plans]
+        self.by_days = {tariff.days: tariff for tariff in self.plans}
+        self.by_kopecks = {tariff.kopecks: tariff for tariff in self.plans}
+        if len(self.by_days) != len(self.plans) or len(self.by_kopecks) != len(self.plans):
+            raise ValueError("В TARIFFS повторяются сроки или цены: сумма оплаты должна однозначно задавать срок")
+
+    def for_days(self, days):
+        return self.by_days.get(days)
+
+    def for_kopecks(self, kopecks):
+        return self.by_kopecks.get(kopecks)
+
+
+def load_tariffs():
+    raw = os.getenv("TARIFFS")
+    return Tariffs(json.loads(raw) if raw else DEFAULT_TARIFFS)
+
+
+tariffs = load_tariffs()
\ No newline at end of file
@@ -1,23 +1,30 @@
 # tasks.py
-import json
 import os
 import secrets
 import string
-import aiosqlite
-import asyncio
 from urllib.parse import urlencode
 from loguru import logger
 from dotenv import load_dotenv
 from datetime import datetime, timezone
-from vpn_manager import x3
-
-logger.add("logs_tasks.log", mode='w', level="INFO")
+from vpn_manager import x3, index_listeners
+from sync import mirror
+from broadcast import broadcaster
+from scheduler import ExpiryScheduler, now_ms
+from metrics import timed, EXPIRY_SWEEP_SECONDS, EXPIRY_CLIENTS, EXPIRY_SCHEDULED, EXPIRY_EVENTS
 
 load_dotenv()
 
 YOOMONEY_SECRET = os.getenv('YOOMONEY_SECRET')
 YOOMONEY_WALLET = os.getenv('YOOMONEY_WALLET')
 NOTIFICATION_URL = os.getenv('NOTIFICATION_URL')
+# Максимальный интервал между сверками с панелью, если событий не ожидается
+EXPIRY_RESYNC_INTERVAL = int(os.getenv('EXPIRY_RESYNC_INTERVAL', 600))
+
+# Планировщик получает каждое изменение индекса клиентов, в том числе из renew_subscribe
+scheduler = ExpiryScheduler()
+index_listeners.append(scheduler.update)
+EXPIRY_CLIENTS.set_function(lambda: len(x3.index.clients))
+EXPIRY_SCHEDULED.set_function(lambda: len(scheduler.expiry))
 
 
 def generate_nickname(length=8):
@@ -49,7 +56,9 @@ def generate_payment_link(amount, label, description):
 
 
 async def check_expirytime(tg_id):
-    time_left = x3.find_expirytime_by_tg_id(tg_id=tg_id)
+    time_left = await mirror.get_expirytime(tg_id)
+    if time_left is None:
+        return 0
     expirytime = datetime.fromtimestamp(time_left / 1000, tz=timezone.utc)
     time_left = expirytime - datetime.now(timezone.utc)
     total_seconds_left = time_left.total_seconds()
@@ -71,32 +80,57 @@ async def check_test_usage_status_in_db(tg_id):
     pass
 
 
+# Обрабатывает наступившие события планировщика: напоминания и удаление истекших ключей.
+# Сообщения уходят через очередь рассылки с ограничением скорости, проход их не ждет
+@timed(EXPIRY_SWEEP_SECONDS)
+async def sweep_subscribes_expirity():
+    # Индекс перечитывается только если устарел; изменения попадают в планировщик через слушателя
+    await x3.refresh_index()
+    expired = []
+    for tg_id, event in scheduler.pop_due():
+        EXPIRY_EVENTS.labels(event).inc()
+        try:
+            if event == "5_days":
+                await broadcaster.notify(tg_id, "До окончания подписки осталось 5 дней")
+                logger.info(f"Срок действия подписки 5 дней для {tg_id}")
+            elif event == "1_day":
+                await broadcaster.notify(tg_id, "До окончания подписки осталось 1 день")
+                logger.info(f"Срок действия подписки 1 дней для {tg_id}")
+            elif event == "expired":
+                expired.append(tg_id)
+        except Exception as e:
+            logger.error(f"Fail to check_subscribes_expirity {e}")
+
+    # Истекшие ключи удаляются пакетом: один запрос на инбаунд, а не на каждого клиента.
+    # Сообщение об удалении уходит только после удаления; неудаленные ключи повторяются позже
+    if expired:
+        deleted = set()
+        try:
+            deleted = await x3.delete_many(expired)
+        except Exception as e:
+            logger.error(f"Fail to delete expired keys {e}")
+        for tg_id in expired:
+            if tg_id in deleted:
+                await broadcaster.notify(tg_id, "Срок действия подписки истек\n"
+                                                "Ключ удалён")
+                logger.info(f"Срок действия подписки истек для {tg_id}, Ключ удалён")
+            else:
+                logger.error(f"Ключ {tg_id} с истекшей подпиской не удален, повтор через {EXPIRY_RESYNC_INTERVAL} с")
+                scheduler.retry(tg_id, "expired", EXPIRY_RESYNC_INTERVAL * 1000)
+
+
 async def check_subscribes_expirity():
-    # с определенным интервалом проверяет срок действия подписок x3.get_inbounds() и присылает уведомления о сроках
-    # уведомления об окончания подписки(5 дней,1 день, срок истек)
-    from telegram_bot import bot
+    # присылает уведомления об окончании подписки (5 дней, 1 день, срок истек) по событиям планировщика,
+    # просыпаясь к ближайшему событию или раз в EXPIRY_RESYNC_INTERVAL для сверки с панелью
+    # До первой загрузки панели планировщик заполняется из зеркала одним запросом по индексу expires_at
+    try:
+        current = now_ms()
+        scheduler.update(await mirror.get_expiring(current - scheduler.grace_ms, current + 6 * 86400000))
+    except Exception as e:
+        logger.error(f"Fail to load expiring clients from mirror {e}")
     while True:
-        inbounds = x3.get_inbounds()
-        for item in inbounds:
-            try:
-                settings = json.loads((item["settings"]))
-                for client in settings['clients']:
-                    tg_id = client.get("tgId")
-
-                    total_seconds_left = await check_expirytime(tg_id)
-                    days_left = int(total_seconds_left // 86400)
-                    print(days_left)
-
-
-                    if 86400 < total_seconds_left <= 87000:
-                        await bot.send_message(str(tg_id), f"До окончания подписки осталось {days_left} день")
-                        logger.info(f"Срок действия подписки {days_left} дней для {tg_id}")
-                    elif total_seconds_left <= 0:
-                        await bot.send_message(str(tg_id), "Срок действия подписки истек\n"
-                                                           "Ключ удалён")
-                        logger.info(f"Срок действия подписки истек для {tg_id}, Ключ удалён")
-                        x3.delete_client(tg_id)
-
-            except Exception as e:
-                logger.error(f"Fail to check_subscribes_expirity {e}")
-        await asyncio.sleep(600)
\ No newline at end of file
+        try:
+            await sweep_subscribes_expirity()
+        except Exception as e:
+            logger.error(f"Fail to check_subscribes_expirity {e}")
+        await scheduler.wait(EXPIRY_RESYNC_INTERVAL)
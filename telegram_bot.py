@@ -1,15 +1,18 @@
 # telegram_bot.py
-import aiosqlite
-import os
 from datetime import datetime
 from dotenv import load_dotenv
-from loguru import logger
 from aiogram import types, F
-from aiogram import Bot, Dispatcher
+from aiogram import Dispatcher
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from vpn_manager import x3
-from db import add_user, DB_FILE
+from sync import mirror
+from db import add_user, has_used_test
+from metrics import HandlerMetricsMiddleware
+from storage import STORAGE_URL, make_fsm_storage
+from context import Lazy, current
+from tariffs import tariffs
+from traffic import traffic_collector, format_bytes
 from tasks import (check_expirytime,
                    generate_nickname,
                    generate_payment_link)
@@ -17,12 +20,13 @@ from tasks import (check_expirytime,
 
 load_dotenv()
 
-logger.add("logs_bot.log", mode='w', level="DEBUG")
-
-API_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
+# Бот из контекста приложения: создается при первом обращении
+bot = Lazy(lambda: current().bot)
+# Состояния FSM хранятся там же, где остальное общее состояние экземпляров бота
+dp = Dispatcher(storage=make_fsm_storage(STORAGE_URL))
+# Время каждого обработчика в метрике bot_handler_seconds
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
 
 
 @dp.message(Command("start"))
@@ -30,19 +34,17 @@ async def start(message: types.Message):
     user_id = message.from_user.id
     await add_user(user_id)  # Добавляем пользователя в базу данных, если он новый
     # Проверяем, использовал ли пользователь тестовую подписку
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('SELECT COUNT(*) FROM test_usage WHERE user_id = ?', (user_id,))
-        row = await cursor.fetchone()
-        has_used_test = row[0] > 0
+    used_test = await has_used_test(user_id)
 
     keyboard_buttons = [
         [InlineKeyboardButton(text="Мои ключи", callback_data="my_keys")],
+        [InlineKeyboardButton(text="Трафик", callback_data="traffic")],
         [InlineKeyboardButton(text="Купить ключ", callback_data="new_key")],
         [InlineKeyboardButton(text="Инструкция", callback_data="instruction")],
     ]
 
     # Вставляем кнопку "Тест на день" только если тест не был использован
-    if not has_used_test:
+    if not used_test:
         keyboard_buttons.insert(1, [InlineKeyboardButton(text="Тест HRVPN на 1 день", callback_data="test_period")])
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
@@ -54,7 +56,7 @@ async def start(message: types.Message):
 async def handle_my_keys(callback: types.CallbackQuery):
     await callback.answer("Вы выбрали 'Мои ключи'.")
     tg_id = callback.from_user.id
-    booster_key = x3.find_client_by_tg_id(tg_id=tg_id)
+    booster_key = await mirror.get_client_link(tg_id)
     if booster_key:
         await callback.message.answer(f"Ваш ключ для HRVPN:<pre>{booster_key}</pre>"
                                       f"Просто коснитесь 👆 и ключ сам скопируеться в буффер обмена",
@@ -85,10 +87,31 @@ async def handle_my_keys(callback: types.CallbackQuery):
                                       reply_markup=keyboard)
 
 
+@dp.callback_query(F.data == "traffic")
+async def handle_traffic(callback: types.CallbackQuery):
+    await callback.answer()
+    summary = await traffic_collector.get_user_summary(callback.from_user.id)
+    periods = (("day", "За сутки"), ("week", "За неделю"), ("month", "За месяц"))
+    lines = [f"{title}: ↓ {format_bytes(summary[period][1])} ↑ {format_bytes(summary[period][0])}"
+             for period, title in periods]
+    await callback.message.answer("Использованный трафик:\n" + "\n".join(lines))
+
+
+# Кнопки тарифов строятся один раз из того же списка, по которому вебхук ЮMoney определяет срок
+def tariff_keyboard(prefix):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=tariff.title, callback_data=f"{prefix}_{tariff.days}")] for tariff in tariffs.plans
+    ])
+
+
+new_key_keyboard = tariff_keyboard("new_key")
+renew_key_keyboard = tariff_keyboard("renew_key")
+
+
 @dp.callback_query(F.data == "new_key")
 async def handle_new_key(callback: types.CallbackQuery):
     tg_id = callback.from_user.id
-    check_key = x3.find_client_by_tg_id(tg_id=tg_id)
+    check_key = await mirror.get_client_link(tg_id)
     if check_key:
         await callback.message.answer(f"У Вас уже есть ключ:<pre>{check_key}</pre>", parse_mode='HTML')
         await check_expirytime(tg_id)
@@ -97,34 +120,23 @@ async def handle_new_key(callback: types.CallbackQuery):
         await callback.message.answer("Чтобы продлить подписку нажмите кнопку",
                                       reply_markup=keyboard)
     else:
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [InlineKeyboardButton(
-                    text="30 дней - 200 рублей", callback_data="new_key_30")],
-                [InlineKeyboardButton(
-                    text="90 дней - 500 рублей", callback_data="new_key_90")],
-                [InlineKeyboardButton(
-                    text="180 дней - 1000 рублей", callback_data="new_key_180")],
-            ]
-        )
-        await callback.message.answer("Выберите период подписки для нового ключа:", reply_markup=keyboard)
+        await callback.message.answer("Выберите период подписки для нового ключа:", reply_markup=new_key_keyboard)
 
 
 @dp.callback_query(F.data.startswith("new_key_"))
 async def handle_new_subscription(callback: types.CallbackQuery):
     period = int(callback.data.split("_")[2])
-    amount_mapping = {30: 5, 90: 500, 180: 1000}
-    amount = amount_mapping.get(period)
+    tariff = tariffs.for_days(period)
 
-    if not amount:
+    if not tariff:
         await callback.message.answer("Некорректный выбор периода подписки.")
         return
 
     user_id = callback.from_user.id
     payment_label = f"{user_id}_{int(datetime.now().timestamp())}"
-    payment_link = generate_payment_link(amount, payment_label, f"Подписка на {period} дней")
+    payment_link = generate_payment_link(tariff.price, payment_label, f"Подписка на {period} дней")
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"Оплатить {amount} рублей", url=payment_link)]
+        [InlineKeyboardButton(text=f"Оплатить {tariff.price} рублей", url=payment_link)]
     ])
     await callback.message.answer(
         f"Для оплаты подписки на {period} дней нажмите кнопку ниже:",reply_markup=keyboard)
@@ -133,36 +145,25 @@ async def handle_new_subscription(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "renew_key")
 async def handle_renew_key(callback: types.CallbackQuery):
     tg_id = callback.from_user.id
-    check_key = x3.find_client_by_tg_id(tg_id=tg_id)
+    check_key = await mirror.get_client_link(tg_id)
     if check_key:
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [InlineKeyboardButton(
-                    text="30 дней - 200 рублей", callback_data="renew_key_30")],
-                [InlineKeyboardButton(
-                    text="90 дней - 500 рублей", callback_data="renew_key_90")],
-                [InlineKeyboardButton(
-                    text="180 дней - 1000 рублей", callback_data="renew_key_180")],
-            ]
-        )
-        await callback.message.answer("Выберите период продления:", reply_markup=keyboard)
+        await callback.message.answer("Выберите период продления:", reply_markup=renew_key_keyboard)
 
 
 @dp.callback_query(F.data.startswith("renew_key_"))
 async def handle_renew_subscription(callback: types.CallbackQuery):
     period = int(callback.data.split("_")[2])
-    amount_mapping = {30: 5, 90: 500, 180: 1000}
-    amount = amount_mapping.get(period)
+    tariff = tariffs.for_days(period)
 
-    if not amount:
+    if not tariff:
         await callback.message.answer("Некорректный выбор периода подписки.")
         return
 
     user_id = callback.from_user.id
     payment_label = f"renew_key_{user_id}_{int(datetime.now().timestamp())}"
-    payment_link = generate_payment_link(amount, payment_label, f"Продление подписки на {period} дней")
+    payment_link = generate_payment_link(tariff.price, payment_label, f"Продление подписки на {period} дней")
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"Оплатить {amount} рублей", url=payment_link)]
+        [InlineKeyboardButton(text=f"Оплатить {tariff.price} рублей", url=payment_link)]
     ])
     await callback.message.answer(
         f"Для продления подписки на {period} дней нажмите кнопку ниже:",reply_markup=keyboard)
@@ -171,7 +172,7 @@ async def handle_renew_subscription(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "instruction")
 async def handle_instruction(callback: types.CallbackQuery):
     tg_id = callback.from_user.id
-    x3.get_inbounds()
+    await x3.get_inbounds()
 
 
 
@@ -183,17 +184,20 @@ async def handle_test_period(callback: types.CallbackQuery):
     random_nickname = generate_nickname()
     user_id = f"{tg_id}-{random_nickname}"
 
-    check_key = x3.find_client_by_tg_id(tg_id=tg_id)
+    check_key = await mirror.get_client_link(tg_id)
     if check_key:
         await callback.message.answer(f"У Вас уже есть ключ:<pre>{check_key}</pre>", parse_mode='HTML')
         await check_expirytime(tg_id)
+        return
 
-    elif not check_key:
-        booster_key = x3.add_client(day=1, tg_id=tg_id, user_id=user_id)
-        if booster_key:
-            await callback.message.answer(f"Ваш ключ для HRVPN:<pre>{booster_key}</pre>"
-                                          f"Просто коснитесь 👆 и ключ сам скопируеться в буффер обмена",
+    # Проверка и создание под блокировкой пользователя: повторное нажатие не создаст второй ключ
+    booster_key, created = await x3.add_client_if_absent(day=1, tg_id=tg_id, user_id=user_id)
+    if booster_key and created:
+        await callback.message.answer(f"Ваш ключ для HRVPN:<pre>{booster_key}</pre>"
+                                      f"Просто коснитесь 👆 и ключ сам скопируеться в буффер обмена",
                                       parse_mode="HTML")
+    elif booster_key:
+        await callback.message.answer(f"У Вас уже есть ключ:<pre>{booster_key}</pre>", parse_mode='HTML')
     else:
         await callback.answer("Ошибка при создании клиента или получении ссылки. Попробуйте позже.")
 
@@ -0,0 +1,86 @@
+# telegram_webhook.py
+import os
+import hmac
+import asyncio
+import hashlib
+from aiohttp import web
+from loguru import logger
+from dotenv import load_dotenv
+from aiogram.types import Update
+from metrics import TELEGRAM_UPDATES, TELEGRAM_UPDATE_QUEUE
+
+load_dotenv()
+
+# Публичный адрес, на который Telegram отправляет обновления (https://example.com). Пустой - long polling
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram_webhook")
+# Если секрет не задан, он выводится из токена бота: одинаковый у всех экземпляров
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET") or hashlib.sha256(
+    os.getenv("TELEGRAM_BOT_TOKEN", "").encode()).hexdigest()
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 16))
+# При переполненной очереди webhook отвечает 503, и Telegram повторит доставку позже
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+
+
+# Прием обновлений Telegram через aiohttp: ответ сразу после постановки в очередь,
+# обработка в фиксированном числе задач
+class UpdateQueue:
+    def __init__(self, secret=TELEGRAM_WEBHOOK_SECRET, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE):
+        self.bot = None
+        self.dp = None
+        self.secret = secret
+        self.workers = workers
+        self.queue = asyncio.Queue(queue_size)
+        self.tasks = []
+        TELEGRAM_UPDATE_QUEUE.set_function(self.queue.qsize)
+
+    def start(self, bot, dp):
+        self.bot = bot
+        self.dp = dp
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    # Регистрирует webhook в Telegram только для тех типов обновлений, на которые есть обработчики
+    async def set_webhook(self, url=TELEGRAM_WEBHOOK_URL, path=TELEGRAM_WEBHOOK_PATH):
+        await self.bot.set_webhook(f"{url.rstrip('/')}{path}", secret_token=self.secret,
+                                   allowed_updates=self.dp.resolve_used_update_types())
+        logger.info(f"Webhook Telegram установлен на {url.rstrip('/')}{path}")
+
+    async def handle(self, request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, self.secret):
+            TELEGRAM_UPDATES.labels("unauthorized").inc()
+            logger.warning(f"Запрос к webhook Telegram с неверным секретом от {request.remote}")
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError as e:
+            TELEGRAM_UPDATES.labels("invalid").inc()
+            logger.error(f"Некорректное обновление Telegram: {e}")
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            TELEGRAM_UPDATES.labels("rejected").inc()
+            logger.warning(f"Очередь обновлений Telegram заполнена, обновление {update.update_id} отклонено")
+            return web.Response(status=503)
+        TELEGRAM_UPDATES.labels("accepted").inc()
+        return web.Response()
+
+    async def worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+
+update_queue = UpdateQueue()
\ No newline at end of file
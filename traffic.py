@@ -0,0 +1,116 @@
+# traffic.py
+import os
+import time
+import asyncio
+from loguru import logger
+from dotenv import load_dotenv
+import db
+from vpn_manager import x3
+from metrics import timed, TRAFFIC_COLLECT_SECONDS
+
+load_dotenv()
+
+# Интервал сбора трафика, в секундах: один запрос inbounds/list к каждой панели
+TRAFFIC_INTERVAL = int(os.getenv("TRAFFIC_INTERVAL", 300))
+# Сколько дней хранятся часовые и суточные корзины
+TRAFFIC_HOURLY_RETENTION_DAYS = int(os.getenv("TRAFFIC_HOURLY_RETENTION_DAYS", 14))
+TRAFFIC_DAILY_RETENTION_DAYS = int(os.getenv("TRAFFIC_DAILY_RETENTION_DAYS", 365))
+
+HOUR_MS = 3600 * 1000
+DAY_MS = 24 * HOUR_MS
+
+
+# Сборщик трафика клиентов: читает счетчики up/down из clientStats инбаундов и записывает приросты
+# с прошлого прохода в часовые и суточные корзины одной пакетной транзакцией
+class TrafficCollector:
+    def __init__(self, x3, interval):
+        self.x3 = x3
+        self.interval = interval
+        # email -> (up, down) на момент прошлого прохода; загружается из базы при первом проходе
+        self.counters = None
+        self.pruned_at = 0
+
+    @timed(TRAFFIC_COLLECT_SECONDS)
+    async def collect(self):
+        updated_at = self.x3.index.updated_at
+        await self.x3.refresh_index(force=True)
+        if self.x3.index.updated_at == updated_at:
+            logger.error("Сбор трафика пропущен: панель недоступна")
+            return
+        # Первый запуск без сохраненных счетчиков: текущие значения становятся точкой отсчета,
+        # иначе весь накопленный за время работы панели трафик попал бы в текущий час
+        baseline = False
+        if self.counters is None:
+            self.counters = await db.get_traffic_counters()
+            baseline = not self.counters
+
+        tg_by_email = {client.get("email"): tg_id for tg_id, (item, client) in self.x3.index.clients.items()}
+        now = int(time.time() * 1000)
+        hour, day = now - now % HOUR_MS, now - now % DAY_MS
+        samples = []
+        changed = []
+        seen = set()
+        for item in self.x3.index.inbounds:
+            for stat in item.get("clientStats") or []:
+                email = stat.get("email")
+                if not email or email in seen:
+                    continue
+                seen.add(email)
+                current = (stat.get("up", 0), stat.get("down", 0))
+                previous = self.counters.get(email)
+                if previous == current:
+                    continue
+                changed.append((email, *current))
+                self.counters[email] = current
+                tg_id = tg_by_email.get(email)
+                if baseline or tg_id is None:
+                    continue
+                # Счетчики панели могут быть сброшены, тогда приростом считается текущее значение
+                if previous is None or current[0] < previous[0] or current[1] < previous[1]:
+                    previous = (0, 0)
+                samples.append((tg_id, hour, day, current[0] - previous[0], current[1] - previous[1]))
+
+        removed = self.counters.keys() - seen
+        for email in removed:
+            del self.counters[email]
+        if samples or changed or removed:
+            await db.save_traffic(samples, changed, removed)
+        logger.debug(f"Трафик: записано приростов {len(samples)}, обновлено счетчиков {len(changed)}")
+
+    # Удаление корзин старше срока хранения, не чаще раза в час
+    async def prune(self):
+        now = int(time.time() * 1000)
+        if now - self.pruned_at < HOUR_MS:
+            return
+        await db.prune_traffic(now - TRAFFIC_HOURLY_RETENTION_DAYS * DAY_MS, now - TRAFFIC_DAILY_RETENTION_DAYS * DAY_MS)
+        self.pruned_at = now
+
+    async def run(self):
+        while True:
+            try:
+                await self.collect()
+                await self.prune()
+            except Exception as e:
+                logger.error(f"Ошибка сбора трафика: {e}")
+            await asyncio.sleep(self.interval)
+
+    # Трафик пользователя за последние сутки, неделю и месяц: {период: (up, down)}
+    @staticmethod
+    async def get_user_summary(tg_id):
+        now = int(time.time() * 1000)
+        return {
+            "day": await db.get_user_traffic(tg_id, now - now % HOUR_MS - 23 * HOUR_MS, 'traffic_hourly'),
+            "week": await db.get_user_traffic(tg_id, now - now % DAY_MS - 6 * DAY_MS),
+            "month": await db.get_user_traffic(tg_id, now - now % DAY_MS - 29 * DAY_MS),
+        }
+
+
+def format_bytes(value):
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if value < 1024:
+            return f"{value:.0f} {unit}" if unit == "Б" else f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} ТБ"
+
+
+traffic_collector = TrafficCollector(x3, TRAFFIC_INTERVAL)
\ No newline at end of file
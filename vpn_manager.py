@@ -1,11 +1,21 @@
 # vpn_manager.py
 import os
 import json
+import hashlib
+import time
 import uuid
-import requests
+import random
+import asyncio
+import aiohttp
 from datetime import datetime, timezone
 from loguru import logger
 from dotenv import load_dotenv
+from yarl import URL
+from singleflight import SingleFlight
+from storage import storage, Locks
+from metrics import observe_panel
+from jsonstream import load_stream, CHUNK_SIZE
+from context import Lazy, current
 
 
 load_dotenv()
@@ -15,272 +25,1041 @@ LOGIN = os.getenv("LOGIN")
 PASSWORD = os.getenv("PASSWORD")
 HOST = os.getenv("HOST")
 
-logger.add("logs_manager.log", mode='w', level="DEBUG")
+# Таймаут одного запроса к панели и максимальное число одновременных запросов
+PANEL_TIMEOUT = float(os.getenv("PANEL_TIMEOUT", 10))
+PANEL_MAX_CONNECTIONS = int(os.getenv("PANEL_MAX_CONNECTIONS", 10))
+
+# Повторы идемпотентных запросов и базовая задержка между ними (с экспоненциальным ростом и джиттером)
+PANEL_RETRIES = int(os.getenv("PANEL_RETRIES", 2))
+PANEL_RETRY_BACKOFF = float(os.getenv("PANEL_RETRY_BACKOFF", 0.5))
+# После скольких ошибок подряд панель считается недоступной и на сколько секунд
+PANEL_BREAKER_THRESHOLD = int(os.getenv("PANEL_BREAKER_THRESHOLD", 5))
+PANEL_BREAKER_COOLDOWN = float(os.getenv("PANEL_BREAKER_COOLDOWN", 30))
+
+# Сколько секунд индекс клиентов считается актуальным без повторной загрузки списка инбаундов
+CLIENT_INDEX_TTL = float(os.getenv("CLIENT_INDEX_TTL", 60))
+# Фрагменты msg, с которыми старые версии 3x-ui отвечают 200 {"success": false} на запрос с истекшей
+# сессией ("войдите снова" в разных локализациях панели)
+LOGIN_AGAIN_MESSAGES = ("login again", "log in again", "重新登录", "войдите снова", "войдите заново")
+
+
+# Индекс клиентов панели tgId -> (инбаунд, клиент), строится из одного разбора inbounds/list.
+# Один индекс может собирать клиентов нескольких панелей: каждая панель обновляет только свою часть
+class ClientIndex:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.inbounds = []
+        # имя панели -> ее инбаунды
+        self.by_node = {}
+        self.clients = {}
+        # tg_id -> имя панели, на которой находится клиент
+        self.nodes = {}
+        # (панель, inbound_id) -> (хэш строки settings, список клиентов, остальные поля settings),
+        # чтобы не разбирать неизмененные инбаунды
+        self.parsed = {}
+        self.updated_at = 0.0
+        self.version = 0
+        # Подписчики на изменения: вызываются с {tg_id: клиент или None, если клиент удален}
+        self.listeners = []
+
+    def is_stale(self):
+        return time.monotonic() - self.updated_at > self.ttl
+
+    def invalidate(self):
+        self.updated_at = 0.0
+
+    # Разбирает строку settings инбаунда, если ее хэш изменился с прошлой загрузки. Сама строка
+    # удаляется из инбаунда: в индексе остаются только разобранные клиенты, а не обе копии
+    def decode(self, item, node=None):
+        raw = item.pop("settings", None)
+        if raw is None:
+            return item
+        key = (node, item["id"])
+        digest = hashlib.sha1(raw.encode() if isinstance(raw, str) else raw).hexdigest()
+        cached = self.parsed.get(key)
+        if cached is None or cached[0] != digest:
+            try:
+                settings = json.loads(raw)
+                item_clients = settings.pop("clients", [])
+            except (json.JSONDecodeError, TypeError, AttributeError) as e:
+                logger.error(f"Ошибка декодирования JSON для инбаунда {item['id']}. Ошибка: {e}")
+                settings, item_clients = {}, []
+            self.parsed[key] = (digest, item_clients, settings)
+        return item
+
+    # Строка settings инбаунда с заданным списком клиентов, для обновления инбаунда целиком
+    def settings_with(self, item, clients, node=None):
+        cached = self.parsed.get((node, item["id"]))
+        return json.dumps({**(cached[2] if cached is not None else {}), "clients": clients})
+
+    def rebuild(self, inbounds, node=None):
+        node_clients = {}
+        for item in inbounds:
+            # При потоковой загрузке инбаунды уже разобраны в get_inbounds
+            self.decode(item, node)
+            cached = self.parsed.get((node, item["id"]))
+            item_clients = cached[1] if cached is not None else []
+            for client in item_clients:
+                tg_id = client.get("tgId")
+                if tg_id:
+                    # Как и при линейном поиске, побеждает первое вхождение tgId
+                    node_clients.setdefault(tg_id, (item, client))
+
+        inbound_keys = {(node, item["id"]) for item in inbounds}
+        for key in [key for key in self.parsed if key[0] == node and key not in inbound_keys]:
+            del self.parsed[key]
+
+        previous = {tg_id for tg_id, owner in self.nodes.items() if owner == node}
+        changes = {}
+        for tg_id in previous - node_clients.keys():
+            del self.clients[tg_id]
+            del self.nodes[tg_id]
+            changes[tg_id] = None
+        for tg_id, entry in node_clients.items():
+            owner = self.nodes.get(tg_id, node)
+            if owner != node:
+                continue
+            self.clients[tg_id] = entry
+            self.nodes[tg_id] = node
+            changes[tg_id] = entry[1]
+
+        self.by_node[node] = inbounds
+        self.inbounds = [item for node_inbounds in self.by_node.values() for item in node_inbounds]
+        self.updated_at = time.monotonic()
+        self.version += 1
+        self.notify(changes)
+
+    def notify(self, changes):
+        for listener in self.listeners:
+            listener(changes)
+
+    def get(self, tg_id):
+        return self.clients.get(tg_id)
+
+    def node_of(self, tg_id):
+        return self.nodes.get(tg_id)
+
+    # Клиенты инбаунда по последнему разбору
+    def inbound_clients(self, item, node=None):
+        cached = self.parsed.get((node, item["id"]))
+        return cached[1] if cached is not None else []
+
+    def put(self, item, client, node=None):
+        cached = self.parsed.get((node, item["id"]))
+        if cached is not None:
+            # Новый клиент сразу учитывается в размере инбаунда для размещения, измененный заменяет прежнего
+            item_clients = [c for c in cached[1] if c.get("id") != client["id"]]
+            self.parsed[(node, item["id"])] = (cached[0], item_clients + [client], cached[2])
+        self.clients[client["tgId"]] = (item, client)
+        self.nodes[client["tgId"]] = node
+        self.version += 1
+        self.notify({client["tgId"]: client})
+
+    # Заменяет клиентов одного инбаунда после его обновления целиком; слушатели получают
+    # только действительно изменившихся клиентов
+    def replace_inbound(self, item, clients, node=None):
+        key = (node, item["id"])
+        cached = self.parsed.get(key)
+        self.parsed[key] = (cached[0] if cached is not None else None, clients,
+                            cached[2] if cached is not None else {})
+        changes = {}
+        present = set()
+        for client in clients:
+            tg_id = client.get("tgId")
+            if not tg_id or tg_id in present:
+                continue
+            present.add(tg_id)
+            owner = self.nodes.get(tg_id, node)
+            entry = self.clients.get(tg_id)
+            if owner != node or (entry is not None and entry[0]["id"] != item["id"]):
+                continue
+            if entry is None or entry[1] is not client:
+                self.clients[tg_id] = (item, client)
+                self.nodes[tg_id] = node
+                changes[tg_id] = client
+        for client in cached[1] if cached is not None else []:
+            tg_id = client.get("tgId")
+            entry = self.clients.get(tg_id)
+            if tg_id not in present and entry is not None and entry[1] is client:
+                del self.clients[tg_id]
+                del self.nodes[tg_id]
+                changes[tg_id] = None
+        self.version += 1
+        self.notify(changes)
+
+    def remove(self, tg_id):
+        entry = self.clients.pop(tg_id, None)
+        if entry is not None:
+            item, client = entry
+            node = self.nodes.pop(tg_id, None)
+            cached = self.parsed.get((node, item["id"]))
+            if cached is not None:
+                self.parsed[(node, item["id"])] = (cached[0], [c for c in cached[1] if c.get("id") != client["id"]],
+                                                   cached[2])
+            self.version += 1
+            self.notify({tg_id: None})
+
+
+# Размыкатель цепи: после threshold подряд неудачных запросов панель считается недоступной
+# на cooldown секунд, затем пропускается один пробный запрос
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            # Полуоткрытое состояние: следующая ошибка снова размыкает цепь на cooldown
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.error(f"Панель недоступна после {self.failures} ошибок подряд, "
+                             f"запросы приостановлены на {self.cooldown} с")
+            self.opened_at = time.monotonic()
 
 
 class X3:
-    def __init__(self, login, password, host):
+    def __init__(self, login, password, host, base_path=BASE_PATH, name=None, index=None,
+                 weight=1, inbound_ids=None):
         self.login = login
         self.password = password
         self.host = host
-        self.cookies = {}
-        self.ses = requests.Session()
-        self.login_panel()
-    
-    def get_inbounds(self):
-        headers = {"Accept": "application/json"}
-        response = self.ses.get(f"{self.host}{BASE_PATH}/panel/api/inbounds/list",
-                                headers=headers, cookies=self.cookies, verify=True)
-
-        if response.status_code == 200:
+        self.base_path = base_path or ""
+        # Имя панели в пуле, вес для взвешенного размещения и инбаунды, доступные для новых клиентов
+        self.name = name
+        # Имя панели в ключах общего хранилища
+        self.storage_name = name or host
+        self.weight = weight
+        self.inbound_ids = set(inbound_ids) if inbound_ids else None
+        self.ses = None
+        self.timeout = aiohttp.ClientTimeout(total=PANEL_TIMEOUT)
+        self.semaphore = asyncio.Semaphore(PANEL_MAX_CONNECTIONS)
+        self.session_lock = asyncio.Lock()
+        # Номер текущей сессии: по нему параллельные запросы понимают, что вход уже выполнен заново
+        self.login_generation = 0
+        self.breaker = CircuitBreaker(PANEL_BREAKER_THRESHOLD, PANEL_BREAKER_COOLDOWN)
+        self.index = index if index is not None else ClientIndex(CLIENT_INDEX_TTL)
+        self.index_lock = asyncio.Lock()
+        # Одиночные операции блокируют свой инбаунд, пакетные обновляют инбаунды целиком под блокировкой
+        self.inbound_locks = Locks(storage, f"inbound:{self.storage_name}")
+        # inbound_id -> (хэш настроек, шаблон ссылки)
+        self.link_templates = {}
+
+    # Сессия создается при первом запросе: в __init__ еще нет запущенного event loop
+    async def get_session(self):
+        async with self.session_lock:
+            if self.ses is None or self.ses.closed:
+                connector = aiohttp.TCPConnector(limit=PANEL_MAX_CONNECTIONS, keepalive_timeout=30)
+                # unsafe=True нужен, чтобы сохранялись cookie панели, доступной по IP
+                self.ses = aiohttp.ClientSession(
+                    connector=connector,
+                    timeout=self.timeout,
+                    cookie_jar=aiohttp.CookieJar(unsafe=True),
+                    headers={"Accept": "application/json"}
+                )
+                if not await self.adopt_shared_session():
+                    await self.login_shared()
+        return self.ses
+
+    async def close(self):
+        if self.ses is not None and not self.ses.closed:
+            await self.ses.close()
+
+    # Один запрос к панели без повторов, возвращает статус и декодированный JSON.
+    # parse(response) заменяет разбор всего тела, например на потоковый
+    async def send(self, method, path, parse=None, **kwargs):
+        try:
+            ses = await self.get_session()
+            async with self.semaphore:
+                async with ses.request(method, f"{self.host}{self.base_path}{path}", **kwargs) as response:
+                    if parse is not None:
+                        try:
+                            return response.status, await parse(response)
+                        except ValueError as e:
+                            logger.error(f"Ошибка декодирования JSON: {e}")
+                            return response.status, None
+                    text = await response.text()
+                    try:
+                        return response.status, json.loads(text)
+                    except json.JSONDecodeError:
+                        logger.error(f"Ошибка декодирования JSON: {text[:200]}")
+                        return response.status, None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+            logger.error(f"Ошибка запроса к панели {method} {path}: {e!r}")
+            return None, None
+
+    # Истекшая сессия: в зависимости от версии 3x-ui панель отвечает 401/404, редиректит
+    # на HTML-страницу входа (после редиректа это 200 без JSON) или, в старых версиях, возвращает
+    # {"success": false} с просьбой войти снова. Остальные {"success": false} - отказ самой операции
+    # (например, повторяющийся email), он возвращается вызывающему без повторного входа
+    @staticmethod
+    def session_expired(status, data):
+        if status in (401, 404):
+            return True
+        if status != 200:
+            return False
+        if data is None:
+            return True
+        if isinstance(data, dict) and data.get("success") is False:
+            msg = str(data.get("msg") or "").lower()
+            return any(fragment in msg for fragment in LOGIN_AGAIN_MESSAGES)
+        return False
+
+    async def relogin(self, generation):
+        async with self.session_lock:
+            # Пока ждали блокировку, сессию мог обновить параллельный запрос
+            if self.login_generation != generation or self.ses is None or self.ses.closed:
+                return True
+            logger.info("Сессия панели истекла, выполняется повторный вход")
             try:
-                inbounds = response.json().get('obj', [])
-                return inbounds
-            except json.JSONDecodeError:
-                logger.error(f"Ошибка декодирования JSON: {response.text}")
-                return []
+                await self.login_shared()
+                return True
+            except ConnectionError as e:
+                logger.error(f"Ошибка повторного входа в панель: {e}")
+                return False
+
+    # Выполняет запрос к панели: повторный вход при истекшей сессии, повторы с джиттером для
+    # идемпотентных GET-запросов и быстрый отказ, пока панель считается недоступной
+    async def request(self, method, path, **kwargs):
+        retries = PANEL_RETRIES if method == "GET" else 0
+        status, data = None, None
+        for attempt in range(retries + 1):
+            if not self.breaker.allow():
+                logger.error(f"Панель {self.name or self.host} недоступна, запрос {method} {path} отклонен")
+                return None, None
+
+            generation = self.login_generation
+            status, data = await self.send(method, path, **kwargs)
+            if self.session_expired(status, data):
+                # Запрос отклонен из-за авторизации и не был применен, поэтому повтор безопасен и для POST
+                if await self.relogin(generation):
+                    status, data = await self.send(method, path, **kwargs)
+                # Вход не помог: панель отвечает, но запрос не выполнен, это не успех для размыкателя
+                if self.session_expired(status, data):
+                    return status, data
+
+            if status is None or status >= 500:
+                self.breaker.record_failure()
+                if attempt < retries:
+                    await asyncio.sleep(random.uniform(0, PANEL_RETRY_BACKOFF * 2 ** attempt))
+                continue
+            self.breaker.record_success()
+            return status, data
+        return status, data
+
+    # Список читается потоком: каждый инбаунд разбирается сразу по мере получения
+    async def read_inbounds(self, response):
+        return await load_stream(response.content.iter_chunked(CHUNK_SIZE), "obj",
+                                 lambda item: self.index.decode(item, self.name))
+
+    @observe_panel
+    async def get_inbounds(self):
+        status, data = await self.request("GET", "/panel/api/inbounds/list", parse=self.read_inbounds)
+
+        if status == 200 and data is not None and data.get('success', True):
+            inbounds = data.get('obj') or []
+            # Каждая полная загрузка списка заодно обновляет индекс клиентов
+            self.index.rebuild(inbounds, self.name)
+            if storage.shared:
+                await self.publish_index(inbounds)
+            return inbounds
         else:
-            logger.error(f"Ошибка получения инбаундов. Статус: {response.status_code}, Ответ: {response.text}")
+            logger.error(f"Ошибка получения инбаундов. Статус: {status}, Ответ: {data}")
             return []
 
+    # Перезагружает индекс, если он устарел; параллельные вызовы ждут одну загрузку
+    async def refresh_index(self, force=False):
+        if not force and not self.index.is_stale():
+            return
+        async with self.index_lock:
+            if force or self.index.is_stale():
+                await self.fetch_index(force)
+
+    # Загрузка списка для индекса. С общим хранилищем сначала берется свежий снимок, сохраненный
+    # другим экземпляром, а из панели список в одно время загружает только один экземпляр
+    async def fetch_index(self, force=False):
+        if not storage.shared:
+            await self.get_inbounds()
+            return
+        if not force and await self.load_shared_index():
+            return
+        async with storage.lock(f"x3:refresh:{self.storage_name}"):
+            if not force and await self.load_shared_index():
+                return
+            await self.get_inbounds()
+
+    async def load_shared_index(self):
+        raw = await storage.get(f"x3:inbounds:{self.storage_name}")
+        if not raw:
+            return False
+        snapshot = json.loads(raw)
+        age = time.time() - snapshot["at"]
+        if age > self.index.ttl:
+            return False
+        self.index.rebuild(snapshot["obj"], self.name)
+        # Возраст индекса считается от загрузки снимка из панели, а не от чтения из хранилища
+        self.index.updated_at = time.monotonic() - age
+        return True
+
+    async def publish_index(self, inbounds):
+        obj = [{**item, "settings": self.index.settings_with(item, self.index.inbound_clients(item, self.name),
+                                                              self.name)}
+               for item in inbounds]
+        await storage.set(f"x3:inbounds:{self.storage_name}", json.dumps({"at": time.time(), "obj": obj}),
+                          ttl=self.index.ttl)
+
+    # После изменения клиентов снимок в общем хранилище устарел: следующий экземпляр загрузит список заново
+    async def index_changed(self):
+        if storage.shared:
+            await storage.delete(f"x3:inbounds:{self.storage_name}")
+
+    # Вход в панель. С общим хранилищем входит один экземпляр, остальные берут его куки сессии
+    async def login_shared(self):
+        if not storage.shared:
+            await self.login_panel()
+            return
+        async with storage.lock(f"x3:login:{self.storage_name}"):
+            if await self.adopt_shared_session():
+                return
+            await self.login_panel()
+            cookies = self.ses.cookie_jar.filter_cookies(URL(self.host))
+            await storage.set(f"x3:session:{self.storage_name}",
+                              json.dumps({name: morsel.value for name, morsel in cookies.items()}))
+
+    # Берет куки сессии из общего хранилища, если они отличаются от текущих
+    async def adopt_shared_session(self):
+        if not storage.shared:
+            return False
+        raw = await storage.get(f"x3:session:{self.storage_name}")
+        if not raw:
+            return False
+        cookies = json.loads(raw)
+        current = self.ses.cookie_jar.filter_cookies(URL(self.host))
+        if cookies == {name: morsel.value for name, morsel in current.items()}:
+            return False
+        self.ses.cookie_jar.update_cookies(cookies, URL(self.host))
+        self.login_generation += 1
+        logger.info(f"Сессия панели {self.storage_name} получена из общего хранилища")
+        return True
+
+    # Возвращает (инбаунд, клиент) по tg_id из индекса
+    async def get_client(self, tg_id):
+        await self.refresh_index()
+        return self.index.get(tg_id)
+
     # Метод для авторизации
-    def login_panel(self):
+    @observe_panel
+    async def login_panel(self):
         data = {
             "username": self.login,
             "password": self.password
         }
-        response = self.ses.post(f"{self.host}{BASE_PATH}/login", data=data, verify=True)
-        if response.status_code == 200 and response.json().get("success"):
-            self.cookies = response.cookies
-            logger.info("Успешный вход в систему!")
-        else:
-            raise ConnectionError("Ошибка входа. Проверьте логин и пароль.")
+        try:
+            async with self.ses.post(f"{self.host}{self.base_path}/login", data=data) as response:
+                result = await response.json(content_type=None)
+                if response.status == 200 and result.get("success"):
+                    self.login_generation += 1
+                    logger.info("Успешный вход в систему!")
+                    return
+        except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as e:
+            logger.error(f"Ошибка соединения с панелью при входе: {e!r}")
+        await self.ses.close()
+        raise ConnectionError("Ошибка входа. Проверьте логин и пароль.")
 
-    # Метод добавления клиента
-    def add_client(self, day, tg_id, user_id):
+    @staticmethod
+    def make_client(day, tg_id, user_id):
         epoch = datetime.fromtimestamp(0, timezone.utc)
         x_time = int((datetime.now(timezone.utc) - epoch).total_seconds() * 1000.0)
         x_time += 86400000 * day
+        return {
+            "id": str(uuid.uuid1()),
+            "alterId": 90,
+            "email": user_id,
+            "limitIp": 3,
+            "totalGB": 0,
+            "expiryTime": x_time,
+            "flow": 'xtls-rprx-vision',
+            "enable": True,
+            "tgId": tg_id,
+            "subId": ""
+        }
 
-        inbounds = self.get_inbounds()
-        if not inbounds:
-            logger.error("Нет доступных инбаундов для добавления клиента.")
-            return None
-
-        inbound_id = inbounds[0]["id"]
+    # Метод добавления клиента
+    @observe_panel
+    async def add_client(self, day, tg_id, user_id, inbound=None):
+        if inbound is None:
+            await self.refresh_index()
+            inbounds = self.index.by_node.get(self.name)
+            if not inbounds:
+                logger.error("Нет доступных инбаундов для добавления клиента.")
+                return None
+            inbound = inbounds[0]
 
-        headers = {"Accept": "application/json"}
+        client = self.make_client(day, tg_id, user_id)
         data1 = {
-            "id": inbound_id,
-            "settings": json.dumps({
-                "clients": [
-                    {
-                        "id": str(uuid.uuid1()),
-                        "alterId": 90,
-                        "email": user_id,
-                        "limitIp": 3,
-                        "totalGB": 0,
-                        "expiryTime": x_time,
-                        "flow": 'xtls-rprx-vision',
-                        "enable": True,
-                        "tgId": tg_id,
-                        "subId": ""
-                    }
-                ]
-            })
+            "id": inbound["id"],
+            "settings": json.dumps({"clients": [client]})
         }
 
-        response = self.ses.post(
-            f"{self.host}{BASE_PATH}/panel/api/inbounds/addClient",
-            headers=headers,
-            json=data1,
-            cookies=self.cookies,
-            verify=True
-        )
-
-        logger.debug(f"Ответ сервера при добавлении клиента: {response.json()}")
+        async with self.inbound_locks.hold(inbound["id"]):
+            status, result = await self.request("POST", "/panel/api/inbounds/addClient", json=data1)
 
-        if response.status_code == 200 and response.json().get("success"):
-            client_link = self.find_client_by_tg_id(tg_id)
-            if client_link:
-                logger.info(f"Ссылка для клиента с tg_id {tg_id} отправлена")
-                return client_link
-            else:
-                logger.error(f"Клиент с tg_id {tg_id} не найден после добавления.")
-                return None
+        if status == 200 and result and result.get("success"):
+            self.index.put(inbound, client, self.name)
+            await self.index_changed()
+            logger.info(f"Ссылка для клиента с tg_id {tg_id} отправлена")
+            return self.build_client_link(inbound, client)
         else:
-            logger.error(f"Ошибка добавления клиента: {response.json()}")
+            logger.error(f"Ошибка добавления клиента: {result}")
             return None
 
     # Метод обновления подписки
-    def renew_subscribe(self, day, tg_id):
-        inbounds = self.get_inbounds()
+    @observe_panel
+    async def renew_subscribe(self, day, tg_id):
+        entry = await self.get_client(tg_id)
+        if entry is None:
+            logger.debug(f"Клиент с tg_id {tg_id} не найден для обновления.")
+            return False
+        item, client = entry
+        # Новое время истечения срока: к текущему добавляются дополнительные дни
+        return await self.update_expiry(item, client, tg_id, client["expiryTime"] + day * 86400000)
 
-        for item in inbounds:
-            try:
-                settings = json.loads(item["settings"])
-
-                for client in settings["clients"]:
-                    if client.get("tgId") == tg_id:
-                        # Получаем текущее время истечения срока
-                        current_expiry_time = client["expiryTime"]
-                        client_id = client["id"]
-
-                        # Вычисляем новое время истечения срока, добавляя дополнительные дни
-                        new_expiry_time = current_expiry_time + day * 86400000
-
-                        # Обновляем время истечения срока
-                        client["expiryTime"] = new_expiry_time
-
-                        # Подготавливаем данные для отправки на сервер
-                        headers = {"Accept": "application/json"}
-                        data = {
-                            "id": item["id"],
-                            "client_id": client_id,
-                            "settings": json.dumps({
-                                "clients": [
-                                    {
-                                        "id": client_id,
-                                        "tgId": tg_id,
-                                        "expiryTime": new_expiry_time,
-                                        "email": client["email"],
-                                        "enable": client.get("enable", True),
-                                        "totalGB": client.get("totalGB", 0),
-                                        "reset": client.get("reset", 0),
-                                        "limitIp": client.get("limitIp", 3),
-                                        "flow": client.get("flow", "")
-                                    }
-                                ]
-                            })
+    # Устанавливает абсолютный срок окончания. Повторный вызов с тем же сроком не меняет клиента,
+    # поэтому его можно безопасно повторять после сбоя
+    @observe_panel
+    async def set_expiry(self, tg_id, expiry_time):
+        entry = await self.get_client(tg_id)
+        if entry is None:
+            logger.debug(f"Клиент с tg_id {tg_id} не найден для обновления.")
+            return False
+        item, client = entry
+        if client.get("expiryTime") == expiry_time:
+            logger.debug(f"Срок клиента с tg_id {tg_id} уже установлен.")
+            return True
+        return await self.update_expiry(item, client, tg_id, expiry_time)
+
+    async def update_expiry(self, item, client, tg_id, new_expiry_time):
+        try:
+            client_id = client["id"]
+
+            # Подготавливаем данные для отправки на сервер
+            data = {
+                "id": item["id"],
+                "client_id": client_id,
+                "settings": json.dumps({
+                    "clients": [
+                        {
+                            "id": client_id,
+                            "tgId": tg_id,
+                            "expiryTime": new_expiry_time,
+                            "email": client["email"],
+                            "enable": client.get("enable", True),
+                            "totalGB": client.get("totalGB", 0),
+                            "reset": client.get("reset", 0),
+                            "limitIp": client.get("limitIp", 3),
+                            "flow": client.get("flow", "")
                         }
+                    ]
+                })
+            }
 
-                        response = self.ses.post(
-                            f"{self.host}{BASE_PATH}/panel/api/inbounds/updateClient/{client_id}",
-                            headers=headers,
-                            json=data,
-                            cookies=self.cookies,
-                            verify=True
-                        )
-
-                        if response.status_code == 200 and response.json().get("success"):
-                            logger.info(f"Время истечения срока действия клиента с tg_id {tg_id} успешно обновлено.")
-                            return True
-                        else:
-                            logger.error(client_id)
-                            logger.error(f"Ошибка обновления клиента с tg_id {tg_id}: {response.json()}")
-                            return False
-            except json.JSONDecodeError as e:
-                logger.error(f"Ошибка декодирования JSON для item: {item}. Ошибка: {e}")
-            except Exception as e:
-                logger.error(f"Ошибка при обновлении времени истечения для клиента с tg_id {tg_id}: {e}")
-
-        logger.debug(f"Клиент с tg_id {tg_id} не найден для обновления.")
-        return False
+            async with self.inbound_locks.hold(item["id"]):
+                status, result = await self.request(
+                    "POST", f"/panel/api/inbounds/updateClient/{client_id}", json=data
+                )
+
+            if status == 200 and result and result.get("success"):
+                # Обновляем индекс, не дожидаясь следующей загрузки списка
+                self.index.put(item, {**client, "expiryTime": new_expiry_time}, self.name)
+                await self.index_changed()
+                logger.info(f"Время истечения срока действия клиента с tg_id {tg_id} успешно обновлено.")
+                return True
+            else:
+                self.index.invalidate()
+                await self.index_changed()
+                logger.error(client_id)
+                logger.error(f"Ошибка обновления клиента с tg_id {tg_id}: {result}")
+                return False
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении времени истечения для клиента с tg_id {tg_id}: {e}")
+            return False
+
+    # Часть vless-ссылки, общая для всех клиентов инбаунда. Пересобирается только
+    # при изменении хэша порта и streamSettings инбаунда
+    def get_link_template(self, item):
+        stream_settings = item["streamSettings"]
+        raw = stream_settings if isinstance(stream_settings, str) else json.dumps(stream_settings, sort_keys=True)
+        settings_hash = hashlib.sha1(f"{item['port']}:{raw}".encode()).hexdigest()
+        cached = self.link_templates.get(item["id"])
+        if cached is not None and cached[0] == settings_hash:
+            return cached[1]
+
+        host = self.host.replace("https://", "")
+        port = item["port"]
+
+        # Safeguard: Ensure streamSettings is a dict
+        stream_settings = json.loads(stream_settings)\
+            if isinstance(stream_settings, str)\
+            else stream_settings
+        security = stream_settings.get("security", "")
+
+        # Ensure realitySettings is properly parsed
+        reality_settings = json.loads(stream_settings["realitySettings"])\
+            if isinstance(stream_settings["realitySettings"], str)\
+            else stream_settings["realitySettings"]
+        public_key = reality_settings.get("settings", {}).get("publicKey")
+        server_name = reality_settings.get("serverNames", [""])[0]
+        short_id = reality_settings.get("shortIds", [""])[0]
+
+        template = (f"@{host}:{port}?type=tcp&security={security}&pbk={public_key}"
+                    f"&fp=chrome&sni={server_name}&sid={short_id}&flow=")
+        self.link_templates[item["id"]] = (settings_hash, template)
+        return template
+
+    # Формирует vless-ссылку клиента по данным инбаунда
+    def build_client_link(self, item, client):
+        # Correctly format the client link
+        return f"vless://{client['id']}{self.get_link_template(item)}{client['flow']}#hrvpn-{client['email']}"
 
     # Метод для поиска клиента по tg_id
-    def find_client_by_tg_id(self, tg_id):
-        inbounds = self.get_inbounds()
+    async def find_client_by_tg_id(self, tg_id):
+        entry = await self.get_client(tg_id)
+        if entry is None:
+            logger.debug(f"Клиент с tg_id {tg_id} не найден.")
+            return None
 
-        for item in inbounds:
-            try:
-                settings = json.loads(item["settings"])
-
-                # Ищем клиента по tg_id
-                for client in settings["clients"]:
-                    if client.get("tgId") == tg_id:
-                        # Формируем ссылку для клиента
-                        client_id = client["id"]
-                        email = client["email"]
-                        host = self.host.replace("https://", "")
-                        port = item["port"]
-                        flow = client["flow"]
-
-                        # Safeguard: Ensure streamSettings is a dict
-                        stream_settings = json.loads(item["streamSettings"])\
-                            if isinstance(item["streamSettings"], str)\
-                            else item["streamSettings"]
-                        security = stream_settings.get("security", "")
-
-                        # Ensure realitySettings is properly parsed
-                        reality_settings = json.loads(stream_settings["realitySettings"])\
-                            if isinstance(stream_settings["realitySettings"], str)\
-                            else stream_settings["realitySettings"]
-                        public_key = reality_settings.get("settings", {}).get("publicKey")
-                        server_name = reality_settings.get("serverNames", [""])[0]
-                        short_id = reality_settings.get("shortIds", [""])[0]
-
-
-                        # Correctly format the client link
-                        client_link = (f"vless://{client_id}@{host}:{port}?type=tcp&security={security}&pbk={public_key}"
-                                       f"&fp=chrome&sni={server_name}&sid={short_id}&flow={flow}#hrvpn-{email}")
-
-                        # Log the correct VLESS link
-                        logger.info(f"Найдена ссылка для клиента: {tg_id}")
-                        return client_link  # Возвращаем ссылку клиента
-
-            except json.JSONDecodeError as e:
-                logger.error(f"Ошибка декодирования JSON для item: {item}. Ошибка: {e}")
-            except Exception as e:
-                logger.error(f"Ошибка при обработке клиента с tg_id {tg_id}: {e}")
-
-        logger.debug(f"Клиент с tg_id {tg_id} не найден.")
+        item, client = entry
+        try:
+            client_link = self.build_client_link(item, client)
+            logger.debug(f"Найдена ссылка для клиента: {tg_id}")
+            return client_link  # Возвращаем ссылку клиента
+        except json.JSONDecodeError as e:
+            logger.error(f"Ошибка декодирования JSON для item: {item}. Ошибка: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка при обработке клиента с tg_id {tg_id}: {e}")
         return None
 
     # Метод удаления клиента
-    def delete_client(self, tg_id):
-        inbounds = self.get_inbounds()
-        inbound_id = inbounds[0]['id']
-        for item in inbounds:
-            try:
-                settings = json.loads(item["settings"])
-                for client in settings["clients"]:
-                    if client.get("tgId") == tg_id:
-                        client_id = client["id"]
-                        response = self.ses.post(
-                            f"{self.host}{BASE_PATH}/panel/api/inbounds/{inbound_id}/delClient/{client_id}",
-                            headers={"Accept": "application/json"},
-                            cookies=self.cookies,
-                            verify=True
-                        )
-                        if response.status_code == 200 and response.json().get("success"):
-                            logger.info(f"Ключ клиента с tg_id {tg_id} успешно удален.")
-                            return True
-                        else:
-                            logger.error(client_id)
-                            logger.error(f"Ошибка удаления ключа клиента с tg_id {tg_id}: {response.json()}")
-                            return False
-            except json.JSONDecodeError as e:
-                logger.error(f"Ошибка декодирования JSON для item: {item}. Ошибка: {e}")
-            except Exception as e:
-                logger.error(f"Ошибка при удалении ключа для клиента с tg_id {tg_id}: {e}")
-
-        logger.debug(f"Клиент с tg_id {tg_id} не найден для удаления.")
+    @observe_panel
+    async def delete_client(self, tg_id):
+        entry = await self.get_client(tg_id)
+        if entry is None:
+            logger.debug(f"Клиент с tg_id {tg_id} не найден для удаления.")
+            return False
+
+        item, client = entry
+        client_id = client["id"]
+        # Клиент удаляется из того инбаунда, в котором он найден
+        async with self.inbound_locks.hold(item["id"]):
+            status, result = await self.request(
+                "POST", f"/panel/api/inbounds/{item['id']}/delClient/{client_id}"
+            )
+        if status == 200 and result and result.get("success"):
+            self.index.remove(tg_id)
+            await self.index_changed()
+            logger.info(f"Ключ клиента с tg_id {tg_id} успешно удален.")
+            return True
+        else:
+            self.index.invalidate()
+            await self.index_changed()
+            logger.error(client_id)
+            logger.error(f"Ошибка удаления ключа клиента с tg_id {tg_id}: {result}")
+            return False
+
+    # Пакетное добавление в один инбаунд одним запросом: addClient принимает список клиентов.
+    # entries: [(day, tg_id, user_id)], возвращает {tg_id: ссылка}
+    @observe_panel
+    async def add_clients(self, entries, inbound):
+        clients = [self.make_client(day, tg_id, user_id) for day, tg_id, user_id in entries]
+        data = {
+            "id": inbound["id"],
+            "settings": json.dumps({"clients": clients})
+        }
+        async with self.inbound_locks.hold(inbound["id"]):
+            status, result = await self.request("POST", "/panel/api/inbounds/addClient", json=data)
+            if not (status == 200 and result and result.get("success")):
+                self.index.invalidate()
+                await self.index_changed()
+                logger.error(f"Ошибка пакетного добавления {len(clients)} клиентов в инбаунд {inbound['id']}: {result}")
+                return {}
+            self.index.replace_inbound(inbound, self.index.inbound_clients(inbound, self.name) + clients, self.name)
+            await self.index_changed()
+        logger.info(f"В инбаунд {inbound['id']} добавлено клиентов: {len(clients)}")
+        return {client["tgId"]: self.build_client_link(inbound, client) for client in clients}
+
+    # Обновляет инбаунд целиком с новым списком клиентов: один запрос вместо запроса на каждого клиента.
+    # Вызывается под блокировкой инбаунда, клиенты берутся из только что загруженного списка
+    async def update_inbound(self, item, clients):
+        data = {key: value for key, value in item.items() if key != "clientStats"}
+        data["settings"] = self.index.settings_with(item, clients, self.name)
+        status, result = await self.request("POST", f"/panel/api/inbounds/update/{item['id']}", json=data)
+        if status == 200 and result and result.get("success"):
+            self.index.replace_inbound(item, clients, self.name)
+            await self.index_changed()
+            return True
+        self.index.invalidate()
+        await self.index_changed()
+        logger.error(f"Ошибка обновления инбаунда {item['id']}: {result}")
         return False
 
+    # Для пакетного изменения: блокирует все инбаунды панели, загружает свежий список и применяет
+    # change(клиенты инбаунда, {id клиента: tg_id}) к каждому затронутому инбаунду. Возвращает
+    # tg_id клиентов, чьи инбаунды обновлены успешно
+    async def update_many(self, tg_ids, change):
+        tg_ids = set(tg_ids)
+        while True:
+            held = {item["id"] for item in self.index.by_node.get(self.name, [])}
+            async with self.inbound_locks.hold_many(held):
+                await self.refresh_index(force=True)
+                # Список инбаундов до загрузки мог устареть (или еще не загружаться): если появились
+                # инбаунды без блокировки, блокировки берутся заново по свежему списку
+                if {item["id"] for item in self.index.by_node.get(self.name, [])} - held:
+                    continue
+                groups = {}
+                for tg_id in tg_ids:
+                    entry = self.index.get(tg_id)
+                    if entry is None or self.index.node_of(tg_id) != self.name:
+                        continue
+                    item, client = entry
+                    groups.setdefault(item["id"], (item, {}))[1][client["id"]] = tg_id
+                updated = set()
+                results = await asyncio.gather(*(
+                    self.update_inbound(item, change(self.index.inbound_clients(item, self.name), targets))
+                    for item, targets in groups.values()
+                ))
+                for (item, targets), ok in zip(groups.values(), results):
+                    if ok:
+                        updated.update(targets.values())
+                return updated
+
+    # Продление многих клиентов: один запрос на инбаунд
+    @observe_panel
+    async def renew_many(self, day, tg_ids):
+        def change(clients, targets):
+            return [{**c, "expiryTime": c.get("expiryTime", 0) + day * 86400000} if c.get("id") in targets else c
+                    for c in clients]
+        renewed = await self.update_many(tg_ids, change)
+        logger.info(f"Продлено клиентов: {len(renewed)}")
+        return renewed
+
+    # Удаление многих клиентов: один запрос на инбаунд
+    @observe_panel
+    async def delete_many(self, tg_ids):
+        def change(clients, targets):
+            return [c for c in clients if c.get("id") not in targets]
+        deleted = await self.update_many(tg_ids, change)
+        logger.info(f"Удалено клиентов: {len(deleted)}")
+        return deleted
+
+    # Установка одного срока окончания многим клиентам: один запрос на инбаунд
+    @observe_panel
+    async def set_expiry_many(self, expiry_time, tg_ids):
+        def change(clients, targets):
+            return [{**c, "expiryTime": expiry_time} if c.get("id") in targets else c for c in clients]
+        updated = await self.update_many(tg_ids, change)
+        logger.info(f"Срок окончания изменен у клиентов: {len(updated)}")
+        return updated
+
     # Метод для поиска даты окончания подписки по tg_id
-    def find_expirytime_by_tg_id(self, tg_id):
-        inbounds = self.get_inbounds()
+    async def find_expirytime_by_tg_id(self, tg_id):
+        entry = await self.get_client(tg_id)
+        if entry is None:
+            logger.debug(f"Клиент с tg_id {tg_id} не найден.")
+            return None
+        return entry[1].get("expiryTime")
 
-        for item in inbounds:
-            try:
-                settings = json.loads(item["settings"])
 
-                # Ищем клиента по tg_id
-                for client in settings["clients"]:
-                    if client.get("tgId") == tg_id:
-                        time_left = client["expiryTime"]
-                        return time_left
+# Кандидат для размещения нового клиента: инбаунд на одной из панелей пула
+class Placement:
+    def __init__(self, node, item, clients, traffic):
+        self.node = node
+        self.item = item
+        self.clients = clients
+        # Трафик инбаунда (up + down по clientStats) с предыдущей загрузки списка
+        self.traffic = traffic
 
-            except Exception as e:
-                logger.error(f"Ошибка при обработке клиента с tg_id {tg_id}: {e}")
 
-        logger.debug(f"Клиент с tg_id {tg_id} не найден.")
-        return None
+def least_clients_strategy(candidates):
+    return min(candidates, key=lambda c: c.clients)
+
+
+def least_traffic_strategy(candidates):
+    return min(candidates, key=lambda c: (c.traffic, c.clients))
+
+
+# Наименьшая загрузка относительно веса панели: панель с весом 2 получает вдвое больше клиентов
+def weighted_strategy(candidates):
+    return min(candidates, key=lambda c: c.clients / max(c.node.weight, 0.001))
+
+
+PLACEMENT_STRATEGIES = {
+    "least_clients": least_clients_strategy,
+    "least_traffic": least_traffic_strategy,
+    "weighted": weighted_strategy,
+}
+
+
+# Пул панелей 3x-ui с общим индексом клиентов. Повторяет интерфейс X3: запросы по tg_id
+# направляются на панель, где находится клиент, новые клиенты размещаются выбранной стратегией
+class X3Pool:
+    def __init__(self, nodes, strategy=least_clients_strategy, index=None):
+        self.index = index if index is not None else ClientIndex(CLIENT_INDEX_TTL)
+        self.nodes = {}
+        for node in nodes:
+            node.index = self.index
+            self.nodes[node.name] = node
+        self.strategy = strategy
+        self.index_lock = asyncio.Lock()
+        # Одновременные поиски одного tg_id делят один запрос, изменения клиента идут по очереди
+        self.flights = SingleFlight()
+        self.user_locks = Locks(storage, "user")
+        # (панель, inbound_id) -> (суммарный трафик, прирост с прошлой загрузки)
+        self.traffic = {}
+
+    async def close(self):
+        await asyncio.gather(*(node.close() for node in self.nodes.values()))
+
+    def node_for(self, tg_id):
+        return self.nodes.get(self.index.node_of(tg_id))
+
+    def update_traffic(self):
+        for node in self.nodes.values():
+            for item in self.index.by_node.get(node.name, []):
+                total = sum(stat.get("up", 0) + stat.get("down", 0) for stat in item.get("clientStats") or [])
+                previous = self.traffic.get((node.name, item["id"]))
+                # Счетчики панели могут быть сброшены, тогда приростом считается текущее значение
+                delta = total - previous[0] if previous is not None and total >= previous[0] else total
+                self.traffic[(node.name, item["id"])] = (total, delta)
+
+    async def get_inbounds(self):
+        await asyncio.gather(*(node.get_inbounds() for node in self.nodes.values()))
+        self.update_traffic()
+        return self.index.inbounds
+
+    async def refresh_index(self, force=False):
+        if not force and not self.index.is_stale():
+            return
+        async with self.index_lock:
+            if force or self.index.is_stale():
+                await asyncio.gather(*(node.fetch_index(force) for node in self.nodes.values()))
+                self.update_traffic()
+
+    async def get_client(self, tg_id):
+        await self.refresh_index()
+        return self.index.get(tg_id)
+
+    # Индекс для проверки под блокировкой пользователя. С общим хранилищем другой экземпляр мог
+    # изменить клиента после загрузки локального индекса, поэтому список загружается из панели заново
+    async def sync_index(self):
+        await self.refresh_index(force=storage.shared)
+
+    def placements(self):
+        candidates = []
+        for node in self.nodes.values():
+            for item in self.index.by_node.get(node.name, []):
+                if not item.get("enable", True):
+                    continue
+                if node.inbound_ids is not None and item["id"] not in node.inbound_ids:
+                    continue
+                traffic = self.traffic.get((node.name, item["id"]), (0, 0))[1]
+                candidates.append(Placement(node, item, len(self.index.inbound_clients(item, node.name)), traffic))
+        return candidates
+
+    async def add_client(self, day, tg_id, user_id):
+        async with self.user_locks.hold(tg_id):
+            return await self.place_client(day, tg_id, user_id)
+
+    async def place_client(self, day, tg_id, user_id):
+        await self.refresh_index()
+        candidates = self.placements()
+        if not candidates:
+            logger.error("Нет доступных инбаундов для добавления клиента.")
+            return None
+        placement = self.strategy(candidates)
+        logger.debug(f"Клиент {tg_id} размещается на панели {placement.node.name}, инбаунд {placement.item['id']}")
+        return await placement.node.add_client(day, tg_id, user_id, inbound=placement.item)
+
+    # Добавляет клиента, только если у tg_id еще нет ключа. Проверка и добавление выполняются
+    # под блокировкой пользователя, поэтому повторные нажатия не создают второй ключ.
+    # Возвращает (ссылка, создан ли новый ключ)
+    async def add_client_if_absent(self, day, tg_id, user_id):
+        async with self.user_locks.hold(tg_id):
+            await self.sync_index()
+            existing = await self.lookup_client_link(tg_id)
+            if existing:
+                return existing, False
+            return await self.place_client(day, tg_id, user_id), True
+
+    async def renew_subscribe(self, day, tg_id):
+        async with self.user_locks.hold(tg_id):
+            await self.refresh_index()
+            node = self.node_for(tg_id)
+            if node is None:
+                logger.debug(f"Клиент с tg_id {tg_id} не найден для обновления.")
+                return False
+            return await node.renew_subscribe(day, tg_id)
+
+    # Продление, которое можно повторять: срок окончания вычисляется один раз, сохраняется через
+    # save до запроса к панели и при повторе берется готовым (target) и применяется как абсолютный
+    async def renew_to(self, day, tg_id, target, save):
+        async with self.user_locks.hold(tg_id):
+            await self.sync_index()
+            node = self.node_for(tg_id)
+            if node is None:
+                logger.debug(f"Клиент с tg_id {tg_id} не найден для обновления.")
+                return False
+            if target is None:
+                target = self.index.get(tg_id)[1]["expiryTime"] + day * 86400000
+                await save(target)
+            return await node.set_expiry(tg_id, target)
+
+    async def set_expiry(self, tg_id, expiry_time):
+        async with self.user_locks.hold(tg_id):
+            await self.refresh_index()
+            node = self.node_for(tg_id)
+            if node is None:
+                logger.debug(f"Клиент с tg_id {tg_id} не найден для обновления.")
+                return False
+            return await node.set_expiry(tg_id, expiry_time)
+
+    async def delete_client(self, tg_id):
+        async with self.user_locks.hold(tg_id):
+            await self.refresh_index()
+            node = self.node_for(tg_id)
+            if node is None:
+                logger.debug(f"Клиент с tg_id {tg_id} не найден для удаления.")
+                return False
+            return await node.delete_client(tg_id)
+
+    # Пакетное добавление: клиенты распределяются стратегией и добавляются одним запросом на инбаунд.
+    # entries: [(day, tg_id, user_id)], возвращает {tg_id: ссылка} для добавленных клиентов
+    async def add_clients(self, entries):
+        async with self.user_locks.hold_many(tg_id for _, tg_id, _ in entries):
+            return await self.place_clients(entries)
+
+    # Пакетный вариант add_client_if_absent: повторы tg_id отбрасываются, проверка существующих
+    # ключей и добавление выполняются под блокировками пользователей. Возвращает
+    # ({tg_id: ссылка} для добавленных, tg_id, у которых ключ уже был)
+    async def add_clients_if_absent(self, entries):
+        unique = {}
+        for entry in entries:
+            unique.setdefault(entry[1], entry)
+        async with self.user_locks.hold_many(unique):
+            await self.sync_index()
+            existing = {tg_id for tg_id in unique if self.index.get(tg_id) is not None}
+            links = await self.place_clients([entry for tg_id, entry in unique.items() if tg_id not in existing])
+        return links, existing
+
+    async def place_clients(self, entries):
+        if not entries:
+            return {}
+        await self.refresh_index()
+        candidates = self.placements()
+        if not candidates:
+            logger.error("Нет доступных инбаундов для добавления клиентов.")
+            return {}
+        batches = {}
+        for entry in entries:
+            placement = self.strategy(candidates)
+            # Следующий клиент выбирается с учетом уже распределенных
+            placement.clients += 1
+            batches.setdefault(id(placement), (placement, []))[1].append(entry)
+        results = await asyncio.gather(*(placement.node.add_clients(batch, inbound=placement.item)
+                                         for placement, batch in batches.values()))
+        return {tg_id: link for result in results for tg_id, link in result.items()}
+
+    # Разбивает tg_id по панелям и вызывает пакетный метод каждой панели параллельно
+    async def per_node(self, tg_ids, call):
+        tg_ids = set(tg_ids)
+        async with self.user_locks.hold_many(tg_ids):
+            await self.refresh_index()
+            by_node = {}
+            for tg_id in tg_ids:
+                node = self.node_for(tg_id)
+                if node is not None:
+                    by_node.setdefault(node.name, (node, []))[1].append(tg_id)
+            results = await asyncio.gather(*(call(node, batch) for node, batch in by_node.values()))
+        return set().union(*results)
+
+    async def renew_many(self, day, tg_ids):
+        return await self.per_node(tg_ids, lambda node, batch: node.renew_many(day, batch))
+
+    async def delete_many(self, tg_ids):
+        return await self.per_node(tg_ids, lambda node, batch: node.delete_many(batch))
+
+    async def set_expiry_many(self, expiry_time, tg_ids):
+        return await self.per_node(tg_ids, lambda node, batch: node.set_expiry_many(expiry_time, batch))
+
+    async def lookup_client_link(self, tg_id):
+        await self.refresh_index()
+        node = self.node_for(tg_id)
+        if node is None:
+            logger.debug(f"Клиент с tg_id {tg_id} не найден.")
+            return None
+        return await node.find_client_by_tg_id(tg_id)
+
+    async def find_client_by_tg_id(self, tg_id):
+        return await self.flights.do(("link", tg_id), self.lookup_client_link, tg_id)
+
+    async def lookup_expirytime(self, tg_id):
+        entry = await self.get_client(tg_id)
+        if entry is None:
+            logger.debug(f"Клиент с tg_id {tg_id} не найден.")
+            return None
+        return entry[1].get("expiryTime")
+
+    async def find_expirytime_by_tg_id(self, tg_id):
+        return await self.flights.do(("expiry", tg_id), self.lookup_expirytime, tg_id)
+
+    def build_client_link(self, item, client):
+        return self.node_for(client["tgId"]).build_client_link(item, client)
+
+
+# Панели пула берутся из PANELS (JSON-список), иначе используется одна панель из HOST/LOGIN/PASSWORD:
+# PANELS='[{"name": "de-1", "host": "https://1.2.3.4:2053", "login": "...", "password": "...",
+#           "base_path": "/path", "weight": 2, "inbounds": [1, 3]}]'
+def load_panels():
+    raw = os.getenv("PANELS")
+    if not raw:
+        return [X3(login=LOGIN, password=PASSWORD, host=HOST, name="default")]
+    return [
+        X3(
+            login=panel["login"],
+            password=panel["password"],
+            host=panel["host"],
+            base_path=panel.get("base_path", BASE_PATH),
+            name=panel.get("name", panel["host"]),
+            weight=panel.get("weight", 1),
+            inbound_ids=panel.get("inbounds")
+        )
+        for panel in json.loads(raw)
+    ]
+
+
+PLACEMENT_STRATEGY = os.getenv("PLACEMENT_STRATEGY", "least_clients")
+
+# Слушатели индекса клиентов: подключаются к пулу, когда контекст приложения его создает
+index_listeners = []
+
+
+def make_pool():
+    pool = X3Pool(load_panels(), strategy=PLACEMENT_STRATEGIES[PLACEMENT_STRATEGY])
+    pool.index.listeners.extend(index_listeners)
+    return pool
 
 
-# Инициализация X3 с использованием ваших данных
-x3 = X3(
-    login=LOGIN,
-    password=PASSWORD,
-    host=HOST
-)
\ No newline at end of file
+# Пул панелей из контекста приложения: создается при первом обращении, вход в панели - при первом запросе
+x3 = Lazy(lambda: current().x3)